@@ -70,6 +70,8 @@ Information on the TMDA mailing lists can be found at:
                 'tmda/bin/tmda-address', 'tmda/bin/tmda-check-address',
                 'tmda/bin/tmda-pending',
                 'tmda/bin/tmda-filter', 'tmda/bin/tmda-rfilter',
+                'tmda/bin/tmda-filterd', 'tmda/bin/tmda-filter-client',
+                'tmda/bin/tmda-filter-batch',
                 'tmda/bin/tmda-sendmail', 'tmda/bin/tmda-inject',
                 'tmda/bin/tmda-ofmipd' ]
 )
@@ -104,10 +104,12 @@ class ConfirmAddress(TaggedAddress):
     def verify(self, dummy=''):
         try:
             (timestamp, pid, hmac) = self.local_parts[-1].split('.')
-            if not Cookie.verify_confirm_mac(hmac, timestamp, pid, self.keyword):
-                raise BadCryptoError("Invalid cryptographic tag.")
         except ValueError:
             raise BadCryptoError("Invalid cryptographic tag format.")
+        key = Cookie.verify_confirm_mac(hmac, timestamp, pid, self.keyword)
+        if not key:
+            raise BadCryptoError("Invalid cryptographic tag.")
+        return key
 
     def keyword(self):
         return self.keyword
@@ -139,13 +141,15 @@ class DatedAddress(TaggedAddress):
     def verify(self, dummy=''):
         try:
             (timestamp, hmac) = self.local_parts[-1].split('.')
-            try_hmac = Cookie.datemac(timestamp)
-            if int(time.time()) > int(timestamp):
-                raise ExpiredAddressError("Dated address has expired.")
-            if try_hmac != hmac:
-                raise BadCryptoError("Invalid cryptographic tag.")
+            expired = int(time.time()) > int(timestamp)
         except ValueError:
             raise BadCryptoError("Invalid cryptographic tag format.")
+        if expired:
+            raise ExpiredAddressError("Dated address has expired.")
+        key = Cookie.verify_dated_mac(hmac, timestamp)
+        if not key:
+            raise BadCryptoError("Invalid cryptographic tag.")
+        return key
 
     def timestamp(self):
         return self.local_parts[-1].split('.')[0]
@@ -176,8 +180,10 @@ class KeywordAddress(TaggedAddress):
         if not keyword:
             raise BadCryptoError("Invalid cryptographic tag format.")
         hmac = parts[-1]
-        if not Cookie.verify_keyword_mac(hmac, keyword):
+        key = Cookie.verify_keyword_mac(hmac, keyword)
+        if not key:
             raise BadCryptoError("Invalid cryptographic tag.")
+        return key
 
     def keyword(self):
         return '.'.join(self.local_parts[-1].split('.')[:-1])
@@ -212,12 +218,13 @@ class SenderAddress(TaggedAddress):
             domain = sender.split('@')[-1]
             domain_parts = domain.split('.')
             while len(domain_parts)>1:
-                if Cookie.verify_sender_mac(hmac, '.'.join(domain_parts)):
-                    match = True
+                match = Cookie.verify_sender_mac(hmac, '.'.join(domain_parts))
+                if match:
                     break
                 del domain_parts[0]
         if not match:
             raise BadCryptoError("Invalid cryptographic tag.")
+        return match
 
     def hmac(self):
         return self.local_parts[-1]
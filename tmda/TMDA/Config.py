@@ -0,0 +1,245 @@
+# -*- mode:python; tab-width:4; c-basic-offset:4; intent-tabs-mode:nil; -*-
+# ex: filetype=python tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent smartindent
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+"""Per-user configurations, for processes serving several users.
+
+TMDA reads its settings as attributes of the TMDA.Defaults module,
+computed once for the user running the program.  A Config object
+holds the settings of one user instead, computed by the same code
+from that user's environment (HOME, TMDARC, etc.) and configuration
+files, including the crypt keys.
+
+Importing this module makes TMDA.Defaults look up its attributes in the
+Config object activated in the current thread or context, if any:
+
+    config = Config.for_user('jdoe')
+    with config.activate():
+        Cookie.make_dated_address(...)
+
+so Cookie, FilterParser, Queue, Deliver, AutoResponse, etc. use that
+user's settings without change.  Outside of activate(), TMDA.Defaults
+has the settings of the process, if it was imported before this module
+(otherwise, it has none).  get() and for_user() keep the configurations
+most recently used, up to cache_size of them, and load them again when
+a configuration or key file changes.
+"""
+
+
+import builtins
+import collections
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import types
+
+from . import Util
+
+
+# The number of configurations kept by get().
+cache_size = 128
+
+_active = contextvars.ContextVar('TMDA.Config', default=None)
+_configs = collections.OrderedDict()
+_lock = threading.RLock()
+_code = None
+
+
+class _DefaultsModule(types.ModuleType):
+    """TMDA.Defaults, resolving its attributes in the active Config."""
+    def __getattribute__(self, name):
+        config = _active.get()
+        if config is not None:
+            if name == '__dict__':
+                return config.settings
+            try:
+                return config.settings[name]
+            except KeyError:
+                pass
+        return types.ModuleType.__getattribute__(self, name)
+
+    def __setattr__(self, name, value):
+        config = _active.get()
+        if config is not None:
+            config.settings[name] = value
+        else:
+            types.ModuleType.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        config = _active.get()
+        if config is not None:
+            del config.settings[name]
+        else:
+            types.ModuleType.__delattr__(self, name)
+
+
+def _defaults_file():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'Defaults.py')
+
+
+def _install():
+    """Make TMDA.Defaults resolve its attributes in the active Config."""
+    import TMDA
+    module = sys.modules.get('TMDA.Defaults')
+    if module is None:
+        module = _DefaultsModule('TMDA.Defaults')
+        module.__file__ = _defaults_file()
+        module.__package__ = 'TMDA'
+        sys.modules['TMDA.Defaults'] = module
+        TMDA.Defaults = module
+    elif not isinstance(module, _DefaultsModule):
+        module.__class__ = _DefaultsModule
+
+
+def _os_module(environ):
+    """
+    Return a copy of the os module whose environ (and getenv(), and
+    os.path.expanduser() for the user's own directory) is environ.
+    """
+    def expanduser(path):
+        if isinstance(path, str) and (path == '~' or path.startswith('~/')):
+            home = environ.get('HOME')
+            if home is not None:
+                return (home.rstrip('/') or '/') + path[1:]
+        return os.path.expanduser(path)
+
+    path = types.ModuleType(os.path.__name__)
+    path.__dict__.update(os.path.__dict__)
+    path.expanduser = expanduser
+    module = types.ModuleType(os.__name__)
+    module.__dict__.update(os.__dict__)
+    module.environ = environ
+    module.getenv = environ.get
+    module.path = path
+    return module
+
+
+def _builtins(environ):
+    """
+    Return the builtins of the code computing the settings, which is
+    given the _os_module() of environ when it imports os.
+    """
+    module = _os_module(environ)
+    def importer(name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0 and name == 'os':
+            return module
+        if level == 0 and name == 'os.path':
+            return fromlist and module.path or module
+        return builtins.__import__(name, globals, locals, fromlist, level)
+    return dict(vars(builtins), __import__=importer)
+
+
+def _stamp(filename):
+    try:
+        st = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class Config:
+    """The settings of one user."""
+    def __init__(self, environ):
+        """
+        environ is the environment the settings are computed in (a
+        dictionary, e.g. a copy of os.environ with HOME changed).
+        Errors.ConfigError is raised as TMDA.Defaults would raise it,
+        e.g. for a missing crypt key.
+        """
+        global _code
+        self.environ = dict(environ)
+        # The code of TMDA.Defaults, and the configuration files it
+        # runs, read this environment when they import os; os.environ
+        # is left alone.
+        self.settings = {'__name__': 'TMDA.Defaults',
+                         '__package__': 'TMDA',
+                         '__file__': _defaults_file(),
+                         '__builtins__': _builtins(self.environ)}
+        with _lock:
+            if _code is None:
+                fp = open(_defaults_file())
+                _code = compile(fp.read(), _defaults_file(), 'exec')
+                fp.close()
+        exec(_code, self.settings)
+        self.stamps = {}
+        for name in ('GLOBAL_TMDARC', 'TMDARC', 'CRYPT_KEY_FILE',
+                     'CRYPT_KEY_FILE_ROLLOVER'):
+            filename = self.settings.get(name)
+            self.stamps[filename] = _stamp(filename)
+
+    def __getattr__(self, name):
+        try:
+            return self.settings[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def stale(self):
+        """Return true if a configuration or key file has changed."""
+        for (filename, stamp) in self.stamps.items():
+            if _stamp(filename) != stamp:
+                return 1
+        return 0
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Use these settings as TMDA.Defaults within a with block."""
+        token = _active.set(self)
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+
+
+def active():
+    """Return the active Config, or None."""
+    return _active.get()
+
+
+def get(environ=None, **variables):
+    """
+    Return the Config for environ (os.environ by default) updated with
+    variables, loading it unless a recent one is kept.
+    """
+    environ = dict(environ or os.environ)
+    environ.update(variables)
+    key = tuple(sorted(Util.config_environ(environ).items()))
+    with _lock:
+        config = _configs.pop(key, None)
+        if config is None or config.stale():
+            config = Config(environ)
+        _configs[key] = config
+        while len(_configs) > cache_size:
+            _configs.popitem(last=False)
+    return config
+
+
+def for_user(username, environ=None):
+    """Return the Config of a system user."""
+    import pwd
+    pw = pwd.getpwnam(username)
+    return get(environ, HOME=pw.pw_dir, USER=username, LOGNAME=username)
+
+
+_install()
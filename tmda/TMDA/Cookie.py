@@ -36,15 +36,35 @@
 
 import base64
 from binascii import hexlify
+import collections
+import concurrent.futures
+import contextvars
+import dbm
 import os
 import re
+import stat
+import threading
 import time
 import hmac
 import hashlib
+import marshal
+import tempfile
 
 from . import Defaults
 from . import Util
 
+# The subkeys of the 'k2' algorithms, keyed by (key, algorithm, rounds);
+# see tmda_subkey().
+_subkeys = {}
+
+# The results of verify_mac() and make_mac(), most recently used last,
+# keyed by _cache_tag(); see COOKIE_CACHE_LEN.  Failed verifications
+# are kept apart, in memory only, so that bad cookies can't push the
+# good ones out.
+_cookies = collections.OrderedDict()
+_failures = collections.OrderedDict()
+_cookies_lock = threading.Lock()
+
 def tmda_mac_encode(mac_bytes, rollover=False, legacy=False):
     """Encode the given bytes into a alphanumeric (Base64-derived) string,
     unless legacy/hexadecimal encoding is required or the new/alphanumeric
@@ -68,6 +88,65 @@ def tmda_mac_encode(mac_bytes, rollover=False, legacy=False):
     return mac_str
 
 
+def _subkey_file_safe(st):
+    """Return true if the subkey file of stat result st is owned by this
+    user, and has a mode allowed for CRYPT_KEY_FILE (see
+    ALLOW_MODE_640)."""
+    mode = stat.S_IMODE(st.st_mode)
+    return (st.st_uid == os.getuid()
+            and (mode in (0o400, 0o600)
+                 or (Defaults.ALLOW_MODE_640 and mode == 0o640)))
+
+
+def tmda_subkey(key, algo, rounds, keyfile=None):
+    """Return the subkey used along the 'k2' algorithms: key derived with
+    PBKDF2 along algo, using 10^rounds rounds.  It is computed once per
+    key, and kept in memory and, if keyfile is given, in CACHE_DIR, in a
+    file held to the same owner and mode as CRYPT_KEY_FILE."""
+    subkey = _subkeys.get((key, algo, rounds))
+    if subkey is not None:
+        return subkey
+    cachefile = None
+    if keyfile and Defaults.CACHE_DIR:
+        keyfile = os.path.abspath(keyfile)
+        digest = hashlib.sha1(keyfile.encode()).hexdigest()
+        cachefile = os.path.join(Defaults.CACHE_DIR, 'keys',
+                                 '%s.%s.%s%d' % (os.path.basename(keyfile),
+                                                 digest, algo, rounds))
+        try:
+            with open(cachefile, 'rb') as fp:
+                if not _subkey_file_safe(os.fstat(fp.fileno())):
+                    raise ValueError('unsafe subkey file')
+                (check, subkey) = marshal.loads(fp.read())
+            # The subkey is only used if it was derived from this key.
+            if not hmac.compare_digest(check, hmac.new(key, subkey, 'sha256').digest()):
+                subkey = None
+        except (OSError, EOFError, ValueError, TypeError):
+            subkey = None
+    if subkey is None:
+        # The key is the "password", along a fixed "salt".
+        subkey = hashlib.pbkdf2_hmac(algo, key, b'TMDA', 10**rounds)
+        if cachefile:
+            data = marshal.dumps((hmac.new(key, subkey, 'sha256').digest(), subkey))
+            try:
+                os.makedirs(os.path.dirname(cachefile), 0o700, exist_ok=True)
+                (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+                try:
+                    # (mkstemp() creates it with mode 600)
+                    with os.fdopen(fd, 'wb') as fp:
+                        fp.write(data)
+                    os.rename(tmpname, cachefile)
+                except OSError:
+                    os.unlink(tmpname)
+                    raise
+            except OSError:
+                pass
+    if len(_subkeys) >= 100:
+        _subkeys.clear()
+    _subkeys[(key, algo, rounds)] = subkey
+    return subkey
+
+
 def tmda_mac_bytes(*items, rollover=False):
     """Create a HMAC based on items (which must be strings), using the
     configured HMAC_ALGO(_ROLLOVER) algorithm along the CRYPT_KEY(_ROLLOVER),
@@ -75,42 +154,228 @@ def tmda_mac_bytes(*items, rollover=False):
     items_bytes = ''.join(items).encode()
     if rollover:
         algo = Defaults.HMAC_ALGO_ROLLOVER.lower()
-        if algo[:2] == 'p2':
-            rounds = 10**Defaults.HMAC_ROUNDS_ROLLOVER
-            # Let's use the (short) items_bytes as "password" and the known very long key as "salt"
-            mac_bytes = hashlib.pbkdf2_hmac(algo[2:], items_bytes, Defaults.CRYPT_KEY_ROLLOVER, rounds)
-        else:
-            mac_bytes = hmac.new(Defaults.CRYPT_KEY_ROLLOVER, items_bytes, algo).digest()
+        rounds = Defaults.HMAC_ROUNDS_ROLLOVER
+        key = Defaults.CRYPT_KEY_ROLLOVER
+        keyfile = Defaults.CRYPT_KEY_FILE_ROLLOVER
     else:
         algo = Defaults.HMAC_ALGO.lower()
-        if algo[:2] == 'p2':
-            rounds = 10**Defaults.HMAC_ROUNDS
-            # Let's use the (short) items_bytes as "password" and the known very long key as "salt"
-            mac_bytes = hashlib.pbkdf2_hmac(algo[2:], items_bytes, Defaults.CRYPT_KEY, rounds)
-        else:
-            mac_bytes = hmac.new(Defaults.CRYPT_KEY, items_bytes, algo).digest()
+        rounds = Defaults.HMAC_ROUNDS
+        key = Defaults.CRYPT_KEY
+        keyfile = Defaults.CRYPT_KEY_FILE
+    if algo[:2] == 'p2':
+        # Let's use the (short) items_bytes as "password" and the known very long key as "salt"
+        mac_bytes = hashlib.pbkdf2_hmac(algo[2:], items_bytes, key, 10**rounds)
+    elif algo[:2] == 'k2':
+        subkey = tmda_subkey(key, algo[2:], rounds, keyfile)
+        mac_bytes = hmac.new(subkey, items_bytes, algo[2:]).digest()
+    else:
+        mac_bytes = hmac.new(key, items_bytes, algo).digest()
     return mac_bytes
 
 
+def _key_epoch():
+    """Return a digest identifying the keys and HMAC settings in use, so
+    that cached results don't outlive them."""
+    settings = repr((Defaults.HMAC_ALGO, Defaults.HMAC_ROUNDS,
+                     Defaults.HMAC_BYTES, Defaults.HMAC_ALGO_ROLLOVER,
+                     Defaults.HMAC_ROUNDS_ROLLOVER,
+                     Defaults.HMAC_BYTES_ROLLOVER,
+                     Defaults.HMAC_ENCODING_COMPAT)).encode()
+    return hashlib.sha256(b'\0'.join((settings,
+                                      Defaults.CRYPT_KEY or b'',
+                                      Defaults.CRYPT_KEY_ROLLOVER or b''))
+                          ).digest()
+
+
+def _cache_tag(kind, items, mac=''):
+    """Return the cache key of a verify_mac() (kind 'verify') or
+    make_mac() (kind 'make') call.  It is itself a (cheap) HMAC, so that
+    COOKIE_CACHE entries can't be forged without the key."""
+    data = b'\0'.join((_key_epoch(), kind.encode(), mac.encode(),
+                       ''.join(items).encode()))
+    return hmac.new(Defaults.CRYPT_KEY or b'', data, 'sha256').digest()
+
+
+def _verify_slow():
+    """Return true if verifying a HMAC is worth caching."""
+    if Defaults.HMAC_ALGO.lower()[:2] == 'p2':
+        return True
+    return bool(Defaults.CRYPT_KEY_ROLLOVER
+                and Defaults.HMAC_ALGO_ROLLOVER.lower()[:2] == 'p2')
+
+
+def _cache_get(tag):
+    """Return the cached result for tag, or None."""
+    with _cookies_lock:
+        for cache in (_cookies, _failures):
+            result = cache.get(tag)
+            if result is not None:
+                cache.move_to_end(tag)
+                return result
+    if Defaults.COOKIE_CACHE:
+        try:
+            db = dbm.open(Defaults.COOKIE_CACHE, 'r')
+            try:
+                result = db.get(tag)
+            finally:
+                db.close()
+        except dbm.error:
+            # Missing or busy; it is only a cache.
+            return None
+        if result is not None:
+            result = result.decode()
+            _cache_put(tag, result, store=False)
+    return result
+
+
+def _cache_put(tag, result, store=True):
+    """Cache the result for tag (an empty result in memory only)."""
+    cache = _cookies if result else _failures
+    with _cookies_lock:
+        cache[tag] = result
+        cache.move_to_end(tag)
+        while len(cache) > Defaults.COOKIE_CACHE_LEN:
+            cache.popitem(last=False)
+    if store and result and Defaults.COOKIE_CACHE:
+        try:
+            db = dbm.open(Defaults.COOKIE_CACHE, 'c', 0o600)
+            try:
+                if len(db) >= Defaults.COOKIE_CACHE_LEN:
+                    db.close()
+                    db = dbm.open(Defaults.COOKIE_CACHE, 'n', 0o600)
+                db[tag] = result.encode()
+            finally:
+                db.close()
+        except dbm.error:
+            pass
+
+
+def _key_switch_time():
+    """Return the time the current key was switched to (see
+    CRYPT_KEY_SWITCH_TIME), or None if unknown."""
+    if Defaults.CRYPT_KEY_SWITCH_TIME is not None:
+        return Defaults.CRYPT_KEY_SWITCH_TIME
+    try:
+        return os.stat(Defaults.CRYPT_KEY_FILE).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+def _mac_matches(mac, items, rollover, legacy):
+    """Return true if mac is the encoded HMAC of items with the current or
+    rollover key."""
+    return hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(*items, rollover=rollover), rollover=rollover, legacy=legacy))
+
+
+def verify_mac(mac, *items, made_before=None):
+    """Verify the given encoded HMAC of items (see tmda_mac_bytes), and
+    return 'current' or 'rollover' depending on the key it was made
+    with, or None if it doesn't match.  Results are cached when PBKDF2
+    is involved; see COOKIE_CACHE and COOKIE_CACHE_LEN.
+
+    made_before is the latest time the HMAC can have been made at, if
+    known (e.g, the timestamp of a confirmation cookie); the rollover
+    key is tried first if that was before the current key was switched
+    to.  Otherwise, when both keys use PBKDF2, the two HMACs are
+    computed concurrently."""
+    mac = mac.lower()
+    tag = None
+    if _verify_slow():
+        tag = _cache_tag('verify', items, mac)
+        result = _cache_get(tag)
+        if result is not None:
+            return result or None
+    legacy = Defaults.HMAC_ENCODING_COMPAT and not re.search('[g-z]', mac)
+    result = ''
+    if not Defaults.CRYPT_KEY_ROLLOVER:
+        if _mac_matches(mac, items, False, legacy):
+            result = 'current'
+    elif made_before is not None:
+        switch_time = _key_switch_time()
+        order = (False, True)
+        try:
+            if switch_time is not None and int(made_before) < switch_time:
+                order = (True, False)
+        except ValueError:
+            pass
+        for rollover in order:
+            if _mac_matches(mac, items, rollover, legacy):
+                result = rollover and 'rollover' or 'current'
+                break
+    elif (Defaults.HMAC_ALGO.lower()[:2] == 'p2'
+          and Defaults.HMAC_ALGO_ROLLOVER.lower()[:2] == 'p2'):
+        # hashlib releases the GIL while deriving.  The thread runs in
+        # a copy of this context, for the Defaults of a Config object.
+        matches = []
+        def rollover_matches():
+            matches.append(_mac_matches(mac, items, True, legacy))
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run,
+                                  args=(rollover_matches,))
+        thread.start()
+        current = _mac_matches(mac, items, False, legacy)
+        thread.join()
+        if current:
+            result = 'current'
+        elif matches and matches[0]:
+            result = 'rollover'
+    else:
+        if _mac_matches(mac, items, False, legacy):
+            result = 'current'
+        elif _mac_matches(mac, items, True, legacy):
+            result = 'rollover'
+    if tag is not None:
+        _cache_put(tag, result)
+    return result or None
+
+
+def make_mac(*items):
+    """Return the encoded HMAC of items (see tmda_mac_bytes) with the
+    current key.  Like verify_mac() results, it is cached when PBKDF2 is
+    involved; see COOKIE_CACHE and COOKIE_CACHE_LEN."""
+    if Defaults.HMAC_ALGO.lower()[:2] != 'p2':
+        return tmda_mac_encode(tmda_mac_bytes(*items))
+    tag = _cache_tag('make', items)
+    mac = _cache_get(tag)
+    if mac is None:
+        mac = tmda_mac_encode(tmda_mac_bytes(*items))
+        _cache_put(tag, mac)
+        _cache_put(_cache_tag('verify', items, mac), 'current')
+    return mac
+
+
+def make_macs(itemslist, threads=None):
+    """Return the list of the encoded HMACs of each tuple of items in
+    itemslist, as make_mac() does.  When PBKDF2 is involved, they are
+    computed by up to threads threads (default: one per processor), the
+    later make_* calls for the same items finding them in the cache."""
+    if Defaults.HMAC_ALGO.lower()[:2] != 'p2' or len(itemslist) < 2:
+        return [ make_mac(*items) for items in itemslist ]
+    threads = min(threads or os.cpu_count() or 1, len(itemslist))
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        # Each call runs in a copy of this context, for the Defaults of
+        # a Config object.
+        futures = [ executor.submit(contextvars.copy_context().run,
+                                    make_mac, *items)
+                    for items in itemslist ]
+        return [ future.result() for future in futures ]
+
+
 def make_confirm_mac(time, pid, keyword=None):
     """Expects time, pid and optionally keyword and returns an encoded HMAC."""
     time = str(time)
     pid = str(pid)
     if keyword is None: keyword = ''
-    return tmda_mac_encode(tmda_mac_bytes(time, pid, keyword))
+    return make_mac(time, pid, keyword)
 
 
 def verify_confirm_mac(mac, time, pid, keyword=None):
-    """Verifies the given HMAC. Returns True on match, False otherwise"""
-    mac = mac.lower()
+    """Verifies the given HMAC. Returns the key it matches ('current' or
+    'rollover', see verify_mac) on match, None otherwise"""
     time = str(time)
     pid = str(pid)
     if keyword is None: keyword = ''
-    legacy = Defaults.HMAC_ENCODING_COMPAT and not re.search('[g-z]', mac)
-    verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(time, pid, keyword, rollover=False), rollover=False, legacy=legacy))
-    if not verify and Defaults.CRYPT_KEY_ROLLOVER:
-        verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(time, pid, keyword, rollover=True), rollover=True, legacy=legacy))
-    return verify
+    return verify_mac(mac, time, pid, keyword, made_before=time)
 
 
 def make_confirm_cookie(time, pid, keyword=None):
@@ -138,18 +403,14 @@ def make_confirm_address(address, time, pid, keyword=None):
 def make_dated_mac(expire_time):
     """Expects expiration time (Unix epoch) and returns an encoded HMAC."""
     expire_time = str(expire_time)
-    return tmda_mac_encode(tmda_mac_bytes(expire_time))
+    return make_mac(expire_time)
 
 
 def verify_dated_mac(mac, expire_time):
-    """Verifies the given HMAC. Returns True on match, False otherwise"""
-    mac = mac.lower()
+    """Verifies the given HMAC. Returns the key it matches ('current' or
+    'rollover', see verify_mac) on match, None otherwise"""
     expire_time = str(expire_time)
-    legacy = Defaults.HMAC_ENCODING_COMPAT and not re.search('[g-z]', mac)
-    verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(expire_time, rollover=False), rollover=False, legacy=legacy))
-    if not verify and Defaults.CRYPT_KEY_ROLLOVER:
-        verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(expire_time, rollover=True), rollover=True, legacy=legacy))
-    return verify
+    return verify_mac(mac, expire_time, made_before=expire_time)
 
 
 def make_dated_cookie(time, timeout = None):
@@ -179,18 +440,14 @@ def make_dated_address(address, addrtime=None):
 def make_sender_mac(address):
     """Expects sender address and returns an encoded HMAC."""
     address = address.lower()
-    return tmda_mac_encode(tmda_mac_bytes(address))
+    return make_mac(address)
 
 
 def verify_sender_mac(mac, address):
-    """Verifies the given HMAC. Returns True on match, False otherwise"""
-    mac = mac.lower()
+    """Verifies the given HMAC. Returns the key it matches ('current' or
+    'rollover', see verify_mac) on match, None otherwise"""
     address = address.lower()
-    legacy = Defaults.HMAC_ENCODING_COMPAT and not re.search('[g-z]', mac)
-    verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(address, rollover=False), rollover=False, legacy=legacy))
-    if not verify and Defaults.CRYPT_KEY_ROLLOVER:
-        verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(address, rollover=True), rollover=True, legacy=legacy))
-    return verify
+    return verify_mac(mac, address)
 
 
 def make_sender_cookie(address):
@@ -210,6 +467,14 @@ def make_sender_address(address, sender):
     return sender_address
 
 
+def make_sender_addresses(address, senders, threads=None):
+    """Return the list of the full sender-style e-mail addresses for
+    each of senders, computing their HMACs concurrently (see
+    make_macs)."""
+    make_macs([ (sender.lower(),) for sender in senders ], threads)
+    return [ make_sender_address(address, sender) for sender in senders ]
+
+
 def sanitize_keyword(keyword):
     """Returns a sanitized keyword, safe to use in a RFC 2822 address."""
     # Characters outside of an RFC2822 atom token are changed to '?'
@@ -221,18 +486,14 @@ def sanitize_keyword(keyword):
 def make_keyword_mac(keyword):
     """Expects a keyword as a string, returns an encoded HMAC."""
     keyword = sanitize_keyword(keyword).lower()
-    return tmda_mac_encode(tmda_mac_bytes(keyword))
+    return make_mac(keyword)
 
 
 def verify_keyword_mac(mac, keyword):
-    """Verifies the given HMAC. Returns True on match, False otherwise"""
-    mac = mac.lower()
+    """Verifies the given HMAC. Returns the key it matches ('current' or
+    'rollover', see verify_mac) on match, None otherwise"""
     keyword = sanitize_keyword(keyword).lower()
-    legacy = Defaults.HMAC_ENCODING_COMPAT and not re.search('[g-z]', mac)
-    verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(keyword, rollover=False), rollover=False, legacy=legacy))
-    if not verify and Defaults.CRYPT_KEY_ROLLOVER:
-        verify = hmac.compare_digest(mac, tmda_mac_encode(tmda_mac_bytes(keyword, rollover=True), rollover=True, legacy=legacy))
-    return verify
+    return verify_mac(mac, keyword)
 
 
 def make_keyword_cookie(keyword):
@@ -259,7 +520,7 @@ def make_fingerprint(hdrlist):
     (unsliced) HMAC as a base64 encoded string, but with the trailing
     '=' and newline removed."""
     algo = Defaults.HMAC_ALGO.lower()
-    if algo[:2] == 'p2': algo = algo[2:]
+    if algo[:2] in ('p2', 'k2'): algo = algo[2:]
     fp = hmac.new(Defaults.CRYPT_KEY, digestmod=algo)
     for hdr in hdrlist:
         if isinstance(hdr, str):
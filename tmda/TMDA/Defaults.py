@@ -35,11 +35,16 @@ OFF = Off = off = NO = No = no = FALSE = false = False
 # /etc/tmdarc or ~/.tmda/config instead.
 
 import binascii
+import hashlib
+import marshal
 import os
 import string
 import sys
+import tempfile
+from importlib.util import MAGIC_NUMBER
 
 from . import Errors
+from . import Util
 
 
 ##############################
@@ -68,6 +73,58 @@ if os.path.islink(progpath):
         progpath = os.path.normpath(progdir + '/' + linkpath)
 PARENTDIR = os.path.split(os.path.dirname(progpath))[0] # '../'
 
+# The configuration files are compiled once and kept, along with the
+# optional snapshot of the settings (see CONFIG_CACHE_SNAPSHOT), in the
+# 'config' subdirectory of the directory given by TMDA_CACHE_DIR, or
+# ~/.tmda/cache, since CACHE_DIR can't be known before they are read.
+_config_cache = os.path.join(os.environ.get('TMDA_CACHE_DIR') or
+                             os.path.join(HOMEDIR, '.tmda', 'cache'),
+                             'config')
+
+def _config_cachefile(filename, suffix):
+    """Return the pathname of a cache file kept for filename."""
+    digest = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    return os.path.join(_config_cache, digest + suffix)
+
+def _config_stamp(filename):
+    """Return a value identifying the current version of filename."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _config_write(cachefile, data):
+    """Write a cache file atomically, ignoring errors."""
+    try:
+        os.makedirs(_config_cache, 0o700, exist_ok=True)
+        (fd, tmpname) = tempfile.mkstemp(dir=_config_cache)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmpname, cachefile)
+    except OSError:
+        pass
+
+def _config_code(filename):
+    """
+    Return the code object of a configuration file.  Like a .pyc file,
+    it is kept in the cache and used as long as the file and the Python
+    version are unchanged.
+    """
+    key = (MAGIC_NUMBER, os.path.abspath(filename), _config_stamp(filename))
+    cachefile = _config_cachefile(filename, '.code')
+    try:
+        with open(cachefile, 'rb') as fp:
+            (cached_key, code) = marshal.loads(fp.read())
+        if cached_key == key:
+            return code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    with open(filename) as fp:
+        code = compile(fp.read(), filename, 'exec')
+    _config_write(cachefile, marshal.dumps((key, code)))
+    return code
+
 # Look for the global config file in the environment first, and then
 # default to /etc/tmdarc.  If one exists, read it before TMDARC. Make
 # site-wide configuration changes to this file.
@@ -75,7 +132,7 @@ GLOBAL_TMDARC = os.environ.get('GLOBAL_TMDARC')
 if not GLOBAL_TMDARC:
     GLOBAL_TMDARC = '/etc/tmdarc'
     if os.path.exists(GLOBAL_TMDARC):
-        exec(compile(open(GLOBAL_TMDARC).read(), GLOBAL_TMDARC, 'exec'))
+        exec(_config_code(GLOBAL_TMDARC))
 
 # Look for the user config file in the TMDARC environment var first,
 # and if not there, then check if set by GLOBAL_TMDARC, and finally
@@ -97,7 +154,7 @@ if 'CONFIG_EXEC' not in vars():
 # Read-in the user's configuration file.
 if os.path.exists(TMDARC):
     if CONFIG_EXEC:
-        exec(compile(open(TMDARC).read(), TMDARC, 'exec'))
+        exec(_config_code(TMDARC))
     else:
         import configparser
         cf = configparser.ConfigParser()
@@ -113,8 +170,53 @@ if os.path.exists(TMDARC):
             else:
                 exec('%s = "%s"' % (option, value))
 
+# CONFIG_CACHE_SNAPSHOT
+# If set to True in GLOBAL_TMDARC or TMDARC, the settings computed from
+# your configuration are saved in the cache, and reused instead of
+# being computed again as long as the configuration files and the
+# environment variables TMDA reads (HOME, USER, TMDA_*, etc.) are
+# unchanged.  Only plain values (strings, numbers, lists, etc.) are
+# saved; the crypt keys are always read from their files.  Don't set
+# this if your configuration depends on anything else, such as $EXT,
+# $RECIPIENT or the contents of other files.
+#
+# Default is False
+if 'CONFIG_CACHE_SNAPSHOT' not in vars():
+    CONFIG_CACHE_SNAPSHOT = False
+
+# Settings which are never saved in the snapshot.
+_snapshot_exclude = ('PID', 'CRYPT_KEY', 'CRYPT_KEY_ROLLOVER')
+
+def _snapshot_plain(value):
+    """Return true if value can be saved in the snapshot."""
+    if value is None or isinstance(value, (str, bytes, int, float)):
+        return True
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return all([ _snapshot_plain(item) for item in value ])
+    if isinstance(value, dict):
+        return all([ _snapshot_plain(item) for item in value.items() ])
+    return False
+
+_snapshot_loaded = False
+if CONFIG_CACHE_SNAPSHOT:
+    _snapshot_key = (MAGIC_NUMBER, os.getuid(), progpath,
+                     _config_stamp(__file__),
+                     GLOBAL_TMDARC, _config_stamp(GLOBAL_TMDARC),
+                     TMDARC, _config_stamp(TMDARC),
+                     sorted(Util.config_environ().items()))
+    _snapshot_file = _config_cachefile(TMDARC, '.settings')
+    try:
+        with open(_snapshot_file, 'rb') as fp:
+            (_cached_key, _settings) = marshal.loads(fp.read())
+        if _cached_key == _snapshot_key:
+            for (_name, _value) in _settings.items():
+                if _name not in vars():
+                    vars()[_name] = _value
+            _snapshot_loaded = True
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
 
-from . import Util
 from . import Version
 
 TMDA_HOMEPAGE = "(http://tmda.net/)"
@@ -588,6 +690,23 @@ if env_FILTER_OUTGOING:
 elif 'FILTER_OUTGOING' not in vars():
     FILTER_OUTGOING = os.path.join(DATADIR, 'filters', 'outgoing')
 
+# CACHE_DIR
+# Directory where TMDA keeps data it derives from your configuration
+# and filter files (e.g, pre-parsed filter rules) so that it doesn't
+# have to be recomputed for every message.  Everything stored here is
+# checked against the original files before use and rebuilt when they
+# change, so its contents can safely be removed at any time.  Look for
+# the directory in the environment (TMDA_CACHE_DIR) first.
+#
+# Set this variable to None to disable caching.
+#
+# Default is ~/.tmda/cache
+env_CACHE_DIR = os.environ.get('TMDA_CACHE_DIR')
+if env_CACHE_DIR:
+    CACHE_DIR = env_CACHE_DIR
+elif 'CACHE_DIR' not in vars():
+    CACHE_DIR = os.path.join(DATADIR, 'cache')
+
 # FILTER_BOUNCE_CC
 # An optional e-mail address which will be sent a copy of any message
 # that bounces because of a match in FILTER_INCOMING.
@@ -858,7 +977,7 @@ if 'FINGERPRINT' not in vars():
 #
 # Default comes from your environment or the password file.
 if 'FULLNAME' not in vars():
-    FULLNAME = Util.getfullname()
+    FULLNAME = Util.getfullname(os.environ)
 
 # HMAC_ALGO
 # The algorithm to use to obtain the HMAC, as a string compatible with
@@ -866,6 +985,17 @@ if 'FULLNAME' not in vars():
 # derivation function will be used along the chosen HMAC algorithm,
 # using 10^HMAC_ROUNDS rounds.
 #
+# If prefixed with a leading 'k2' instead (e.g, 'k2sha256'), PBKDF2 is
+# only used once per key, to derive a subkey from CRYPT_KEY with
+# 10^HMAC_ROUNDS rounds, and each HMAC is then computed along the chosen
+# algorithm with that subkey, costing a single HMAC per cookie instead
+# of a PBKDF2 derivation.  The subkey is kept in CACHE_DIR, in a file
+# which, like CRYPT_KEY_FILE, must be owned by you and chmod 400 or 600
+# (see ALLOW_MODE_640), or it is derived and written again.  Since this
+# changes all HMACs, switch to a 'k2' algorithm along a new key, keeping
+# the old key and algorithm in CRYPT_KEY_FILE_ROLLOVER and
+# HMAC_ALGO_ROLLOVER.
+#
 # CHANGING THIS VALUE WILL INVALIDATE ALL PREVIOUSLY GENERATED HMACs!
 #
 # Default is 'p2sha256' (PBKDF2 along SHA256)
@@ -903,6 +1033,35 @@ if 'HMAC_BYTES' not in vars():
 if 'HMAC_ENCODING_COMPAT' not in vars():
     HMAC_ENCODING_COMPAT = False
 
+# COOKIE_CACHE
+# Path to a file where the cookies (HMACs) made and the results of
+# their verifications are kept, so that a cookie seen before doesn't
+# need another PBKDF2 derivation (see HMAC_ALGO), e.g, when the same
+# dated or keyword address receives many messages, or when the same
+# sender address is tagged again.  Entries are keyed by a HMAC of the
+# cookie and of the keys and HMAC settings in use, so they can't be
+# forged without CRYPT_KEY, and they are ignored once a key changes.
+# Cookies are also cached in memory, up to COOKIE_CACHE_LEN entries, in
+# processes making or verifying several cookies.  Failed verifications
+# are only cached in memory, apart from the others.
+#
+# Example:
+# COOKIE_CACHE = "~/.tmda/.cookiecache"
+#
+# Default is None (no cache file)
+if 'COOKIE_CACHE' not in vars():
+    COOKIE_CACHE = None
+
+# COOKIE_CACHE_LEN
+# An integer which specifies the maximum number of cookies and
+# verification results held in memory and by COOKIE_CACHE (and of
+# failed verifications held in memory).  The file is emptied when it
+# gets full.
+#
+# Default is 1000
+if 'COOKIE_CACHE_LEN' not in vars():
+    COOKIE_CACHE_LEN = 1000
+
 # HOSTNAME
 # The right-hand side of your email address (after `@').  Used only in
 # cases where TMDA can't determine this itself.
@@ -912,7 +1071,7 @@ if 'HMAC_ENCODING_COMPAT' not in vars():
 #
 # Defaults to the fully qualified domain name of the localhost.
 if 'HOSTNAME' not in vars():
-    HOSTNAME = Util.gethostname()
+    HOSTNAME = Util.gethostname(os.environ)
 
 # LOGFILE_DEBUG
 # Filename which uncaught exceptions should be written to.
@@ -1110,6 +1269,16 @@ if 'PENDING_DIR' not in vars():
 #      Maildir is a specific one-file-per-message organization that
 #      was introduced with the qmail system by D.J. Bernstein.  For
 #      more information, see http://wiki.tmda.net/TmdaPendingAsMaildir
+#      Messages are looked up through PENDING_DIR/tmda-index, a
+#      directory of symbolic links named after the message ids.
+#
+# "sqlite"
+#      Messages are stored in a single SQLite database,
+#      PENDING_DIR/pending.sqlite, along with the headers used to list
+#      and expire them, which keeps large queues fast.  Messages already
+#      in PENDING_DIR in the "original" or "maildir" format are moved
+#      into the database a hundred at a time, each time TMDA opens it,
+#      or all at once by 'tmda-pending --cleanup'.
 #
 # Default is "original".
 if 'PENDING_QUEUE_FORMAT' not in vars():
@@ -1133,6 +1302,24 @@ if 'PENDING_QUEUE_FORMAT' not in vars():
 if 'PENDING_LIFETIME' not in vars():
     PENDING_LIFETIME = '14d'
 
+# PENDING_BUCKET_SIZE
+# A time interval (see PENDING_LIFETIME) which, with the "original"
+# PENDING_QUEUE_FORMAT, spreads the pending queue over subdirectories
+# of PENDING_DIR, one per interval, named after its start and end
+# times (e.g, 1159315200-1159401600).  Cleaning the queue then deletes
+# whole subdirectories instead of going through every message, and
+# looking a message up reads a small directory.  Messages already in
+# PENDING_DIR are moved into their subdirectory a few at a time as the
+# queue is cleaned.
+#
+# Example:
+#
+# PENDING_BUCKET_SIZE = "1d"
+#
+# Default is None (all messages are stored in PENDING_DIR)
+if 'PENDING_BUCKET_SIZE' not in vars():
+    PENDING_BUCKET_SIZE = None
+
 # PENDING_CLEANUP_ODDS
 # A floating point number which describes the odds that tmda-filter
 # will automatically clean the pending queue of expired messages upon
@@ -1140,8 +1327,9 @@ if 'PENDING_LIFETIME' not in vars():
 # pending queue is controlled by the PENDING_LIFETIME setting.
 #
 # If you wish to disable this feature in order to clean the queue by
-# hand, or through cron, set this value to 0.0.  If you wish to
-# trigger a cleanup every time a message arrives, set it to 1.0.
+# hand, or through cron (see 'tmda-pending --cleanup'), set this value
+# to 0.0.  If you wish to trigger a cleanup every time a message
+# arrives, set it to 1.0.
 #
 # The closer this value gets to 1.0, the fewer messages you'll have in
 # your pending queue beyond PENDING_LIFETIME, but at some additional
@@ -1158,9 +1346,26 @@ if 'PENDING_LIFETIME' not in vars():
 if 'PENDING_CLEANUP_ODDS' not in vars():
     PENDING_CLEANUP_ODDS = 0.01
 
+# PENDING_CLEANUP_BUDGET
+# An integer which specifies the maximum number of expired messages
+# deleted by each cleanup tmda-filter triggers (see
+# PENDING_CLEANUP_ODDS), the oldest first; the next cleanup carries on
+# from there, and once it is done, the queue is left alone until its
+# oldest message expires.  This bounds the time a cleanup adds to the
+# delivery of a message.  Such cleanups only compact the metadata of
+# the queue once it has doubled in size.  Only one process cleans the
+# queue at a time, and 'tmda-pending --cleanup' deletes all the expired
+# messages and compacts the metadata.  Set it to None for no limit.
+#
+# Default is 1000
+if 'PENDING_CLEANUP_BUDGET' not in vars():
+    PENDING_CLEANUP_BUDGET = 1000
+
 # PENDING_CACHE
 # Path to the cache file used when tmda-pending is invoked with the
-# --cache option.
+# --cache option.  Each run appends the ids of the messages it has
+# seen to this file, which is rewritten with the PENDING_CACHE_LEN
+# most recent ones once it has grown twice as long.
 #
 # Default is ~/.tmda/.pendingcache
 if 'PENDING_CACHE' not in vars():
@@ -1366,6 +1571,17 @@ if 'DB_PENDING_WHITELIST_APPEND' not in vars():
 if 'PENDING_WHITELIST_RELEASE' not in vars():
     PENDING_WHITELIST_RELEASE = 1
 
+# PENDING_RELEASE_CONNECTIONS
+# An integer specifying the number of connections to the SMTP server
+# over which tmda-pending sends the messages it releases in parallel,
+# when MAIL_TRANSPORT is "smtp".  Each connection is opened once and
+# reused (see SMTP_MAX_SESSIONS_PER_CONNECTION) for as many messages
+# as tmda-pending releases.
+#
+# Default is 1
+if 'PENDING_RELEASE_CONNECTIONS' not in vars():
+    PENDING_RELEASE_CONNECTIONS = 1
+
 # ADDED_HEADERS_CLIENT
 # A Python dictionary containing one or more header:value string pairs
 # that should be added to _all_ outgoing client-side messages (i.e,
@@ -1663,7 +1879,7 @@ if 'DATED_TIMEOUT' not in vars():
 #
 # Defaults to your UNIX username.
 if 'USERNAME' not in vars():
-    USERNAME = Util.getusername()
+    USERNAME = Util.getusername(os.environ)
 
 # TIMEOUT_UNITS
 # Dictionary that contains translations of timeout unit strings. This
@@ -1763,6 +1979,17 @@ if 'HMAC_ROUNDS_ROLLOVER' not in vars():
 if 'HMAC_BYTES_ROLLOVER' not in vars():
     HMAC_BYTES_ROLLOVER = HMAC_BYTES
 
+# CRYPT_KEY_SWITCH_TIME
+# The time (Unix epoch) at which the current key (as per CRYPT_KEY_FILE)
+# replaced the rollover key.  Confirmation and dated cookies made
+# before that time are checked against the rollover key first, saving
+# a HMAC computation (and a PBKDF2 derivation) for each of them.  This
+# is only a hint; all cookies are checked against both keys.
+#
+# Default is None (the modification time of CRYPT_KEY_FILE)
+if 'CRYPT_KEY_SWITCH_TIME' not in vars():
+    CRYPT_KEY_SWITCH_TIME = None
+
 ###################################
 # END of user configurable settings
 ###################################
@@ -1772,8 +1999,10 @@ if 'HMAC_BYTES_ROLLOVER' not in vars():
 # removing them from the code above.
 _path_vars = {
     'BARE_APPEND': None,
+    'CACHE_DIR': None,
     'CGI_SETTINGS': None,
     'CONFIRM_APPEND': None,
+    'COOKIE_CACHE': None,
     'CRYPT_KEY_FILE': None,
     'CRYPT_KEY_FILE_ROLLOVER': None,
     'DATADIR': None,
@@ -1844,3 +2073,12 @@ except IOError:
 CRYPT_KEY_ROLLOVER = None
 if CRYPT_KEY_FILE_ROLLOVER and not 'TMDA_CGI_MODE' in os.environ:
     CRYPT_KEY_ROLLOVER = binascii.unhexlify(open(CRYPT_KEY_FILE_ROLLOVER).read().strip())
+
+# Save the settings for the next time (see CONFIG_CACHE_SNAPSHOT).
+if CONFIG_CACHE_SNAPSHOT and not _snapshot_loaded:
+    _settings = {}
+    for (_name, _value) in list(vars().items()):
+        if (_name.isupper() and _name[0].isalpha()
+            and _name not in _snapshot_exclude and _snapshot_plain(_value)):
+            _settings[_name] = _value
+    _config_write(_snapshot_file, marshal.dumps((_snapshot_key, _settings)))
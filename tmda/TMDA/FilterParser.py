@@ -30,10 +30,14 @@ Filter file syntax documented in htdocs/config-filter.html
 """
 
 
+import collections
+import hashlib
 import os
+import pickle
 import re
 import string
 import sys
+import tempfile
 import time
 import types
 
@@ -41,6 +45,38 @@ from . import Defaults
 from . import Util
 
 
+# Format of the parsed filter cache.  Bump this whenever the structure
+# of the rules built by __parserule changes.
+_cache_version = 1
+
+# Parsed filter files of this process, keyed by filename.  The pickled
+# cache is kept rather than the rules themselves since firstmatch may
+# modify the action dictionaries of the rules it matches.
+_parsed = {}
+
+# Compiled address lists and opened index files of this process, keyed
+# by filename.
+_matchers = {}
+
+# Expressions read from body-file and headers-file lists, keyed by
+# filename, and the scanners compiled from them, keyed by the
+# expressions of all the rules they search for.  The least recently
+# used ones are dropped beyond _patternfiles_len and _scanners_len
+# (e.g, in tmda-filterd, as filters are edited).
+_patternfiles = collections.OrderedDict()
+_patternfiles_len = 256
+_scanners = collections.OrderedDict()
+_scanners_len = 32
+
+
+def _remember(cache, limit, key, value):
+    """Store value in an OrderedDict cache of at most limit entries."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+
 # exception classes
 class Error(Exception):
     def __init__(self, msg=''):
@@ -218,6 +254,155 @@ class _FilterFile:
         self.exception = ParsingError(filename)
 
 
+class _ContentScanner:
+    """
+    The expressions of all the body (or headers) rules of a filter,
+    compiled to be searched for together.  Used internally by
+    FilterParser.
+
+    Literal phrases are folded into a prefix tree, written as a regular
+    expression, and the other expressions are combined into the same
+    alternation.  A search finds some matching rule; the search is then
+    repeated with the expressions of the rules preceding it only, until
+    nothing earlier matches.  Expressions that can't be combined
+    (backreferences, named groups, global flags) are searched for one
+    by one.
+    """
+
+    metachars = re.compile(r'[.^$*+?{}\[\]\\|()]')
+    standalone = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)')
+
+    def __init__(self, patterns):
+        """
+        patterns is a list of (ruleno, case, expression) tuples, in rule
+        order.  An expression that doesn't compile is recorded in the
+        errors dictionary, keyed by rule number, and the expressions of
+        the rule following it are ignored, as the rule raises the error
+        when none of the preceding ones match.
+        """
+        self.errors = {}
+        self.members = []       # (ruleno, kind, expression)
+        self.singles = []       # (ruleno, compiled expression)
+        self.combined = {}
+        for (ruleno, case, expr) in patterns:
+            if ruleno in self.errors:
+                continue
+            if not self.metachars.search(expr):
+                expr = expr.encode()
+                if case:
+                    self.members.append((ruleno, 'literal', expr))
+                else:
+                    self.members.append((ruleno, 'iliteral', expr.lower()))
+                continue
+            flags = re.MULTILINE
+            if not case:
+                flags = flags | re.IGNORECASE
+            try:
+                regex = re.compile(expr.encode(), flags)
+            except re.error as e:
+                self.errors[ruleno] = e
+                continue
+            if self.standalone.search(expr):
+                self.singles.append((ruleno, regex))
+                continue
+            wrapped = (case and b'(?:%s)' or b'(?i:%s)') % expr.encode()
+            try:
+                re.compile(wrapped, re.MULTILINE)
+            except re.error:
+                self.singles.append((ruleno, regex))
+            else:
+                self.members.append((ruleno, regex.groups, wrapped))
+
+    def __compile(self, limit):
+        """Combine the expressions of the rules preceding limit."""
+        if limit in self.combined:
+            return self.combined[limit]
+        literals = {'literal': {}, 'iliteral': {}}
+        alternatives = []
+        groups = []
+        for (ruleno, kind, expr) in self.members:
+            if limit is not None and ruleno >= limit:
+                break
+            if kind in literals:
+                literals[kind].setdefault(expr, ruleno)
+            else:
+                alternatives.append(expr)
+                groups.append((ruleno, kind))
+        for (kind, wrapped) in (('iliteral', b'(?i:%s)'),
+                                ('literal', b'(?:%s)')):
+            if literals[kind]:
+                alternatives.insert(0, wrapped % _trie_regex(literals[kind]))
+                groups.insert(0, ((kind, literals[kind]), 0))
+        combined = None
+        if alternatives:
+            regex = re.compile(b'|'.join([ b'(' + alternative + b')'
+                                           for alternative in alternatives ]),
+                               re.MULTILINE)
+            # Map the number of each alternative's group to its rule.
+            rules = {}
+            groupno = 1
+            for (rule, inner) in groups:
+                rules[groupno] = rule
+                groupno += 1 + inner
+            combined = (regex, rules)
+        self.combined[limit] = combined
+        return combined
+
+    def firstmatch(self, content):
+        """Return the number of the first rule matching content, or None."""
+        best = None
+        while 1:
+            combined = self.__compile(best)
+            if not combined:
+                break
+            (regex, rules) = combined
+            mo = regex.search(content)
+            if not mo:
+                break
+            rule = rules[mo.lastindex]
+            if isinstance(rule, tuple):
+                # A literal phrase, mapped to its rule.
+                (kind, phrases) = rule
+                phrase = mo.group(mo.lastindex)
+                if kind == 'iliteral':
+                    phrase = phrase.lower()
+                rule = phrases[phrase]
+            best = rule
+        for (ruleno, regex) in self.singles:
+            if best is not None and ruleno >= best:
+                break
+            if regex.search(content):
+                best = ruleno
+                break
+        return best
+
+
+def _trie_regex(phrases):
+    """Return a regular expression matching any of the phrases (bytes)."""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for byte in phrase:
+            node = node.setdefault(byte, {})
+        node[None] = 1
+
+    def build(node):
+        end = None in node
+        alternatives = [ re.escape(bytes([byte])) + build(node[byte])
+                         for byte in sorted([ key for key in node
+                                              if key is not None ]) ]
+        if not alternatives:
+            return b''
+        if len(alternatives) == 1 and not end:
+            return alternatives[0]
+        regex = b'(?:' + b'|'.join(alternatives) + b')'
+        if end:
+            regex += b'?'
+        return regex
+
+    return build(trie)
+
+
 class FilterParser:
     bol_comment = re.compile(r'\s*#')
 
@@ -265,8 +450,8 @@ class FilterParser:
     arguments = {
         'from'         : None,
         'to'           : None,
-        'from-file'    : ('autocdb', 'autodbm', 'optional'),
-        'to-file'      : ('autocdb', 'autodbm', 'optional'),
+        'from-file'    : ('autocdb', 'autodbm', 'autoindex', 'optional'),
+        'to-file'      : ('autocdb', 'autodbm', 'autoindex', 'optional'),
         'from-cdb'     : ('optional',),
         'to-cdb'       : ('optional',),
         'from-dbm'     : ('optional',),
@@ -292,6 +477,10 @@ class FilterParser:
         self.macros = []
         self.files = []
         self.filterlist = []
+        self.depends = {}
+        self.variables = {}
+        self.cwd = None
+        self.dbm_handles = {}
 
 
     def __pushfile(self, file):
@@ -336,6 +525,18 @@ class FilterParser:
             exception.append(self.__file().lineno, errstr)
             raise exception
 
+        # Only a top-level filter read by a fresh parser can be cached;
+        # macros defined by an earlier filter would change its meaning.
+        toplevel = not self.files and not self.macros
+        if toplevel:
+            if self.__loadcache(filename):
+                return
+            self.depends = {}
+            self.variables = {}
+            self.cwd = None
+            first_rule = len(self.filterlist)
+
+        self.__depend(filename)
         try:
             fp = open(filename)
             self.__pushfile(_FilterFile(filename))
@@ -345,6 +546,130 @@ class FilterParser:
         except IOError:
             pass
 
+        if toplevel:
+            self.__savecache(filename, first_rule)
+
+
+    def __stamp(self, filename):
+        """Return a value identifying the current version of filename."""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+    def __depend(self, filename):
+        """Record that the filter being read depends on filename."""
+        filename = os.path.normpath(os.path.abspath(filename))
+        self.depends[filename] = self.__stamp(filename)
+
+
+    def __cachefile(self, filename):
+        """Return the pathname of the cache of filename, if caching is on."""
+        if not Defaults.CACHE_DIR:
+            return None
+        # Keyed on the absolute pathname, so a relative filename read
+        # from another directory has a cache of its own.
+        filename = os.path.normpath(os.path.abspath(filename))
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        return os.path.join(Defaults.CACHE_DIR, 'filters',
+                            os.path.basename(filename) + '.' + digest)
+
+
+    def __uptodate(self, cache):
+        """Return true if nothing the cached rules depend on has changed."""
+        if cache.get('version') != _cache_version:
+            return 0
+        if cache['cwd'] and cache['cwd'] != os.getcwd():
+            return 0
+        for (filename, stamp) in cache['depends'].items():
+            if self.__stamp(filename) != stamp:
+                return 0
+        for (var, sub) in cache['variables'].items():
+            try:
+                if self.__findvarsub(var) != sub:
+                    return 0
+            except Error:
+                return 0
+        return 1
+
+
+    def __loadcache(self, filename):
+        """
+        Load the rules of filename from the process or on-disk cache.
+        Return true if they were found and are still valid.
+        """
+        filename = os.path.normpath(os.path.abspath(filename))
+        candidates = [ _parsed.get(filename) ]
+        cachefile = self.__cachefile(filename)
+        if cachefile:
+            candidates.append(cachefile)
+        for data in candidates:
+            if data is None:
+                continue
+            if data is cachefile:
+                try:
+                    fp = open(cachefile, 'rb')
+                    data = fp.read()
+                    fp.close()
+                except IOError:
+                    continue
+            try:
+                cache = pickle.loads(data)
+                if not self.__uptodate(cache):
+                    continue
+            except Exception:
+                # An unreadable cache is simply rebuilt.
+                continue
+            _parsed[filename] = data
+            self.depends = cache['depends']
+            self.variables = cache['variables']
+            self.cwd = cache['cwd']
+            self.macros.extend(cache['macros'])
+            self.filterlist.extend(cache['filterlist'])
+            return 1
+        return 0
+
+
+    def __savecache(self, filename, first_rule):
+        """Store the rules just parsed from filename in the caches."""
+        filename = os.path.normpath(os.path.abspath(filename))
+        # The configuration files are checked too, in case they
+        # changed something the filter doesn't refer to explicitly.
+        for config in (Defaults.GLOBAL_TMDARC, Defaults.TMDARC):
+            if config:
+                self.__depend(config)
+        cache = { 'version'    : _cache_version,
+                  'depends'    : self.depends,
+                  'variables'  : self.variables,
+                  'cwd'        : self.cwd,
+                  'macros'     : self.macros,
+                  'filterlist' : self.filterlist[first_rule:] }
+        data = pickle.dumps(cache, 2)
+        if _parsed.get(filename) == data:
+            return
+        _parsed[filename] = data
+        cachefile = self.__cachefile(filename)
+        if cachefile:
+            tmpname = None
+            try:
+                cachedir = os.path.dirname(cachefile)
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir, 0o700)
+                (fd, tmpname) = tempfile.mkstemp(dir=cachedir)
+                fp = os.fdopen(fd, 'wb')
+                fp.write(data)
+                fp.close()
+                os.rename(tmpname, cachefile)
+            except (IOError, OSError):
+                # The cache is only an optimization.
+                if tmpname is not None:
+                    try:
+                        os.unlink(tmpname)
+                    except OSError:
+                        pass
+
 
     def __parse(self, fp):
         """
@@ -518,6 +843,7 @@ class FilterParser:
                 break
             var = mo.group(1)
             sub = self.__findvarsub(var)
+            self.variables[var] = sub
             rule_line = rule_line[:mo.start()] + sub + rule_line[mo.end():]
         return rule_line
 
@@ -538,10 +864,14 @@ class FilterParser:
             else:
                 filename = include_line
             filename = os.path.expanduser(filename)
+            if not os.path.isabs(filename):
+                self.cwd = os.getcwd()
             if os.path.exists(filename):
                 self.read(filename)
             elif not optional:
                 raise Error('"%s": file not found' % filename)
+            else:
+                self.__depend(filename)
             rule_line = None
         return rule_line
 
@@ -690,15 +1020,14 @@ class FilterParser:
 
     def __search_list(self, addrlist, keys, actions, source):
         """Search addrlist for match in field 1, optional action in 2."""
-        # This list comprehension splits each line in the list into
-        # two columns, lowercases the first column and stuffs the
-        # columns back together.  The result is the original list of
-        # lines from the file with the first field in each line
-        # lowercased.
-        addrlist = [' '.join(
-            (lambda f1, f2=None: f2 and [f1.lower(), f2]
-                                          or [f1.lower()])(*line.split(None, 1))) for line in addrlist]
-        found_match = Util.findmatch(addrlist, keys)
+        matcher = Util.WildcardMatcher([ _lowerfirst(line)
+                                         for line in addrlist ])
+        return self.__search_matcher(matcher, keys, actions, source)
+
+
+    def __search_matcher(self, matcher, keys, actions, source):
+        """Search a compiled list for match in field 1, optional action in 2."""
+        found_match = matcher.findmatch(keys)
         if found_match:
             # The second column of the line may contain an
             # overriding action specification.
@@ -714,10 +1043,28 @@ class FilterParser:
         """
         Search a text file for match in first column.
         """
-        return self.__search_list(Util.file_to_list(pathname),
-                                  keys,
-                                  actions,
-                                  source)
+        # The compiled list is kept for as long as the file doesn't
+        # change, for processes matching more than one message.
+        stamp = self.__stamp(pathname)
+        (cached_stamp, matcher) = _matchers.get(pathname, (None, None))
+        if stamp is None or stamp != cached_stamp:
+            matcher = Util.WildcardMatcher([ _lowerfirst(line) for line in
+                                             Util.file_to_list(pathname) ])
+            if stamp is not None:
+                _matchers[pathname] = (stamp, matcher)
+        return self.__search_matcher(matcher, keys, actions, source)
+
+
+    def __search_index(self, pathname, keys, actions, source):
+        """
+        Search an index file built from a text file by Util.build_index.
+        """
+        stamp = self.__stamp(pathname)
+        (cached_stamp, index) = _matchers.get(pathname, (None, None))
+        if stamp is None or stamp != cached_stamp:
+            index = Util.ListIndex(pathname)
+            _matchers[pathname] = (stamp, index)
+        return self.__search_matcher(index, keys, actions, source)
 
 
     def __search_cdb(self, pathname, keys, actions, source):
@@ -745,35 +1092,42 @@ class FilterParser:
         """
         Search a DBM-style database.
         """
-        import dbm
-        dbm_o = dbm.open(pathname, 'r')
-        dbm_keys = dbm_o.keys()
+        dbm_o = self.__opendbm(pathname)
         found_match = 0
         for key in keys:
             if not key:
                 continue
-            key = key.lower().encode()
-            if key in dbm_keys:
+            dbm_value = dbm_o.get(key.lower().encode())
+            if dbm_value is not None:
                 found_match = 1
-                try:
-                    dbm_value = dbm_o[key].decode()
-                except KeyError:
-                    dbm_value = None
+                dbm_value = dbm_value.decode()
                 # If there is an entry for this key,
                 # we consider it an overriding action
                 # specification.
                 if dbm_value:
                     actions.clear()
                     actions.update(self.__buildactions(dbm_value, source))
-                dbm_o.close()
                 break
         return found_match
 
 
+    def __opendbm(self, pathname):
+        """
+        Open a DBM-style database, or return the handle already opened
+        for it by this firstmatch call.
+        """
+        import dbm
+        dbm_o = self.dbm_handles.get(pathname)
+        if dbm_o is None:
+            dbm_o = dbm.open(pathname, 'r')
+            self.dbm_handles[pathname] = dbm_o
+        return dbm_o
+
+
     def __autobuild_db(self, basename, extension,
                        surrogate, build_func, search_func, optional):
         """
-        Automatically build a CDB/DBM database if it's out-of-date.
+        Automatically build a CDB/DBM database or index if it's out-of-date.
         """
         dbname = basename + extension
         try:
@@ -882,16 +1236,78 @@ class FilterParser:
         return found_match
 
 
+    def __patternfile(self, pathname):
+        """Return the expressions of a body-file or headers-file list."""
+        stamp = self.__stamp(pathname)
+        cached = _patternfiles.get(pathname)
+        if stamp and cached and cached[0] == stamp:
+            _patternfiles.move_to_end(pathname)
+            return cached[1]
+        exprs = []
+        for line in Util.file_to_list(pathname):
+            mo = self.matches.match(line)
+            if mo:
+                exprs.append(mo.group(2) or mo.group(3))
+        if stamp:
+            _remember(_patternfiles, _patternfiles_len, pathname,
+                      (stamp, exprs))
+        return exprs
+
+
+    def __scanner(self, kind):
+        """
+        Return the scanner of the 'body' or 'headers' rules, and the
+        errors of the lists which couldn't be read keyed by rule number.
+        """
+        patterns = []
+        missing = {}
+        for (ruleno, rule) in enumerate(self.filterlist):
+            (source, args, match, actions, lineno) = rule
+            source = source.lower()
+            case = 'case' in args
+            if source == kind:
+                patterns.append((ruleno, case, match))
+            elif source == kind + '-file':
+                try:
+                    for expr in self.__patternfile(os.path.expanduser(match)):
+                        patterns.append((ruleno, case, expr))
+                except IOError as e:
+                    if 'optional' not in args:
+                        missing[ruleno] = e
+        key = tuple(patterns)
+        scanner = _scanners.get(key)
+        if scanner is None:
+            scanner = _ContentScanner(patterns)
+        _remember(_scanners, _scanners_len, key, scanner)
+        return (scanner, missing)
+
+
     def firstmatch(self, recipient, senders=None,
                    msg_body=None, msg_headers=None, msg_size=None):
         """Iterate over each rule in the list looking for a match.  As
         soon as a match is found exit, returning the corresponding
         action dictionary and matching line.
-        Message body and headers must be passed as bytes strings.
+        Message body and headers must be passed as bytes strings, or
+        as memoryview objects over them.
         """
+        # Databases are opened once, however many rules refer to them.
+        try:
+            return self.__firstmatch(recipient, senders,
+                                     msg_body, msg_headers, msg_size)
+        finally:
+            for dbm_o in self.dbm_handles.values():
+                dbm_o.close()
+            self.dbm_handles.clear()
+
+
+    def __firstmatch(self, recipient, senders,
+                     msg_body, msg_headers, msg_size):
         line = None
         found_match = None
-        for (source, args, match, actions, lineno) in self.filterlist:
+        scanners = {}
+        firsts = {}
+        for (ruleno, rule) in enumerate(self.filterlist):
+            (source, args, match, actions, lineno) = rule
             source = source.lower()
             # set up the keys for searching
             if source.startswith('from') and senders:
@@ -905,7 +1321,7 @@ class FilterParser:
                 found_match = Util.findmatch([match.lower()], keys)
                 if found_match:
                     break
-            # 'from-file' or 'to-file', including autocdb functionality
+            # 'from-file' or 'to-file', including autocdb/autodbm/autoindex
             if source in ('from-file', 'to-file'):
                 dbname = os.path.expanduser(match)
                 search_func = self.__search_file
@@ -922,6 +1338,10 @@ class FilterParser:
                     (dbname, search_func) = self.__autobuild_db(
                         dbname, '.dbm', dbname + '.dbm.last_built',
                         Util.build_dbm, self.__search_dbm, optional)
+                elif 'autoindex' in args:
+                    (dbname, search_func) = self.__autobuild_db(
+                        dbname, '.idx', dbname + '.idx',
+                        Util.build_index, self.__search_index, optional)
                 else:
                     if not os.path.exists(dbname) and optional:
                         search_func = None
@@ -1058,8 +1478,9 @@ class FilterParser:
             # A match is found if the command exits with a zero exit
             # status.
             if source == 'pipe' and msg_body and msg_headers:
-                (r, out, err) = Util.runcmd((match,), msg_headers + b'\n' +
-                                            msg_body)
+                (r, out, err) = Util.runcmd((match,),
+                                            b'\n'.join((msg_headers,
+                                                         msg_body)))
                 if r == 0:
                     found_match = 1
                     break
@@ -1068,45 +1489,29 @@ class FilterParser:
                 elif r < 0:
                     raise Error('command "%s" abnormal exit signal %s (%s)' %
                                 (match, -r, err.strip()))
-            if source in ('body', 'headers'):
-                if source == 'body' and msg_body:
+            # All the body (or headers) rules are searched for at once,
+            # the first time one of them is reached.
+            if source in ('body', 'headers', 'body-file', 'headers-file'):
+                kind = source.split('-')[0]
+                if source.endswith('-file'):
+                    match = os.path.expanduser(match)
+                if kind not in scanners:
+                    scanners[kind] = self.__scanner(kind)
+                (scanner, missing) = scanners[kind]
+                if ruleno in missing:
+                    raise missing[ruleno]
+                if kind == 'body':
                     content = msg_body
-                elif source == 'headers' and msg_headers:
-                    content = msg_headers
-                else:
-                    content = None
-                re_flags = re.MULTILINE
-                if 'case' not in args:
-                    re_flags = re_flags | re.IGNORECASE
-                if content and re.search(match.encode(),content,re_flags):
-                    found_match = 1
-                    break
-            if source in ('body-file','headers-file'):
-                match = os.path.expanduser(match)
-                try:
-                    match_list = Util.file_to_list(match)
-                except IOError:
-                    if 'optional' not in args:
-                        raise
                 else:
-                    if source == 'body-file' and msg_body:
-                        content = msg_body
-                    elif source == 'headers-file' and msg_headers:
-                        content = msg_headers
-                    else:
-                        content = None
-                    re_flags = re.MULTILINE
-                    if 'case' not in args:
-                        re_flags = re_flags | re.IGNORECASE
-                    for line in match_list:
-                        mo = self.matches.match(line)
-                        if mo:
-                            expr = mo.group(2) or mo.group(3)
-                            if content and re.search(expr.encode(),content,re_flags):
-                                found_match = 1
-                                break
-                if found_match:
-                    break
+                    content = msg_headers
+                if content:
+                    if kind not in firsts:
+                        firsts[kind] = scanner.firstmatch(content)
+                    if firsts[kind] == ruleno:
+                        found_match = 1
+                        break
+                    if ruleno in scanner.errors:
+                        raise scanner.errors[ruleno]
             if source == 'size' and msg_size:
                 match_list = list(match)
                 operator = match_list[0] # first character should be < or >
@@ -1125,6 +1530,15 @@ class FilterParser:
         return actions, line
 
 
+def _lowerfirst(line):
+    """
+    Lowercase the first column of a list line, leaving the rest alone.
+    """
+    fields = line.split(None, 1)
+    fields[0] = fields[0].lower()
+    return ' '.join(fields)
+
+
 def _rulestr(source, args, match, actions):
     """
     Build string from source, args, match and actions.
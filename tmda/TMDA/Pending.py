@@ -26,9 +26,13 @@
 
 
 from email.utils import parseaddr
+import collections
+import concurrent.futures
 import email
 import os
+import re
 import sys
+import tempfile
 import time
 
 from . import Defaults
@@ -42,6 +46,185 @@ Q = Queue()
 Q = Q.init()
 
 
+class MessageCache:
+    """
+    The ids of the messages already seen by tmda-pending -C: an
+    ordered set, iterated from the most recently added id.
+
+    It is kept in PENDING_CACHE as a journal, one line per id added
+    ("+msgid") or removed ("-msgid"), which save() appends to.  Once
+    the journal is twice as long as needed, it is rewritten with the
+    PENDING_CACHE_LEN most recent ids.  A cache pickled by earlier
+    versions is read and rewritten as a journal.
+    """
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self.ids = collections.OrderedDict()
+        self.journal = []
+        self.lines = 0
+        self.rewrite = False
+        self.load()
+
+    def load(self):
+        try:
+            fp = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+        with fp:
+            data = fp.read()
+        if data[:1] not in (b'', b'+', b'-'):
+            # A pickled list, most recent first.
+            for msgid in reversed(Util.unpickle(self.filename)):
+                self.ids[msgid] = None
+            self.rewrite = True
+        else:
+            for line in data.decode().splitlines():
+                self.lines += 1
+                (op, msgid) = (line[:1], line[1:])
+                if op == '+':
+                    self.ids[msgid] = None
+                    self.ids.move_to_end(msgid)
+                elif op == '-':
+                    self.ids.pop(msgid, None)
+        self.trim()
+
+    def trim(self):
+        """Drop the oldest ids beyond size."""
+        while len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+    def __contains__(self, msgid):
+        return msgid in self.ids
+
+    def __iter__(self):
+        return reversed(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, msgid):
+        self.ids[msgid] = None
+        self.ids.move_to_end(msgid)
+        self.journal.append('+' + msgid)
+
+    def remove(self, msgid):
+        del self.ids[msgid]
+        self.journal.append('-' + msgid)
+
+    def save(self):
+        """Append the changes to PENDING_CACHE, or rewrite it."""
+        if not self.journal and not self.rewrite:
+            return
+        self.trim()
+        if self.rewrite or self.lines + len(self.journal) > 2 * self.size:
+            # Rewrite the journal with the ids kept.
+            lines = [ '+' + msgid for msgid in self.ids ]
+            (fd, tmpname) = tempfile.mkstemp(
+                dir=os.path.dirname(self.filename))
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(''.join([ line + '\n' for line in lines ]))
+            os.rename(tmpname, self.filename)
+            self.lines = len(lines)
+        else:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o600)
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(''.join([ line + '\n' for line in self.journal ]))
+            self.lines += len(self.journal)
+        self.journal = []
+        self.rewrite = False
+
+
+class Query:
+    """
+    The conditions pending messages are selected by, evaluated against
+    the metadata of the queue (see Queue.fetch_metadata() in
+    TMDA.Queue.Queue) rather than by reading each message.
+
+    sender is a regular expression searched for in the envelope sender
+    and From: addresses, domain the domain (or parent domain) of one of
+    them, recipient a regular expression searched for in the
+    X-TMDA-Recipient, and subject one searched for in the decoded
+    Subject:, all case-insensitive.  larger and smaller bound the size
+    of the message in bytes, younger and older its age as a time
+    interval (e.g, "5d").
+    """
+    def __init__(self, sender=None, domain=None, recipient=None,
+                 subject=None, larger=None, smaller=None,
+                 younger=None, older=None):
+        self.sender = sender and re.compile(sender, re.I)
+        self.domain = domain and domain.lower().strip('.')
+        self.recipient = recipient and re.compile(recipient, re.I)
+        self.subject = subject and re.compile(subject, re.I)
+        self.larger = larger
+        self.smaller = smaller
+        now = int(time.time())
+        self.after = younger and now - Util.seconds(younger)
+        self.before = older and now - Util.seconds(older)
+
+    def __bool__(self):
+        return (self.__headers() or self.larger is not None or
+                self.smaller is not None or bool(self.after or self.before))
+
+    def __headers(self):
+        return bool(self.sender or self.domain or self.recipient or
+                    self.subject)
+
+    def __addresses(self, record):
+        addresses = []
+        if record['return_path']:
+            addresses.append(Util.unmangle_sender(
+                parseaddr(record['return_path'])[1]))
+        if record['from']:
+            addresses.append(parseaddr(record['from'])[1])
+        return [ address for address in addresses if address ]
+
+    def match(self, record):
+        """Return true if the metadata of a message match the query."""
+        msg_time = int(record['mailid'].split('.')[0])
+        if self.after and msg_time < self.after:
+            return False
+        if self.before and msg_time > self.before:
+            return False
+        if self.larger is not None and record['size'] <= self.larger:
+            return False
+        if self.smaller is not None and record['size'] >= self.smaller:
+            return False
+        if self.sender or self.domain:
+            addresses = self.__addresses(record)
+            if self.sender and not [ address for address in addresses
+                                     if self.sender.search(address) ]:
+                return False
+            if self.domain:
+                domains = [ address.rpartition('@')[2].lower()
+                            for address in addresses ]
+                if not [ domain for domain in domains
+                         if domain == self.domain or
+                         domain.endswith('.' + self.domain) ]:
+                    return False
+        if self.recipient and not (record['recipient'] and
+                                   self.recipient.search(record['recipient'])):
+            return False
+        if self.subject and not (record['subject'] and
+                                 self.subject.search(
+                                     Util.decode_header(record['subject']))):
+            return False
+        return True
+
+    def select(self, msgids):
+        """Return the message identifiers matching the query."""
+        if self.__headers() or self.larger is not None or \
+               self.smaller is not None:
+            records = Q.fetch_metadata()
+        else:
+            # the age is given by the identifier
+            records = [ {'mailid': msgid} for msgid in msgids ]
+        wanted = set(msgids)
+        return [ record['mailid'] for record in records
+                 if record['mailid'] in wanted and self.match(record) ]
+
+
 class Queue:
     """A simple pending queue."""
 
@@ -57,7 +240,8 @@ class Queue:
                   threshold = None,
                   verbose = 1,
                   younger = None,
-                  pretend = None ):
+                  pretend = None,
+                  query = None ):
 
         self.msgs = msgs
         self.cache = cache
@@ -71,6 +255,7 @@ class Queue:
         self.verbose = verbose
         self.younger = younger
         self.pretend = pretend
+        self.query = query
 
         self.stdout = sys.stdout
 
@@ -98,6 +283,9 @@ class Queue:
         if not self.msgs and not wantedstdin:
             self.msgs = Q.fetch_ids()
 
+        if self.query:
+            self.msgs = self.query.select(self.msgs)
+
         self.msgs.sort()
         if self.descending:
             self.msgs.reverse()
@@ -132,10 +320,8 @@ class Queue:
     def _loadCache(self):
         """Load the message cache from disk."""
         if self.cache:
-            if os.path.exists(Defaults.PENDING_CACHE):
-                self.msgcache = Util.unpickle(Defaults.PENDING_CACHE)
-            else:
-                self.msgcache = []
+            self.msgcache = MessageCache(Defaults.PENDING_CACHE,
+                                         Defaults.PENDING_CACHE_LEN)
 
     def _addCache(self, msgid):
         """Add a message to the cache."""
@@ -143,7 +329,7 @@ class Queue:
             if msgid in self.msgcache:
                 return 0
             else:
-                self.msgcache.insert(0, msgid)
+                self.msgcache.add(msgid)
         return 1
 
     def _delCache(self, msgid):
@@ -156,40 +342,86 @@ class Queue:
     def _saveCache(self):
         """Save the cache on disk."""
         if self.cache:
-            # Trim tail entries off if necessary, and then save the
-            # cache in ASCII format.
-            self.msgcache = self.msgcache[:Defaults.PENDING_CACHE_LEN]
-            Util.pickleit(self.msgcache, Defaults.PENDING_CACHE, 0)
+            self.msgcache.save()
 
     ## Threshold (-Y and -O options)
     def checkTreshold(self, msgid):
-        """Check the threshold against the message date."""
+        """Check the threshold against the message date.
+
+        younger and older are either flags applying the threshold, or
+        time intervals of their own, e.g. to select a time range."""
         if self.threshold:
-            threshold_secs = Util.seconds(self.threshold)
-            now = '%d' % time.time()
-            min_time = int(now) - int(threshold_secs)
             msg_time = int(msgid.split('.')[0])
-            if (self.younger and msg_time < min_time) or \
-               (self.older and msg_time > min_time):
+            if (self.younger and msg_time < self._minTime(self.younger)) or \
+               (self.older and msg_time > self._minTime(self.older)):
                 # skip this message
                 return 0
         return 1
 
+    def _minTime(self, bound):
+        """Return the time the younger or older bound is at."""
+        if not isinstance(bound, str):
+            bound = self.threshold
+        return int(time.time()) - int(Util.seconds(bound))
+
+    ## Release related functions
+    def _openServer(self):
+        """Set up the connection(s) released messages are sent over."""
+        self.server = None
+        self.sending = []
+        self.failures = []
+        if Defaults.MAIL_TRANSPORT == 'smtp' and not self.pretend:
+            from . import SMTP
+            if Defaults.PENDING_RELEASE_CONNECTIONS > 1:
+                self.server = SMTP.ConnectionPool(
+                    Defaults.PENDING_RELEASE_CONNECTIONS)
+            else:
+                self.server = SMTP.Connection()
+
+    def _closeServer(self):
+        """Wait for the released messages to be sent."""
+        for (msgid, dispose, future) in self.sending:
+            try:
+                future.result()
+            except Exception as obj:
+                self._disposeFailed(msgid, dispose, obj)
+        self.sending = []
+        if self.server is not None:
+            self.server.quit()
+
+    def _sending(self, M, result):
+        """Keep track of a message being sent over a ConnectionPool."""
+        if isinstance(result, concurrent.futures.Future):
+            self.sending.append((M.msgid, self.dispose, result))
+
+    def _disposeFailed(self, msgid, dispose, obj):
+        """Report a message which couldn't be disposed of, and go on."""
+        self.failures.append(msgid)
+        sys.stderr.write('%s %s failed: %s\n' % (dispose, msgid, obj))
+        if self.cache and msgid in self.msgcache:
+            self._delCache(msgid)
+
     def disposeMessage(self, M):
         """Dispose the message."""
         if self.dispose is None or self.dispose == 'pass':
             return 0
         if not self.pretend:
-            if self.dispose == 'release':
-                M.release()
-            elif self.dispose == 'delete':
-                M.delete()
-            elif self.dispose == 'whitelist':
-                M.whitelist()
-            elif self.dispose == 'blacklist':
-                M.blacklist()
-            elif self.dispose == 'show':
-                self.Print(M.pager())
+            try:
+                if self.dispose == 'release':
+                    self._sending(M, M.release(self.server))
+                elif self.dispose == 'delete':
+                    M.delete()
+                elif self.dispose == 'whitelist':
+                    self._sending(M, M.whitelist(self.server))
+                elif self.dispose == 'blacklist':
+                    M.blacklist()
+                elif self.dispose == 'show':
+                    self.Print(M.pager())
+            except Errors.ConfigError:
+                raise
+            except Exception as obj:
+                self._disposeFailed(M.msgid, self.dispose, obj)
+                return 0
         return 1
 
     def processMessage(self, M):
@@ -218,39 +450,43 @@ class Queue:
         self.count = 0
 
         self._loadCache()
+        self._openServer()
 
-        for msgid in self.msgs:
-            self.count = self.count + 1
-            try:
-                M = Message(msgid, self.command_recipient)
-            except Errors.MessageError as obj:
-                self.cPrint(obj)
-                continue
-
-            if not self.checkTreshold(M.msgid):
-                continue
-            if not self._addCache(M.msgid):
-                continue
-
-            # Pass over the message if it lacks X-TMDA-Recipient and we
-            # aren't using `-R'.
-            if not M.getConfirmAddress():
-                self.cPrint("can't determine recipient address, skipping", M.msgid)
-                continue
-
-            if not self.processMessage(M):
-                break
-
-            # Optionally dispose of the message
-            message = '%s %s' % (self.dispose, M.msgid)
-            if self.pretend:
-                message = message + ' (not)'
-            if self.dispose:
-                self.cPrint('\n', message)
-            if not self.disposeMessage(M):
-                continue
-
-            self.endProcessMessage(M)
+        try:
+            for msgid in self.msgs:
+                self.count = self.count + 1
+                try:
+                    M = Message(msgid, self.command_recipient)
+                except Errors.MessageError as obj:
+                    self.cPrint(obj)
+                    continue
+
+                if not self.checkTreshold(M.msgid):
+                    continue
+                if not self._addCache(M.msgid):
+                    continue
+
+                # Pass over the message if it lacks X-TMDA-Recipient and we
+                # aren't using `-R'.
+                if not M.getConfirmAddress():
+                    self.cPrint("can't determine recipient address, skipping", M.msgid)
+                    continue
+
+                if not self.processMessage(M):
+                    break
+
+                # Optionally dispose of the message
+                message = '%s %s' % (self.dispose, M.msgid)
+                if self.pretend:
+                    message = message + ' (not)'
+                if self.dispose:
+                    self.cPrint('\n', message)
+                if not self.disposeMessage(M):
+                    continue
+
+                self.endProcessMessage(M)
+        finally:
+            self._closeServer()
 
         self._saveCache()
 
@@ -268,7 +504,8 @@ class InteractiveQueue(Queue):
                   threshold = None,
                   verbose = 1,
                   younger = None,
-                  pretend = None ):
+                  pretend = None,
+                  query = None ):
 
         Queue.__init__(self,
                        msgs,
@@ -282,7 +519,8 @@ class InteractiveQueue(Queue):
                        threshold,
                        verbose,
                        younger,
-                       pretend)
+                       pretend,
+                       query)
 
 
     def initQueue(self):
@@ -355,7 +593,11 @@ class InteractiveQueue(Queue):
 
 
 class Message:
-    """A simple pending message class"""
+    """A simple pending message class
+
+    Only the headers of the message are read at first; msgobj, the
+    whole message, is fetched from the queue when it is needed (e.g,
+    to release or show the message)."""
     msg_size = 0
     str_bytes = 'bytes'
     confirm_accept_address = None
@@ -363,17 +605,32 @@ class Message:
         self.msgid = msgid
         if not Q.find_message(self.msgid):
             raise Errors.MessageError('%s not found!' % self.msgid)
-        self.msgobj = Q.fetch_message(self.msgid)
+        self.headers = Q.fetch_headers(self.msgid)
+        self.__msgobj = None
         self.recipient = recipient
         if self.recipient is None:
-            self.recipient = self.msgobj.get('x-tmda-recipient')
-        self.return_path = parseaddr(self.msgobj.get('return-path'))[1]
-        self.x_primary_address = parseaddr(self.msgobj.get('x-primary-address'))[1]
+            self.recipient = self.headers.get('x-tmda-recipient')
+        self.return_path = parseaddr(self.headers.get('return-path'))[1]
+        self.x_primary_address = parseaddr(self.headers.get('x-primary-address'))[1]
         self.append_address = Util.confirm_append_address(
             self.x_primary_address, Util.unmangle_sender(self.return_path))
 
-    def release(self):
-        """Release a message from the pending queue."""
+    @property
+    def msgobj(self):
+        if self.__msgobj is None:
+            self.__msgobj = Q.fetch_message(self.msgid)
+            self.headers = self.__msgobj
+        return self.__msgobj
+
+    @msgobj.setter
+    def msgobj(self, msgobj):
+        self.__msgobj = self.headers = msgobj
+
+    def release(self, server=None):
+        """Release a message from the pending queue.
+
+        server is passed on to Util.sendmail(), whose return value is
+        returned."""
         from . import Cookie
         if Defaults.PENDING_RELEASE_APPEND:
             Util.append_to_file(self.append_address,
@@ -413,7 +670,8 @@ class Message:
             del self.msgobj['X-TMDA-CGI']
             self.msgobj['X-TMDA-CGI'] = cgi_header
         # Reinject the message to the original envelope recipient.
-        Util.sendmail(self.show(), self.recipient, self.return_path)
+        return Util.sendmail(self.show(), self.recipient, self.return_path,
+                             server)
 
     def delete(self):
         """Delete a message from the pending queue."""
@@ -432,8 +690,8 @@ class Message:
                            params)
         Q.delete_message(self.msgid)
 
-    def whitelist(self):
-        """Whitelist the message sender."""
+    def whitelist(self, server=None):
+        """Whitelist the message sender (see release() for server)."""
         if (Defaults.PENDING_WHITELIST_APPEND or
             (Defaults.DB_PENDING_WHITELIST_APPEND and Defaults.DB_CONNECTION)):
             if Defaults.PENDING_WHITELIST_APPEND:
@@ -450,7 +708,7 @@ class Message:
                                Defaults.DB_PENDING_WHITELIST_APPEND,
                                params)
             if Defaults.PENDING_WHITELIST_RELEASE == 1:
-                self.release()
+                return self.release(server)
         else:
             raise Errors.ConfigError(
                 'PENDING_WHITELIST_APPEND (or DB_CONNECTION+'
@@ -496,14 +754,14 @@ class Message:
         for hdr in Defaults.TERSE_SUMMARY_HEADERS:
             if hdr in ('from_name', 'from_address'):
                 from_name, from_address = parseaddr(
-                    self.msgobj.get('from'))
+                    self.headers.get('from'))
                 if hdr == 'from_name':
                     terse_hdrs.append(from_name
                                       or from_address or 'None')
                 elif hdr == 'from_address':
                     terse_hdrs.append(from_address or 'None')
             else:
-                terse_hdrs.append(self.msgobj.get(hdr))
+                terse_hdrs.append(self.headers.get(hdr))
 
         if date:
             terse_hdrs.insert(0,self.getDate())
@@ -533,7 +791,7 @@ class Message:
     def summary(self, count = 0, total = 0, mailto = 0):
         """Return summary header information."""
         if not self.msg_size:
-            self.msg_size = len(self.show())
+            self.msg_size = Q.message_size(self.msgid)
             if  self.msg_size == 1:
                 self.str_bytes =    self.str_bytes[:-1]
         str_v = self.msgid + " ("
@@ -544,7 +802,7 @@ class Message:
         for hdr in Defaults.SUMMARY_HEADERS:
             str_v += "%s %s: %s\n" % ('  >>',
                                  hdr.capitalize()[:4].rjust(4),
-                                 Util.decode_header(self.msgobj.get(hdr)))
+                                 Util.decode_header(self.headers.get(hdr)))
 
         if mailto and self.getConfirmAddress():
             str_v += '<mailto:%s>' % self.confirm_accept_address
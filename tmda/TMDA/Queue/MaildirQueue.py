@@ -26,7 +26,6 @@ http://en.wikipedia.org/wiki/Maildir
 """
 
 
-from email.utils import parseaddr
 from glob import glob
 
 
@@ -78,52 +77,71 @@ class MaildirQueue(Queue):
             os.makedirs(os.path.join(dirpath, 'cur'), 0o700)
             os.mkdir(os.path.join(dirpath, 'new'), 0o700)
             os.mkdir(os.path.join(dirpath, 'tmp'), 0o700)
+            os.mkdir(os.path.join(dirpath, 'tmda-index'), 0o700)
 
 
     def _convert(self):
         pass
 
 
-    def cleanup(self):
-        if not self.exists():
-            return
-
-        lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
-        cwd = os.getcwd()
-        os.chdir(os.path.join(Defaults.PENDING_DIR, 'new'))
-        new_msgs = glob('1*.[0-9]*.*')
-        os.chdir(os.path.join(Defaults.PENDING_DIR, 'cur'))
-        cur_msgs = glob('1*.[0-9]*.*')
-        os.chdir(cwd)
-        msgs = new_msgs + cur_msgs
-
-        for msg in msgs:
-            now = '%d' % time.time()
-            min_time = int(now) - int(lifetimesecs)
-            msg_time = int(msg.split('.')[0])
-            if msg_time > min_time:
-                # skip this message
-                continue
+    def _expire(self, after, until, limit):
+        expired = []
+        kept = []
+        for subdir in ('new', 'cur'):
+            cwd = os.getcwd()
+            os.chdir(os.path.join(Defaults.PENDING_DIR, subdir))
+            msgs = glob('1*.[0-9]*.*')
+            os.chdir(cwd)
+            for msg in msgs:
+                msg_time = int(msg.split('.')[0])
+                if msg_time > until:
+                    # skip this message
+                    kept.append(msg_time)
+                    continue
+                if after is not None and msg_time <= after:
+                    # skip this message, behind the cursor
+                    continue
+                expired.append((msg_time, subdir, msg))
+        expired.sort()
+        if limit is not None:
+            kept.extend([ msg_time for (msg_time, subdir, msg)
+                          in expired[limit:] ])
+            expired = expired[:limit]
+        records = {}
+        if Defaults.PENDING_DELETE_APPEND:
+            records = self._read_metadata()
+
+        for (msg_time, subdir, msg) in expired:
             # delete this message
-            for f in (os.path.join(Defaults.PENDING_DIR, 'new', msg),
-                      os.path.join(Defaults.PENDING_DIR, 'cur', msg)):
-                if os.path.exists(f):
-                    fpath = f
-                    break
+            fpath = os.path.join(Defaults.PENDING_DIR, subdir, msg)
+            mailid = '.'.join(msg.split('.')[:2])
             if Defaults.PENDING_DELETE_APPEND:
-                try:
-                    msgobj = Util.msg_from_binfile(open(fpath, 'rb'))
-                except IOError:
-                    # in case of concurrent cleanups
-                    pass
-                else:
-                    rp = Util.unmangle_sender(parseaddr(msgobj.get('return-path'))[1])
+                rp = self._metadata_return_path(records, mailid, fpath)
+                # None in case of concurrent cleanups
+                if rp is not None:
                     Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
             try:
                 os.unlink(fpath)
             except OSError:
                 # in case of concurrent cleanups
                 pass
+            self.__unindex(mailid)
+
+        if limit is None or len(expired) < limit:
+            # Drop the index entries of the messages removed otherwise.
+            try:
+                links = os.listdir(self.__index_dir())
+            except OSError:
+                links = []
+            for link in links:
+                try:
+                    if int(link.split('.')[0]) <= until:
+                        os.unlink(os.path.join(self.__index_dir(), link))
+                except (ValueError, OSError):
+                    pass
+
+        return ([ msg_time for (msg_time, subdir, msg) in expired ],
+                min(kept, default=int(time.time())))
 
 
     def fetch_ids(self):
@@ -146,56 +164,127 @@ class MaildirQueue(Queue):
         msg['X-TMDA-Recipient'] = recipient
         # Write message
         time, pid = mailid.split('.')
-        self.__deliver_maildir(Util.msg_as_bytes(msg), time, pid,
-                               Defaults.PENDING_DIR)
+        message = Util.msg_as_bytes(msg)
+        filename = self.__deliver_maildir(message, time, pid,
+                                          Defaults.PENDING_DIR)
+        self.__index(mailid, 'new', filename)
         del msg['X-TMDA-Recipient']
+        self._append_metadata(self._make_metadata(msg, mailid, recipient,
+                                                  len(message)))
 
 
     def fetch_message(self, mailid):
-        msgs = (glob(os.path.join(Defaults.PENDING_DIR, 'new/')
-                     + '1*.[0-9]*.*')) + \
-                     (glob(os.path.join(Defaults.PENDING_DIR, 'cur/')
-                           + '1*.[0-9]*.*'))
-        for m in msgs:
-            if mailid in m:
-                msg = Util.msg_from_binfile(open(m, 'rb'))
-                return msg
-        else:
+        fpath = self.__locate(mailid)
+        if fpath is None:
             # couldn't find message, defer and retry until we find it
-            raise IOError("couldn't locate %s, will retry" % m)
+            raise IOError("couldn't locate %s, will retry" % mailid)
+        msg = Util.msg_from_binfile(open(fpath, 'rb'))
+        return msg
+
+
+    def fetch_headers(self, mailid):
+        fpath = self.__locate(mailid)
+        if fpath is None:
+            raise IOError("couldn't locate %s, will retry" % mailid)
+        with open(fpath, 'rb') as fp:
+            return Util.headers_from_binfile(fp)
+
+
+    def message_size(self, mailid):
+        fpath = self.__locate(mailid)
+        if fpath is None:
+            raise IOError("couldn't locate %s, will retry" % mailid)
+        return os.stat(fpath).st_size
 
 
     def delete_message(self, mailid):
-        msgs = (glob(os.path.join(Defaults.PENDING_DIR, 'new/')
-                     + '1*.[0-9]*.*')) + \
-                     (glob(os.path.join(Defaults.PENDING_DIR, 'cur/')
-                           + '1*.[0-9]*.*'))
-        for m in msgs:
-            if mailid in m:
-                os.unlink(m)
+        fpath = self.__locate(mailid)
+        if fpath is not None:
+            os.unlink(fpath)
+        self.__unindex(mailid)
 
 
     def find_message(self, mailid):
-        cwd = os.getcwd()
-        os.chdir(Defaults.PENDING_DIR)
-        msgs = glob('new/1*.[0-9]*.*') + glob('cur/1*.[0-9]*.*')
-
         for i in range(5):
-            for m in msgs:
-                if mailid in m:
-                    os.chdir(cwd)
-                    return True
-            else:
-                # retry 5 times in case a MUA moved/renamed the
-                # message to cur/ in a non-atomic way.
-                time.sleep(0.1)
-                msgs = glob('new/1*.[0-9]*.*') + glob('cur/1*.[0-9]*.*')
-                continue
+            if self.__locate(mailid) is not None:
+                return True
+            # retry 5 times in case a MUA moved/renamed the
+            # message to cur/ in a non-atomic way.
+            time.sleep(0.1)
         # give up; message is not there
-        os.chdir(cwd)
         return False
 
 
+    # The index is a directory of symbolic links, one per message,
+    # named after the mailid and pointing to the message file
+    # (e.g, tmda-index/1014754642.51195 ->
+    # ../new/1014754642.51195.aguirre.la.mastaler.com).  Links are
+    # created and replaced atomically, so it needs no locking; it is
+    # only a hint, repaired when a MUA has renamed a message.
+
+    def __index_dir(self):
+        return os.path.join(Defaults.PENDING_DIR, 'tmda-index')
+
+
+    def __index(self, mailid, subdir, filename):
+        """Point the index entry of mailid to subdir/filename."""
+        link = os.path.join(self.__index_dir(), mailid)
+        tmplink = '%s.%s.tmp' % (link, os.getpid())
+        try:
+            if not os.path.isdir(self.__index_dir()):
+                os.makedirs(self.__index_dir(), 0o700, exist_ok=True)
+            os.symlink(os.path.join('..', subdir, filename), tmplink)
+            os.rename(tmplink, link)
+        except OSError:
+            pass
+
+
+    def __unindex(self, mailid):
+        """Remove the index entry of mailid."""
+        try:
+            os.unlink(os.path.join(self.__index_dir(), mailid))
+        except OSError:
+            pass
+
+
+    def __locate(self, mailid):
+        """Return the pathname of the message file of mailid, or None."""
+        filename = None
+        try:
+            target = os.readlink(os.path.join(self.__index_dir(), mailid))
+        except OSError:
+            pass
+        else:
+            fpath = os.path.join(Defaults.PENDING_DIR,
+                                 os.path.relpath(target, '..'))
+            if os.path.exists(fpath):
+                return fpath
+            filename = os.path.basename(target).split(':')[0]
+        if filename:
+            # Moved to cur/ by a MUA, most likely without flags yet.
+            for name in (filename + ':2,', filename):
+                fpath = os.path.join(Defaults.PENDING_DIR, 'cur', name)
+                if os.path.exists(fpath):
+                    self.__index(mailid, 'cur', name)
+                    return fpath
+        # Not indexed (e.g, queued before the index existed) or renamed
+        # with flags: look for the files named after the mailid.
+        prefix = mailid + '.'
+        for subdir in ('new', 'cur'):
+            try:
+                names = os.listdir(os.path.join(Defaults.PENDING_DIR, subdir))
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith(prefix):
+                    self.__index(mailid, subdir, name)
+                    return os.path.join(Defaults.PENDING_DIR, subdir, name)
+        if filename:
+            # A stale entry; the message is gone.
+            self.__unindex(mailid)
+        return None
+
+
     def __deliver_maildir(self, message, time, pid, maildir):
         """Reliably deliver a mail message into a Maildir.
 
@@ -208,6 +297,8 @@ class MaildirQueue(Queue):
 
         maildir is the destination Maildir.
 
+        Return the name of the message file.
+
         Based on code from getmail
         Copyright (C) 2001 Charles Cazabon, and licensed under the GNU
         General Public License version 2.
@@ -274,3 +365,4 @@ class MaildirQueue(Queue):
         # Cancel the alarm.
         signal.alarm(0)
         signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        return filename
@@ -30,10 +30,12 @@ Maildir without subdirectories.  It perhaps offers the best
 performance, but since it's a custom format, it can't be accessed and
 read with non-TMDA tools so may not be as convenient for users who
 wish to monitor the contents of their pending queue.
-"""
 
+With PENDING_BUCKET_SIZE, the files are spread over subdirectories of
+PENDING_DIR covering consecutive time intervals (e.g, a day), so that
+expired messages are deleted a subdirectory at a time.
+"""
 
-from email.utils import parseaddr
 
 import glob
 import os
@@ -44,6 +46,9 @@ from TMDA import Util
 from TMDA.Queue.Queue import Queue
 
 
+# The number of messages moved into buckets by each cleanup.
+MIGRATE_LIMIT = 1000
+
 
 class OriginalQueue(Queue):
     def __init__(self):
@@ -67,78 +72,222 @@ class OriginalQueue(Queue):
         pass
 
 
-    def cleanup(self):
-        if not self.exists():
-            return
+    # With PENDING_BUCKET_SIZE, messages are stored in subdirectories
+    # of PENDING_DIR, the buckets, each holding the messages queued
+    # during a PENDING_BUCKET_SIZE interval and named after it
+    # (e.g, 1159315200-1159401600/1159377144.3747.msg).  A bucket
+    # whose interval has expired is deleted as a whole.
+
+    def __bucket_size(self):
+        if Defaults.PENDING_BUCKET_SIZE:
+            return Util.seconds(Defaults.PENDING_BUCKET_SIZE)
+        return None
+
+
+    def __buckets(self):
+        """Return the list of (start, end, dirname) of the buckets."""
+        buckets = []
+        for name in os.listdir(Defaults.PENDING_DIR):
+            (start, sep, end) = name.partition('-')
+            if sep and start.isdigit() and end.isdigit():
+                buckets.append((int(start), int(end), name))
+        return buckets
+
+
+    def __path(self, mailid):
+        """Return the pathname a new message is stored at."""
+        fname = mailid + '.msg'
+        size = self.__bucket_size()
+        if not size:
+            return os.path.join(Defaults.PENDING_DIR, fname)
+        start = int(mailid.split('.')[0]) // size * size
+        return os.path.join(Defaults.PENDING_DIR,
+                            '%d-%d' % (start, start + size), fname)
+
+
+    def __find_path(self, mailid):
+        """Return the pathname of a queued message, or None."""
+        fpath = self.__path(mailid)
+        if os.path.exists(fpath):
+            return fpath
+        fname = mailid + '.msg'
+        flat = os.path.join(Defaults.PENDING_DIR, fname)
+        if fpath != flat and os.path.exists(flat):
+            # Queued before buckets were used.
+            return self.__migrate(fname) or flat
+        # Queued with another PENDING_BUCKET_SIZE.
+        try:
+            msg_time = int(mailid.split('.')[0])
+            buckets = self.__buckets()
+        except (ValueError, OSError):
+            return None
+        for (start, end, dirname) in buckets:
+            if start <= msg_time < end:
+                fpath = os.path.join(Defaults.PENDING_DIR, dirname, fname)
+                if os.path.exists(fpath):
+                    return fpath
+        return None
+
+
+    def __migrate(self, fname):
+        """Move a message from PENDING_DIR into its bucket, and return
+        its new pathname (None if it failed)."""
+        fpath = self.__path(fname[:-len('.msg')])
+        try:
+            if not os.path.isdir(os.path.dirname(fpath)):
+                os.makedirs(os.path.dirname(fpath), 0o700, exist_ok=True)
+            os.rename(os.path.join(Defaults.PENDING_DIR, fname), fpath)
+        except OSError:
+            return None
+        return fpath
+
+
+    def __delete(self, fpath, records):
+        """Delete an expired message."""
+        if Defaults.PENDING_DELETE_APPEND:
+            mailid = os.path.basename(fpath)[:-len('.msg')]
+            rp = self._metadata_return_path(records, mailid, fpath)
+            # None in case of concurrent cleanups
+            if rp is not None:
+                Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
+        try:
+            os.unlink(fpath)
+        except OSError:
+            # in case of concurrent cleanups
+            pass
+
+
+    def _expire(self, after, until, limit):
+        bucket_size = self.__bucket_size()
+        records = {}
+        if Defaults.PENDING_DELETE_APPEND:
+            records = self._read_metadata()
+
+        expired = []
+        kept = []
+        later = []
+        buckets = []
+        for (start, end, dirname) in self.__buckets():
+            if start > until:
+                # skip this bucket
+                later.append((start, dirname))
+                continue
+            if after is not None and end - 1 <= after:
+                # skip this bucket
+                continue
+            dirpath = os.path.join(Defaults.PENDING_DIR, dirname)
+            if end - 1 <= until:
+                buckets.append(dirpath)
+            for msg in glob.glob(os.path.join(glob.escape(dirpath), '*.*.msg')):
+                expired.append((int(os.path.basename(msg).split('.')[0]), msg))
 
-        lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
         cwd = os.getcwd()
         os.chdir(Defaults.PENDING_DIR)
         msgs = glob.glob('*.*.msg')
         os.chdir(cwd)
 
+        migrated = 0
         for msg in msgs:
-            now = '%d' % time.time()
-            min_time = int(now) - int(lifetimesecs)
             msg_time = int(msg.split('.')[0])
-            if msg_time > min_time:
-                # skip this message
+            if msg_time > until:
+                # skip this message, or move it into its bucket, a few
+                # at a time to keep each cleanup short
+                if bucket_size and migrated < MIGRATE_LIMIT:
+                    self.__migrate(msg)
+                    migrated += 1
+                kept.append(msg_time)
                 continue
+            expired.append((msg_time, os.path.join(Defaults.PENDING_DIR, msg)))
+
+        if later:
+            # the oldest message left may be in the first bucket skipped
+            (start, dirname) = min(later)
+            dirpath = os.path.join(Defaults.PENDING_DIR, dirname)
+            kept.extend([ int(os.path.basename(msg).split('.')[0])
+                          for msg in glob.glob(os.path.join(glob.escape(dirpath),
+                                                            '*.*.msg')) ]
+                        or [start])
+        # (messages up to after are behind the cursor)
+        kept.extend([ msg_time for (msg_time, fpath) in expired
+                      if msg_time > until ])
+        expired = [ (msg_time, fpath) for (msg_time, fpath) in expired
+                    if msg_time <= until
+                    and (after is None or msg_time > after) ]
+        expired.sort()
+        if limit is not None:
+            kept.extend([ msg_time for (msg_time, fpath) in expired[limit:] ])
+            expired = expired[:limit]
+        for (msg_time, fpath) in expired:
             # delete this message
-            fpath = os.path.join(Defaults.PENDING_DIR, msg)
-            if Defaults.PENDING_DELETE_APPEND:
-                try:
-                    msgobj = Util.msg_from_binfile(open(fpath, 'rb'))
-                except IOError:
-                    # in case of concurrent cleanups
-                    pass
-                else:
-                    rp = Util.unmangle_sender(parseaddr(msgobj.get('return-path'))[1])
-                    Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
+            self.__delete(fpath, records)
+        for dirpath in buckets:
             try:
-                os.unlink(fpath)
+                os.rmdir(dirpath)
             except OSError:
-                # in case of concurrent cleanups
+                # not empty yet, or in case of concurrent deliveries
                 pass
+        return ([ msg_time for (msg_time, fpath) in expired ],
+                min(kept, default=int(time.time())))
 
 
     def fetch_ids(self):
         cwd = os.getcwd()
         os.chdir(Defaults.PENDING_DIR)
-        msgs = glob.glob('*.*.msg')
-        ids = [i.rstrip('.msg') for i in msgs]
+        msgs = glob.glob('*.*.msg') + glob.glob('*-*/*.*.msg')
+        ids = [os.path.basename(i)[:-len('.msg')] for i in msgs]
         os.chdir(cwd)
         return ids
 
 
     def insert_message(self, msg, mailid, recipient):
-        fname = mailid + ".msg"
         # Create ~/.tmda/ and friends if necessary.
         self._create()
         # X-TMDA-Recipient is used by release_pending()
         del msg['X-TMDA-Recipient']
         msg['X-TMDA-Recipient'] = recipient
-        # Write ~/.tmda/pending/MAILID.msg
+        # Write ~/.tmda/pending/[BUCKET/]MAILID.msg
         fcontents = Util.msg_as_bytes(msg)
-        fpath = os.path.join(Defaults.PENDING_DIR, fname)
+        fpath = self.__path(mailid)
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath), 0o700, exist_ok=True)
         Util.write_to_binfile(fcontents, fpath)
         del msg['X-TMDA-Recipient']
+        self._append_metadata(self._make_metadata(msg, mailid, recipient,
+                                                  len(fcontents)))
 
 
     def fetch_message(self, mailid):
-        fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
+        fpath = self.__find_path(mailid)
+        if fpath is None:
+            fpath = self.__path(mailid)
         msg = Util.msg_from_binfile(open(fpath, 'rb'))
         return msg
 
 
+    def fetch_headers(self, mailid):
+        fpath = self.__find_path(mailid)
+        if fpath is None:
+            fpath = self.__path(mailid)
+        with open(fpath, 'rb') as fp:
+            return Util.headers_from_binfile(fp)
+
+
+    def message_size(self, mailid):
+        fpath = self.__find_path(mailid)
+        if fpath is None:
+            fpath = self.__path(mailid)
+        return os.stat(fpath).st_size
+
+
     def delete_message(self, mailid):
-        fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
+        fpath = self.__find_path(mailid)
+        if fpath is None:
+            fpath = self.__path(mailid)
         os.unlink(fpath)
 
 
     def find_message(self, mailid):
-        fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
-        if os.path.exists(fpath):
+        if self.__find_path(mailid):
             return True
         else:
             return False
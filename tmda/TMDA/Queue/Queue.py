@@ -28,8 +28,57 @@ seperated by a dot, e.g, "1159383896.4198".  This infomration
 currently comes from a timestamp and the Python process id.
 """
 
+from email.utils import parseaddr
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import time
+
 from TMDA import Defaults
 from TMDA import Errors
+from TMDA import Util
+
+
+# The size (in bytes) below which cleanups with a budget don't compact
+# the metadata store; see Queue.cleanup().
+METADATA_COMPACT_SIZE = 1 << 20
+
+# The metadata kept for each message; see Queue.fetch_metadata().  All
+# but 'confirm_address', made when looked up, are stored.
+METADATA_FIELDS = ('mailid', 'return_path', 'recipient', 'from', 'subject',
+                   'date', 'size', 'confirm_address')
+STORED_FIELDS = tuple([ field for field in METADATA_FIELDS
+                        if field != 'confirm_address' ])
+
+
+class Metadata(dict):
+    """
+    The metadata of a message, keyed by STORED_FIELDS.  Its
+    'confirm_address', a HMAC which may cost a PBKDF2 derivation (see
+    HMAC_ALGO), is only made the first time it is looked up.
+    """
+    def __missing__(self, key):
+        if key != 'confirm_address':
+            raise KeyError(key)
+        from TMDA import Cookie
+        confirm_address = None
+        recipient = self.get('recipient')
+        if recipient:
+            (timestamp, pid) = self['mailid'].split('.')
+            confirm_address = Cookie.make_confirm_address(recipient,
+                                                          timestamp, pid,
+                                                          'accept')
+        self[key] = confirm_address
+        return confirm_address
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
 
 class Queue:
@@ -61,12 +110,16 @@ class Queue:
         pass
 
 
-    def cleanup(self):
+    def _expire(self, after, until, limit):
         """
-        Delete messages from the queue that are older than
-        Defaults.PENDING_LIFETIME.
+        Delete the messages queued after time after (None for no
+        bound) and up to time until, the oldest first, and at most
+        limit of them (None for no limit).  Return the sorted list of
+        the times of the deleted messages, and the time of the oldest
+        message left in the queue (the current time if none is left,
+        None if unknown).
         """
-        pass
+        return ([], None)
 
 
     def fetch_ids(self):
@@ -98,6 +151,22 @@ class Queue:
         pass
 
 
+    def fetch_headers(self, mailid):
+        """
+        Fetch the headers of a message in the queue, without reading
+        its body if possible.  Should return an email.message like
+        object.
+        """
+        return self.fetch_message(mailid)
+
+
+    def message_size(self, mailid):
+        """
+        Return the size of a message in the queue, in bytes.
+        """
+        return len(Util.msg_as_bytes(self.fetch_message(mailid)))
+
+
     def delete_message(self, mailid):
         """
         Delete a message in the queue.
@@ -112,7 +181,250 @@ class Queue:
         pass
 
 
-    # Subclasses should not override this method.
+    def fetch_metadata(self):
+        """
+        Return a list containing the metadata of all messages in the
+        queue, without reading their bodies: a Metadata dictionary per
+        message, which gives each of METADATA_FIELDS.  'return_path',
+        'from', 'subject' and 'date' are the raw headers (or None),
+        'recipient' is the X-TMDA-Recipient, 'size' is in bytes and
+        'confirm_address' is the confirmation address releasing the
+        message, made when looked up.
+
+        The default implementation uses the metadata store (see
+        _append_metadata()), reading the headers of the messages
+        missing from it and adding them.
+        """
+        records = self._read_metadata()
+        metadata = []
+        missing = []
+        for mailid in self.fetch_ids():
+            record = records.get(mailid)
+            if record is None:
+                try:
+                    record = self._make_metadata(self.fetch_headers(mailid),
+                                                 mailid, None,
+                                                 self.message_size(mailid))
+                except (IOError, OSError):
+                    # deleted meanwhile
+                    continue
+                missing.append(record)
+            metadata.append(record)
+        if missing:
+            self._append_metadata(*missing)
+        return metadata
+
+
+    # Subclasses may use the following methods to keep the metadata
+    # of the messages in PENDING_DIR/tmda-metadata, a file of JSON
+    # records, one per line, appended as messages are inserted.  The
+    # records of deleted messages are only dropped by
+    # _compact_metadata(), so the store is only a cache: the messages
+    # are always listed with fetch_ids().
+
+    def _metadata_path(self):
+        return os.path.join(Defaults.PENDING_DIR, 'tmda-metadata')
+
+
+    @contextlib.contextmanager
+    def _lock_metadata(self):
+        """
+        Hold the lock of the metadata store within a with block.  It
+        is a separate file, since the store is replaced when compacted.
+        """
+        fd = os.open(self._metadata_path() + '.lock',
+                     os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+    def _make_metadata(self, msg, mailid, recipient, size):
+        """
+        Return the Metadata of a message.
+        """
+        if recipient is None:
+            recipient = msg.get('x-tmda-recipient')
+        record = Metadata(mailid=mailid, recipient=recipient, size=size)
+        for (field, header) in (('return_path', 'return-path'),
+                                ('from', 'from'), ('subject', 'subject'),
+                                ('date', 'date')):
+            value = msg.get(header)
+            if value is not None:
+                value = str(value)
+            record[field] = value
+        return record
+
+
+    def _append_metadata(self, *records):
+        """
+        Append records to the metadata store.
+        """
+        data = ''.join([ json.dumps(dict([ (field, record.get(field))
+                                           for field in STORED_FIELDS ]))
+                         + '\n' for record in records ])
+        try:
+            with self._lock_metadata():
+                fd = os.open(self._metadata_path(),
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                try:
+                    os.write(fd, data.encode())
+                finally:
+                    os.close(fd)
+        except OSError:
+            # it is only a cache
+            pass
+
+
+    def _metadata_size(self):
+        """
+        Return the size of the metadata store in bytes.
+        """
+        try:
+            return os.stat(self._metadata_path()).st_size
+        except OSError:
+            return 0
+
+
+    def _read_metadata(self):
+        """
+        Return the records of the metadata store, keyed by mailid.
+        """
+        records = {}
+        try:
+            fp = open(self._metadata_path(), 'rb')
+        except OSError:
+            return records
+        with fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                    # (older stores have a 'confirm_address' too)
+                    records[record['mailid']] = Metadata(
+                        [ (field, record.get(field))
+                          for field in STORED_FIELDS ])
+                except (ValueError, KeyError, TypeError):
+                    # e.g, a partial line
+                    continue
+        return records
+
+
+    def _compact_metadata(self):
+        """
+        Drop the records of the messages no longer in the queue from
+        the metadata store.
+        """
+        path = self._metadata_path()
+        if not os.path.exists(path):
+            return
+        try:
+            with self._lock_metadata():
+                mailids = set(self.fetch_ids())
+                records = self._read_metadata()
+                (tmpfd, tmpname) = tempfile.mkstemp(dir=Defaults.PENDING_DIR)
+                with os.fdopen(tmpfd, 'w') as fp:
+                    for (mailid, record) in records.items():
+                        if mailid in mailids:
+                            fp.write(json.dumps(record) + '\n')
+                os.rename(tmpname, path)
+        except OSError:
+            pass
+
+
+    def _metadata_return_path(self, records, mailid, fpath):
+        """
+        Return the unmangled Return-Path address of a message, from its
+        metadata record if any, otherwise from the message file fpath.
+        Return None if it can't be read.
+        """
+        record = records.get(mailid)
+        if record is not None:
+            return_path = record['return_path']
+        else:
+            try:
+                with open(fpath, 'rb') as fp:
+                    return_path = Util.headers_from_binfile(fp).get('return-path')
+            except IOError:
+                return None
+        return Util.unmangle_sender(parseaddr(return_path or '')[1])
+
+
+    # Subclasses should not override these methods.
+
+    def cleanup(self, budget=None):
+        """
+        Delete messages from the queue that are older than
+        Defaults.PENDING_LIFETIME, and return how many.
+
+        Only one process cleans the queue at a time; if another one
+        is, None is returned right away.
+
+        With a budget (see PENDING_CLEANUP_BUDGET), at most budget
+        messages, the oldest, are deleted.  The time up to which the
+        queue is clean, and the time of the oldest message left, are
+        kept in PENDING_DIR/tmda-cleanup, so the next call resumes from
+        there, and returns at once until that message expires.  The
+        metadata store is only compacted once it has doubled in size
+        (and is over METADATA_COMPACT_SIZE).  Otherwise, the whole
+        queue is gone through, the metadata store compacted, and the
+        queue converted from another format if need be (see _convert()).
+        """
+        if not self.exists():
+            return 0
+        lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
+        min_time = int(time.time()) - int(lifetimesecs)
+        try:
+            fd = os.open(os.path.join(Defaults.PENDING_DIR, 'tmda-cleanup'),
+                         os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # another process is cleaning
+                return None
+            # "AFTER [OLDEST [COMPACTED]]", OLDEST being -1 if unknown
+            # and COMPACTED the size of the metadata store when it was
+            # last compacted.
+            state = (os.read(fd, 64).split() + [b'-1', b'0'])[:3]
+            try:
+                (after, oldest, compacted) = [ int(field)
+                                               for field in state ]
+            except ValueError:
+                # new or damaged cursor
+                (after, oldest, compacted) = (None, -1, 0)
+            if not budget:
+                # e.g, move what is left of a queue in another format
+                self._convert()
+                after = None
+            elif after is not None and oldest > min_time:
+                # nothing expired since
+                return 0
+            (expired, oldest) = self._expire(after, min_time, budget or None)
+            if budget and len(expired) >= budget:
+                # Messages queued at the time of the last one deleted
+                # may remain.
+                cursor = expired[-1] - 1
+            else:
+                cursor = min_time
+            if oldest is None:
+                oldest = -1
+            if expired:
+                size = self._metadata_size()
+                if not budget or size > max(2 * compacted,
+                                            METADATA_COMPACT_SIZE):
+                    self._compact_metadata()
+                    compacted = self._metadata_size()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, b'%d %d %d\n' % (cursor, oldest, compacted))
+        finally:
+            os.close(fd)
+        return len(expired)
+
 
     def init(self):
         qformat = Defaults.PENDING_QUEUE_FORMAT
@@ -122,6 +434,9 @@ class Queue:
         if qformat.lower() == 'maildir':
             from .MaildirQueue import MaildirQueue
             return MaildirQueue()
+        if qformat.lower() == 'sqlite':
+            from .SQLiteQueue import SQLiteQueue
+            return SQLiteQueue()
         else:
             raise Errors.ConfigError("Unknown PENDING_QUEUE_FORMAT: " + '"%s"' % qformat)
 
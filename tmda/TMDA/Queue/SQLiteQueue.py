@@ -0,0 +1,273 @@
+# -*- mode:python; tab-width:4; c-basic-offset:4; intent-tabs-mode:nil; -*-
+# ex: filetype=python tabstop=4 softtabstop=4 shiftwidth=4 expandtab autoindent smartindent
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""SQLite pending queue format.
+
+All the messages are kept in a single SQLite database,
+PENDING_DIR/pending.sqlite, one row per message holding the message as
+it was queued along with the headers TMDA looks at: listing the queue,
+expiring messages and looking one up are done on indexed columns
+rather than by reading a directory and parsing files.
+
+Messages already in PENDING_DIR in the "original" or "maildir" format
+are moved into the database a few at a time, each time a process opens
+it, and all at once by 'tmda-pending --cleanup'.
+"""
+
+
+from email.utils import parseaddr
+
+import os
+import sqlite3
+import time
+
+from TMDA import Defaults
+from TMDA import Util
+from TMDA.Queue.Queue import Queue, Metadata, STORED_FIELDS
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    mailid TEXT PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    return_path TEXT,
+    recipient TEXT,
+    from_header TEXT,
+    subject TEXT,
+    date TEXT,
+    size INTEGER NOT NULL,
+    message BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# The version of SCHEMA, kept as the user_version of the database, and
+# the columns added since the first version, which are added to older
+# databases.  (Databases of version 1 may also have a confirm_address
+# column, no longer used.)
+SCHEMA_VERSION = 1
+ADDED_COLUMNS = (('date', 'TEXT'),)
+
+# The number of messages of an older queue moved into the database
+# each time a process opens it; see _convert().
+CONVERT_BATCH = 100
+
+# The open databases, keyed by process id and pathname (a connection
+# must not be used by a forked process).
+_connections = {}
+
+# The columns holding each field of Queue.fetch_metadata().
+METADATA_COLUMNS = {'from': 'from_header'}
+
+
+class SQLiteQueue(Queue):
+    def __init__(self):
+        Queue.__init__(self)
+        self.format = "sqlite"
+
+
+    def __dbpath(self):
+        return os.path.join(Defaults.PENDING_DIR, 'pending.sqlite')
+
+
+    def __db(self):
+        """Return the connection to the database, creating it if
+        necessary, and converting some of the messages of an older
+        queue left."""
+        dbpath = self.__dbpath()
+        db = _connections.get((os.getpid(), dbpath))
+        if db is not None:
+            return db
+        self._create()
+        os.close(os.open(dbpath, os.O_WRONLY | os.O_CREAT, 0o600))
+        db = sqlite3.connect(dbpath, timeout=30)
+        db.executescript(SCHEMA)
+        self.__upgrade(db)
+        _connections[(os.getpid(), dbpath)] = db
+        self._convert(CONVERT_BATCH)
+        return db
+
+
+    def __upgrade(self, db):
+        """Bring a database created by an older version up to SCHEMA."""
+        (version,) = db.execute('PRAGMA user_version').fetchone()
+        if version >= SCHEMA_VERSION:
+            return
+        with db:
+            columns = [ row[1] for row
+                        in db.execute('PRAGMA table_info(messages)') ]
+            for (column, type_) in ADDED_COLUMNS:
+                if column not in columns:
+                    db.execute('ALTER TABLE messages ADD COLUMN %s %s'
+                               % (column, type_))
+            db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+
+    def exists(self):
+        if os.path.exists(Defaults.PENDING_DIR):
+            return True
+        else:
+            return False
+
+
+    def _create(self):
+        if not self.exists():
+            os.makedirs(Defaults.PENDING_DIR, 0o700)
+
+
+    def _convert(self, limit=None):
+        """Move the messages of an "original" or "maildir" queue in
+        PENDING_DIR into the database, at most limit of them (None for
+        no limit).  Each message is deleted from the old queue once
+        moved, so the next call carries on with those left, and once
+        none is, this is recorded in the database."""
+        db = self.__db()
+        if db.execute("SELECT value FROM state WHERE name = 'converted'"
+                      ).fetchone():
+            return
+        from .OriginalQueue import OriginalQueue
+        from .MaildirQueue import MaildirQueue
+        queues = [OriginalQueue()]
+        if (os.path.isdir(os.path.join(Defaults.PENDING_DIR, 'new')) and
+            os.path.isdir(os.path.join(Defaults.PENDING_DIR, 'cur'))):
+            queues.append(MaildirQueue())
+        count = 0
+        for queue in queues:
+            for mailid in queue.fetch_ids():
+                if limit is not None and count >= limit:
+                    return
+                try:
+                    msg = queue.fetch_message(mailid)
+                except IOError:
+                    continue
+                recipient = msg.get('x-tmda-recipient')
+                self.insert_message(msg, mailid, recipient)
+                try:
+                    queue.delete_message(mailid)
+                except OSError:
+                    pass
+                count += 1
+        with db:
+            db.execute("INSERT OR REPLACE INTO state VALUES ('converted', 1)")
+
+
+    def _expire(self, after, until, limit):
+        db = self.__db()
+        with db:
+            cursor = db.execute('SELECT mailid, timestamp, return_path'
+                                ' FROM messages'
+                                ' WHERE timestamp > ? AND timestamp <= ?'
+                                ' ORDER BY timestamp LIMIT ?',
+                                (-1 if after is None else after, until,
+                                 -1 if limit is None else limit))
+            expired = cursor.fetchall()
+            for (mailid, timestamp, return_path) in expired:
+                if Defaults.PENDING_DELETE_APPEND:
+                    rp = Util.unmangle_sender(parseaddr(return_path or '')[1])
+                    Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
+            db.executemany('DELETE FROM messages WHERE mailid = ?',
+                           [ (mailid,) for (mailid, timestamp, return_path)
+                             in expired ])
+            (oldest,) = db.execute('SELECT MIN(timestamp) FROM messages'
+                                   ' WHERE timestamp > ?',
+                                   (-1 if after is None else after,)
+                                   ).fetchone()
+        if oldest is None:
+            oldest = int(time.time())
+        return ([ timestamp for (mailid, timestamp, return_path) in expired ],
+                oldest)
+
+
+    def fetch_ids(self):
+        cursor = self.__db().execute('SELECT mailid FROM messages')
+        return [ mailid for (mailid,) in cursor ]
+
+
+    def insert_message(self, msg, mailid, recipient):
+        # X-TMDA-Recipient is used by release_pending()
+        del msg['X-TMDA-Recipient']
+        msg['X-TMDA-Recipient'] = recipient
+        message = Util.msg_as_bytes(msg)
+        del msg['X-TMDA-Recipient']
+        record = self._make_metadata(msg, mailid, recipient, len(message))
+        db = self.__db()
+        with db:
+            # The columns are named, since those added by __upgrade()
+            # come last.
+            db.execute('INSERT OR REPLACE INTO messages (mailid, timestamp,'
+                       ' return_path, recipient, from_header, subject, date,'
+                       ' size, message) VALUES'
+                       ' (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (mailid, int(mailid.split('.')[0]),
+                        record['return_path'], recipient, record['from'],
+                        record['subject'], record['date'], record['size'],
+                        message))
+
+
+    def fetch_message(self, mailid):
+        row = self.__db().execute('SELECT message FROM messages'
+                                  ' WHERE mailid = ?', (mailid,)).fetchone()
+        if row is None:
+            raise IOError("couldn't locate %s" % mailid)
+        return Util.RawMessage(row[0]).message()
+
+
+    def fetch_metadata(self):
+        columns = [ METADATA_COLUMNS.get(field, field)
+                    for field in STORED_FIELDS ]
+        cursor = self.__db().execute('SELECT %s FROM messages'
+                                     % ', '.join(columns))
+        return [ Metadata(zip(STORED_FIELDS, row)) for row in cursor ]
+
+
+    def fetch_headers(self, mailid):
+        row = self.__db().execute('SELECT message FROM messages'
+                                  ' WHERE mailid = ?', (mailid,)).fetchone()
+        if row is None:
+            raise IOError("couldn't locate %s" % mailid)
+        return Util.RawMessage(row[0]).headers_message()
+
+
+    def message_size(self, mailid):
+        row = self.__db().execute('SELECT size FROM messages'
+                                  ' WHERE mailid = ?', (mailid,)).fetchone()
+        if row is None:
+            raise IOError("couldn't locate %s" % mailid)
+        return row[0]
+
+
+    def delete_message(self, mailid):
+        db = self.__db()
+        with db:
+            db.execute('DELETE FROM messages WHERE mailid = ?', (mailid,))
+
+
+    def find_message(self, mailid):
+        if not self.exists():
+            return False
+        row = self.__db().execute('SELECT 1 FROM messages WHERE mailid = ?',
+                                  (mailid,)).fetchone()
+        return row is not None
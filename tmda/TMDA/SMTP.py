@@ -32,7 +32,10 @@ Copyright (C) 1998,1999,2000,2001 by the Free Software Foundation, Inc.,
 and licensed under the GNU General Public License version 2.
 """
 
+import concurrent.futures
+import queue
 import smtplib
+import threading
 
 from . import Defaults
 
@@ -56,10 +59,19 @@ class Connection:
                               Defaults.SMTPAUTH_PASSWORD)
 
     def sendmail(self, envsender, recips, msg_bytes):
-        if self.__conn is None:
+        reused = self.__conn is not None
+        if not reused:
             self.__connect()
         try:
             results = self.__conn.sendmail(envsender, recips, msg_bytes)
+        except (smtplib.SMTPServerDisconnected,
+                smtplib.SMTPSenderRefused) as obj:
+            self.quit()
+            if not reused or getattr(obj, 'smtp_code', 421) != 421:
+                raise
+            # The server closed the connection while it was idle
+            # (e.g, it timed out); try once more over a new one.
+            return self.sendmail(envsender, recips, msg_bytes)
         except smtplib.SMTPException:
             # For safety, close this connection.  The next send
             # attempt will automatically re-open it.  Pass the
@@ -85,3 +97,33 @@ class Connection:
             pass
         self.__conn = None
 
+
+# Send messages over several connections to an SMTP server in parallel.
+class ConnectionPool:
+    def __init__(self, size):
+        self.__idle = queue.LifoQueue()
+        for i in range(size):
+            self.__idle.put(Connection())
+        self.__executor = concurrent.futures.ThreadPoolExecutor(size)
+        # Don't hold more than a couple of messages per connection.
+        self.__slots = threading.BoundedSemaphore(2 * size)
+
+    def __send(self, envsender, recips, msg_bytes):
+        conn = self.__idle.get()
+        try:
+            return conn.sendmail(envsender, recips, msg_bytes)
+        finally:
+            self.__idle.put(conn)
+            self.__slots.release()
+
+    def sendmail(self, envsender, recips, msg_bytes):
+        """Return a concurrent.futures.Future of the results of
+        Connection.sendmail(), as soon as a connection is free."""
+        self.__slots.acquire()
+        return self.__executor.submit(self.__send,
+                                      envsender, recips, msg_bytes)
+
+    def quit(self):
+        self.__executor.shutdown()
+        while not self.__idle.empty():
+            self.__idle.get().quit()
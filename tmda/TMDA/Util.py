@@ -29,12 +29,14 @@ import email
 import email.utils
 import fileinput
 import fnmatch
+import mmap
 import os
 import subprocess
 from subprocess import PIPE, STDOUT # Make these available in Util
 import re
 import socket
 import stat
+import struct
 import sys
 import tempfile
 import textwrap
@@ -49,16 +51,37 @@ MODE_READ = 0o4
 MODE_WRITE = 0o2
 POSIX_NAME_MAX = 255                    # maximum length of a file name
 
-def gethostname():
+def gethostname(environ=None):
     """The host name"""
-    hostname = os.environ.get('TMDAHOST') or \
-               os.environ.get('QMAILHOST') or \
-               os.environ.get('MAILHOST')
+    if environ is None:
+        environ = os.environ
+    hostname = environ.get('TMDAHOST') or \
+               environ.get('QMAILHOST') or \
+               environ.get('MAILHOST')
     if not hostname:
         hostname = socket.getfqdn()
     return hostname
 
 
+# The environment variables the configuration depends on, besides
+# those starting with TMDA (TMDARC, TMDAHOST, TMDA_CACHE_DIR, etc.):
+# the ones Defaults reads, and those gethostname(), getfullname() and
+# getusername() read.
+config_environ_names = ('HOME', 'GLOBAL_TMDARC',
+                        'QMAILHOST', 'MAILHOST',
+                        'QMAILNAME', 'NAME', 'MAILNAME',
+                        'QMAILUSER', 'USER', 'LOGNAME')
+
+def config_environ(environ=None):
+    """Return the part of environ (os.environ by default) the
+    configuration depends on, as a dictionary."""
+    if environ is None:
+        environ = os.environ
+    return dict([ (name, value) for (name, value) in environ.items()
+                  if name.startswith('TMDA')
+                  or name in config_environ_names ])
+
+
 def urlsplit(urlstring, scheme='', allow_fragments=True):
     '''Modified urlparse.urlsplit that handles IPv6 addresses.'''
     import urllib.parse
@@ -102,12 +125,14 @@ class IP6SplitResult(object):
         return repr(self._result)
 
 
-def getfullname():
+def getfullname(environ=None):
     """The user's personal name.  Default is an empty value."""
-    fullname = os.environ.get('TMDANAME') or \
-               os.environ.get('QMAILNAME') or \
-               os.environ.get('NAME') or \
-               os.environ.get('MAILNAME')
+    if environ is None:
+        environ = os.environ
+    fullname = environ.get('TMDANAME') or \
+               environ.get('QMAILNAME') or \
+               environ.get('NAME') or \
+               environ.get('MAILNAME')
     if not fullname:
         import pwd
         fullname = pwd.getpwuid(os.getuid())[4]
@@ -116,12 +141,14 @@ def getfullname():
     return fullname
 
 
-def getusername():
+def getusername(environ=None):
     """The user name"""
-    username = os.environ.get('TMDAUSER') or \
-               os.environ.get('QMAILUSER') or \
-               os.environ.get('USER') or \
-               os.environ.get('LOGNAME')
+    if environ is None:
+        environ = os.environ
+    username = environ.get('TMDAUSER') or \
+               environ.get('QMAILUSER') or \
+               environ.get('USER') or \
+               environ.get('LOGNAME')
     if not username:
         import pwd
         username = pwd.getpwuid(os.getuid())[0]
@@ -561,6 +588,83 @@ def msg_from_binfile(fp):
     return msg
 
 
+def headers_from_binfile(fp):
+    """Read a binary file up to the first empty line, and parse these
+    headers into a Message object model; the body is not read."""
+    from email.message import Message
+    from email.parser import BytesParser
+    lines = []
+    for line in fp:
+        if line in (b'\n', b'\r\n'):
+            break
+        lines.append(line)
+    return BytesParser(Message).parsebytes(b''.join(lines), headersonly=True)
+
+
+# A header or continuation line, as email.feedparser tells them.
+_header_line = re.compile(rb'From |[\041-\071\073-\176]*:|[\t ]')
+
+class RawMessage:
+    """
+    A message kept as the bytes it was read as.
+
+    headers and body are memoryview slices of those bytes, split where
+    the email parser ends the headers: at the first empty line, or at
+    the first line which is neither a header nor a continuation line,
+    which then starts the body.  A leading From_ line is not part of
+    the headers, and size is the length of the whole message.  None of
+    them parse the message or copy its contents.
+
+    headers_message() returns a Message object holding the headers
+    only, enough to read them.  message() returns the complete Message
+    object, parsed the first time it is needed, with the headers of the
+    given headers_message() object, so changes made to them are kept.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.size = len(raw)
+        start = 0
+        if raw.startswith(b'From '):
+            start = raw.find(b'\n') + 1 or len(raw)
+        (end, body) = (len(raw), len(raw))
+        pos = start
+        while pos < len(raw):
+            if raw.startswith(b'\n', pos) or raw.startswith(b'\r\n', pos):
+                # the empty line separating the body
+                (end, body) = (pos, raw.index(b'\n', pos) + 1)
+                break
+            if not _header_line.match(raw, pos):
+                # not a header, so the body starts here
+                (end, body) = (pos, pos)
+                break
+            pos = raw.find(b'\n', pos) + 1 or len(raw)
+        view = memoryview(raw)
+        self.headers = view[start:end]
+        self.body = view[body:]
+        self.__end = end
+        self.__msg = None
+
+    def headers_message(self):
+        """Return a Message object holding the headers only."""
+        from email.message import Message
+        from email.parser import BytesParser
+        return BytesParser(Message).parsebytes(self.raw[:self.__end],
+                                               headersonly=True)
+
+    def message(self, headers_msg=None):
+        """Return the complete Message object."""
+        if headers_msg is not None and headers_msg is self.__msg:
+            return headers_msg
+        if self.__msg is None:
+            from email.message import Message
+            from email.parser import BytesParser
+            self.__msg = BytesParser(Message).parsebytes(self.raw)
+        if headers_msg is not None:
+            self.__msg._headers = headers_msg._headers
+            self.__msg.set_unixfrom(headers_msg.get_unixfrom())
+        return self.__msg
+
+
 def msg_as_bytes(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
     """A more flexible replacement for Message.as_bytes().  The default
     is a textual representation of the message where the headers are
@@ -585,7 +689,7 @@ def msg_as_bytes(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
     return fp.getvalue()
 
 
-def sendmail(msg_bytes, envrecip, envsender):
+def sendmail(msg_bytes, envrecip, envsender, server=None):
     """Send e-mail via direct SMTP, or by opening a pipe to the
     sendmail program.
 
@@ -594,6 +698,10 @@ def sendmail(msg_bytes, envrecip, envsender):
     envrecip is the envelope recipient address.
 
     envsender is the envelope sender address.
+
+    server is an optional SMTP.Connection (or SMTP.ConnectionPool) to
+    send the message over, left open for the next messages.  The
+    return value of its sendmail() method is returned.
     """
     from . import Defaults
     # Sending mail with a null envelope sender address <> is not done
@@ -625,6 +733,8 @@ def sendmail(msg_bytes, envrecip, envsender):
                '-f', envsender, '--', envrecip)
         runcmd_checked(cmd, msg_bytes)
     elif Defaults.MAIL_TRANSPORT == 'smtp':
+        if server is not None:
+            return server.sendmail(envsender, envrecip, msg_bytes)
         from . import SMTP
         server = SMTP.Connection()
         server.sendmail(envsender, envrecip, msg_bytes)
@@ -731,8 +841,8 @@ def build_cdb(filename):
     import cdb
     try:
         cdbname = filename + '.cdb'
-        tempfile.tempdir = os.path.dirname(filename)
-        tmpname = os.path.split(tempfile.mktemp())[1]
+        tmpname = os.path.split(
+            tempfile.mktemp(dir=os.path.dirname(filename)))[1]
         cdb = cdb.cdbmake(cdbname, cdbname + '.' + tmpname)
         for line in file_to_list(filename):
             linef = line.split()
@@ -756,8 +866,7 @@ def build_dbm(filename):
     try:
         dbmpath, dbmname = os.path.split(filename)
         dbmname += '.dbm'
-        tempfile.tempdir = dbmpath
-        tmpname = tempfile.mktemp()
+        tmpname = tempfile.mktemp(dir=dbmpath)
         dbm_o = dbm.open(tmpname, 'n')
         for line in file_to_list(filename):
             linef = line.split()
@@ -779,6 +888,154 @@ def build_dbm(filename):
         return 1
 
 
+# Layout of the files built by build_index(): a header with the
+# number of records in each table, the exact address, '*@domain' and
+# '*@*.domain' tables sorted by key, the table of other wildcards in
+# file order, and the strings the records point to.
+_index_magic = b'TMDAIDX1'
+_index_header = struct.Struct('<8sIIII')
+_index_record = struct.Struct('<IIIII')  # key offset/length, line, value offset/length
+
+
+def build_index(filename):
+    """Build a sorted index file from a text file."""
+    try:
+        lines = []
+        for line in file_to_list(filename):
+            # Like the other list formats, only the keys are lowercased.
+            fields = line.split(None, 1)
+            fields[0] = fields[0].lower()
+            lines.append(' '.join(fields))
+        values = []
+        tables = ({}, {}, {}, [])
+        shapes = ('exact', 'domain', 'subdomain')
+        for (shape, p, idx) in wildcard_patterns(lines, values):
+            if shape in shapes:
+                tables[shapes.index(shape)].setdefault(p, idx)
+            elif shape == 'local':
+                tables[3].append(('@'.join(p), idx))
+            else:
+                tables[3].append((p, idx))
+        values = [ value != 1 and value.encode() or b''
+                   for value in values ]
+        records = []
+        strings = BytesIO()
+        nrecords = 0
+        for table in tables:
+            if isinstance(table, dict):
+                items = sorted([ (key.encode(), idx)
+                                 for (key, idx) in table.items() ])
+            else:
+                items = [ (key.encode(), idx) for (key, idx) in table ]
+            for (key, idx) in items:
+                records.append((strings.tell(), len(key), idx))
+                strings.write(key)
+            nrecords += len(items)
+        base = _index_header.size + nrecords * _index_record.size
+        indexname = filename + '.idx'
+        (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(indexname))
+        fp = os.fdopen(fd, 'wb')
+        fp.write(_index_header.pack(_index_magic,
+                                    *[ len(table) for table in tables ]))
+        value_offsets = {}
+        for (key_off, key_len, idx) in records:
+            value = values[idx]
+            if value not in value_offsets:
+                value_offsets[value] = strings.tell()
+                strings.write(value)
+            fp.write(_index_record.pack(base + key_off, key_len, idx,
+                                        base + value_offsets[value],
+                                        len(value)))
+        fp.write(strings.getvalue())
+        fp.close()
+        os.rename(tmpname, indexname)
+    except:
+        return 0
+    else:
+        return 1
+
+
+class ListIndex:
+    """A memory-mapped index file built by build_index().
+
+    Exact addresses and domains are found by a binary search of the
+    sorted tables, so nothing but the wildcards has to be read or
+    compiled at lookup time.
+    """
+
+    def __init__(self, filename):
+        fp = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        header = _index_header.unpack_from(self.map)
+        if header[0] != _index_magic:
+            raise Errors.TMDAError('%s: not an index file' % filename)
+        self.tables = []
+        offset = _index_header.size
+        for count in header[1:]:
+            self.tables.append((offset, count))
+            offset += count * _index_record.size
+        # Wildcards are compiled into a matcher whose indexes map
+        # back to the records of the side table.
+        (offset, count) = self.tables[3]
+        patterns = []
+        for i in range(count):
+            record = self.__record(offset, i)
+            patterns.append(self.map[record[0]:record[0]+record[1]].decode())
+        self.wildcards = WildcardMatcher(patterns)
+
+    def __record(self, offset, i):
+        return _index_record.unpack_from(self.map,
+                                         offset + i * _index_record.size)
+
+    def __bsearch(self, table, key):
+        """Return the line of key in one of the sorted tables, or None."""
+        (offset, count) = self.tables[table]
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self.__record(offset, mid)
+            found = self.map[record[0]:record[0]+record[1]]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return record
+        return None
+
+    def lookup(self, address):
+        """Return the record of the first line matching address."""
+        found = []
+        found.append(self.__bsearch(0, address.encode()))
+        (local, at, domain) = address.rpartition('@')
+        if at:
+            found.append(self.__bsearch(1, domain.encode()))
+            labels = domain.split('.')
+            for i in range(1, len(labels)):
+                found.append(self.__bsearch(2, '.'.join(labels[i:]).encode()))
+        idx = self.wildcards.lookup(address)
+        if idx is not None:
+            found.append(self.__record(self.tables[3][0], idx))
+        found = [ record for record in found if record ]
+        if found:
+            return min(found, key=lambda record: record[2])
+        return None
+
+    def findmatch(self, addrs):
+        """Same as the findmatch() function, for the indexed file."""
+        for address in addrs:
+            if address:
+                record = self.lookup(address.lower())
+                if record:
+                    if not record[4]:
+                        return 1
+                    return self.map[record[3]:record[3]+record[4]].decode()
+
+
 def pickleit(object, file, proto=2):
     """Store object in a pickle file.
 
@@ -797,9 +1054,8 @@ def pickleit(object, file, proto=2):
 
     default is 2, since we must support Python 2.3 and above.
     """
-    tempfile.tempdir = os.path.dirname(file)
-    tmpname = tempfile.mkstemp()[1]
-    fp = open(tmpname, 'wb')
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(file))
+    fp = os.fdopen(fd, 'wb')
     pickle.dump(object, fp, proto)
     fp.close()
     os.rename(tmpname, file)
@@ -834,30 +1090,179 @@ def findmatch(list_v, addrs):
     Unix shell-style wildcard pattern contained in list.  The
     comparison is case-insensitive.  Also, return the second half of
     the string if it exists (for exp and ext addresses only)."""
-    for address in addrs:
-        if address:
-            address = address.lower()
-            for p in list_v:
-                stringparts = p.split()
-                p = stringparts[0]
-                # Handle special @=domain.dom syntax.
-                try:
-                    at = p.rindex('@')
-                    atequals = p[at+1] == '='
-                except (ValueError, IndexError):
-                    atequals = None
-                if atequals:
-                    p1 = p[:at+1] + p[at+2:]
-                    p2 = p[:at+1] + '*.' + p[at+2:]
-                    match = (fnmatch.fnmatch(address,p1)
-                             or fnmatch.fnmatch(address,p2))
-                else:
-                    match = fnmatch.fnmatch(address,p)
-                if match:
-                    try:
-                        return stringparts[1]
-                    except IndexError:
-                        return 1
+    return WildcardMatcher(list_v).findmatch(addrs)
+
+
+_wildcards = re.compile(r'[*?[]')
+
+def wildcard_patterns(list_v, values):
+    """Classify the patterns of a findmatch() list by their shape.
+
+    Generate (shape, pattern, index) tuples, where index is the position
+    of the line in the list and shape is one of:
+
+      'exact'     - pattern is an address without wildcards,
+      'domain'    - pattern is the domain of a '*@domain' line,
+      'subdomain' - pattern is the domain of a '*@*.domain' line,
+      'local'     - pattern is a (local, domain) tuple for a line with
+                    wildcards in its local part only,
+      'wildcard'  - any other pattern.
+
+    A '@=domain' line yields two patterns.  The value of each line (its
+    second column, or 1) is appended to 'values'.
+    """
+    for line in list_v:
+        stringparts = line.split()
+        if not stringparts:
+            continue
+        idx = len(values)
+        try:
+            values.append(stringparts[1])
+        except IndexError:
+            values.append(1)
+        p = stringparts[0]
+        # Handle special @=domain.dom syntax.
+        try:
+            at = p.rindex('@')
+            atequals = p[at+1] == '='
+        except (ValueError, IndexError):
+            atequals = None
+        if atequals:
+            patterns = (p[:at+1] + p[at+2:], p[:at+1] + '*.' + p[at+2:])
+        else:
+            patterns = (p,)
+        for p in patterns:
+            if not _wildcards.search(p):
+                yield ('exact', p, idx)
+                continue
+            (local, at, domain) = p.rpartition('@')
+            if at and local == '*' and not _wildcards.search(domain):
+                yield ('domain', domain, idx)
+            elif (at and local == '*' and domain.startswith('*.')
+                  and not _wildcards.search(domain[2:])):
+                yield ('subdomain', domain[2:], idx)
+            elif at and not _wildcards.search(domain):
+                yield ('local', (local, domain), idx)
+            else:
+                yield ('wildcard', p, idx)
+
+
+class WildcardMatcher:
+    """The patterns of a findmatch() list, compiled for repeated lookups.
+
+    Patterns are sorted by their shape so that most of them are found
+    by a dictionary lookup instead of being tried one after the other:
+
+      - exact addresses (no wildcard) go in a dictionary,
+
+      - '*@domain' and '*@*.domain' (and thus '*@=domain') go in a trie
+        of the reversed domain labels,
+
+      - 'local@domain' patterns with a wildcard only in the local part
+        are grouped by domain into one regular expression per domain,
+
+      - the remaining patterns are combined into a few regular
+        expressions.
+
+    Each pattern remembers its position in the list, so that the first
+    matching line still wins, as it does with findmatch().
+    """
+
+    # Number of patterns combined into a single regular expression.
+    chunk_size = 256
+
+    def __init__(self, list_v):
+        self.values = []
+        self.exact = {}
+        self.domains = [{}, None, None]    # [children, exact, subdomains]
+        self.bydomain = {}
+        self.residual = []
+        bydomain = {}
+        residual = []
+        for (shape, p, idx) in wildcard_patterns(list_v, self.values):
+            if shape == 'exact':
+                self.exact.setdefault(p, idx)
+            elif shape == 'domain':
+                self.__adddomain(p, idx, 1)
+            elif shape == 'subdomain':
+                self.__adddomain(p, idx, 0)
+            elif shape == 'local':
+                (local, domain) = p
+                bydomain.setdefault(domain, []).append((local, idx))
+            else:
+                residual.append((p, idx))
+        for (domain, patterns) in bydomain.items():
+            self.bydomain[domain] = self.__combine(patterns)
+        for i in range(0, len(residual), self.chunk_size):
+            self.residual.append(
+                self.__combine(residual[i:i+self.chunk_size]))
+
+    def __adddomain(self, domain, idx, exact):
+        """Record '*@domain' (exact) or '*@*.domain' in the domain trie."""
+        node = self.domains
+        for label in reversed(domain.split('.')):
+            node = node[0].setdefault(label, [{}, None, None])
+        slot = exact and 1 or 2
+        if node[slot] is None or idx < node[slot]:
+            node[slot] = idx
+
+    def __combine(self, patterns):
+        """Combine (pattern, index) pairs into a single regex."""
+        regex = '|'.join([ '(?P<p%d>%s)' % (i, fnmatch.translate(p))
+                           for (i, (p, idx)) in enumerate(patterns) ])
+        return (re.compile(regex), [ idx for (p, idx) in patterns ])
+
+    def __search(self, combined, text):
+        (regex, indexes) = combined
+        mo = regex.match(text)
+        if mo:
+            # fnmatch.translate() may create groups of its own (e.g,
+            # with several '*' on Python 3.9 and 3.10), but the named
+            # group enclosing the pattern that matched is closed last.
+            return indexes[int(mo.lastgroup[1:])]
+        return None
+
+    def lookup(self, address):
+        """Return the index of the first pattern matching address."""
+        found = []
+        idx = self.exact.get(address)
+        if idx is not None:
+            found.append(idx)
+        (local, at, domain) = address.rpartition('@')
+        if at:
+            labels = domain.split('.')
+            node = self.domains
+            for remaining in range(len(labels) - 1, -1, -1):
+                node = node[0].get(labels[remaining])
+                if node is None:
+                    break
+                if remaining and node[2] is not None:
+                    found.append(node[2])
+                elif not remaining and node[1] is not None:
+                    found.append(node[1])
+            combined = self.bydomain.get(domain)
+            if combined:
+                idx = self.__search(combined, local)
+                if idx is not None:
+                    found.append(idx)
+        for combined in self.residual:
+            if found and combined[1][0] > min(found):
+                break
+            idx = self.__search(combined, address)
+            if idx is not None:
+                found.append(idx)
+                break
+        if found:
+            return min(found)
+        return None
+
+    def findmatch(self, addrs):
+        """Same as the findmatch() function, for the compiled list."""
+        for address in addrs:
+            if address:
+                idx = self.lookup(address.lower())
+                if idx is not None:
+                    return self.values[idx]
 
 
 def wraptext(text, column=70):
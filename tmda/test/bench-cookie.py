@@ -0,0 +1,139 @@
+"""Time making and verifying cookies with various HMAC settings.
+
+Usage: python bench-cookie.py [algorithm[:rounds] ...]
+
+For each HMAC_ALGO (default sha1, sha256, k2sha256:5, p2sha256:3,
+p2sha256:4 and p2sha256:5, the number after the colon being
+HMAC_ROUNDS), the confirm, dated, sender and keyword HMACs are made and
+verified with the cookie caches turned off, and the number of
+operations per second is reported for:
+
+  make      make_*_mac, the cost of tagging an outgoing address
+  verify    verify_*_mac of an alphanumeric HMAC made with the current key
+  legacy    the same with a hexadecimal HMAC (HMAC_ENCODING_COMPAT)
+  rollover  verify_*_mac of a HMAC made with the rollover key, using
+            the same settings; the current key is tried first, or
+            concurrently for sender and keyword HMACs with PBKDF2
+
+The projected overhead per message is then the time a tmda-filter run
+spends on cookies for a message sent to a tagged address (one verify,
+or one rollover verify for an address issued before a key change) and
+a tmda-inject run for each recipient of a tagged message (one make).
+The one-time derivation of the 'k2' subkeys is not included.
+"""
+
+import sys
+import time
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Cookie
+from TMDA import Defaults
+
+
+MIN_TIME = 0.5
+MIN_OPS = 3
+NOW = int(time.time())
+
+DEFAULT_ALGORITHMS = ['sha1', 'sha256', 'k2sha256:5',
+                      'p2sha256:3', 'p2sha256:4', 'p2sha256:5']
+
+# The items of the HMAC of each kind of cookie, and the functions making
+# and verifying it.  A different cookie is used for each operation.
+KINDS = [
+    ('confirm', lambda i: (str(NOW), str(i), ''),
+     lambda items: Cookie.make_confirm_mac(*items),
+     lambda mac, items: Cookie.verify_confirm_mac(mac, *items)),
+    ('dated', lambda i: (str(NOW + 432000 + i),),
+     lambda items: Cookie.make_dated_mac(*items),
+     lambda mac, items: Cookie.verify_dated_mac(mac, *items)),
+    ('sender', lambda i: ('sender%d@example.org' % i,),
+     lambda items: Cookie.make_sender_mac(*items),
+     lambda mac, items: Cookie.verify_sender_mac(mac, *items)),
+    ('keyword', lambda i: ('keyword%d' % i,),
+     lambda items: Cookie.make_keyword_mac(*items),
+     lambda mac, items: Cookie.verify_keyword_mac(mac, *items)),
+    ]
+
+
+def configure(algorithm, rollover):
+    (algo, rounds) = (algorithm.split(':') + ['5'])[:2]
+    Defaults.HMAC_ALGO = Defaults.HMAC_ALGO_ROLLOVER = algo
+    Defaults.HMAC_ROUNDS = Defaults.HMAC_ROUNDS_ROLLOVER = int(rounds)
+    Defaults.HMAC_BYTES = Defaults.HMAC_BYTES_ROLLOVER = 5
+    Defaults.CRYPT_KEY_ROLLOVER = rollover
+    Defaults.COOKIE_CACHE = None
+    Defaults.COOKIE_CACHE_LEN = 0
+
+
+def rate(operation):
+    """Return the number of calls of operation(i) per second."""
+    ops = 0
+    start = time.time()
+    while ops < MIN_OPS or time.time() - start < MIN_TIME:
+        operation(ops)
+        ops += 1
+    return ops / (time.time() - start)
+
+
+def bench(algorithm, rollover_key):
+    rates = {}
+    for (kind, items, make, verify) in KINDS:
+        configure(algorithm, None)
+        # Derive the 'k2' subkeys outside of the timings.
+        make(items(0))
+        Defaults.HMAC_ENCODING_COMPAT = False
+        rates[kind, 'make'] = rate(lambda i: make(items(i)))
+        def check(mac, i):
+            assert verify(mac, items(i)), (kind, algorithm)
+        rates[kind, 'verify'] = rate(
+            lambda i: check(Cookie.tmda_mac_encode(
+                Cookie.tmda_mac_bytes(*items(i))), i))
+        Defaults.HMAC_ENCODING_COMPAT = True
+        rates[kind, 'legacy'] = rate(
+            lambda i: check(Cookie.tmda_mac_encode(
+                Cookie.tmda_mac_bytes(*items(i)), legacy=True), i))
+        Defaults.HMAC_ENCODING_COMPAT = False
+        configure(algorithm, rollover_key)
+        make(items(0))
+        Cookie.tmda_mac_bytes('', rollover=True)
+        rates[kind, 'rollover'] = rate(
+            lambda i: check(Cookie.tmda_mac_encode(
+                Cookie.tmda_mac_bytes(*items(i), rollover=True),
+                rollover=True), i))
+    return rates
+
+
+def main():
+    algorithms = sys.argv[1:] or DEFAULT_ALGORITHMS
+    rollover_key = bytes(reversed(Defaults.CRYPT_KEY))
+    # Each of the timed operations computes one HMAC (two for the
+    # rollover verifications) to build the cookie to verify; that time
+    # is not subtracted, so it is measured separately.
+    columns = ('make', 'verify', 'legacy', 'rollover')
+    summary = []
+    for algorithm in algorithms:
+        rates = bench(algorithm, rollover_key)
+        print('HMAC_ALGO %s' % algorithm)
+        print('  %-8s' % 'ops/s' + ''.join([ '%12s' % c for c in columns ]))
+        for (kind, items, make, verify) in KINDS:
+            print('  %-8s' % kind +
+                  ''.join([ '%12.1f' % rates[kind, c] for c in columns ]))
+        # Verifying also builds the cookie with one make.
+        make_ms = 1000 / rates['sender', 'make']
+        verify_ms = 1000 / rates['sender', 'verify'] - make_ms
+        rollover_ms = 1000 / rates['sender', 'rollover'] - make_ms
+        summary.append((algorithm, max(verify_ms, 0), max(rollover_ms, 0),
+                        make_ms))
+        print()
+    print('Projected overhead per message (ms)')
+    print('  %-14s%12s%12s%12s' % ('HMAC_ALGO', 'incoming', 'rollover',
+                                   'outgoing'))
+    for (algorithm, verify_ms, rollover_ms, make_ms) in summary:
+        print('  %-14s%12.3f%12.3f%12.3f' % (algorithm, verify_ms,
+                                             rollover_ms, make_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Time from-dbm lookups as the database grows.
+
+Usage: python bench-dbm.py [size ...]
+
+For each size (default 1000, 10000 and 100000 entries), a DBM database
+is built with Util.build_dbm and searched through a filter with two
+from-dbm rules on the same file.  Reported are the time to open the
+database, the time of a firstmatch call (which opens the database
+once), and the time of a single lookup, which should not depend on the
+size of the database.  Note that opening a dbm.dumb database (the
+fallback when neither gdbm nor ndbm is available) reads its whole
+index, so only the lookup column is flat with that module.
+
+Each operation is repeated for at least MIN_TIME seconds.
+"""
+
+import dbm
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import FilterParser
+from TMDA import Util
+
+
+MIN_TIME = 0.5
+MIN_OPS = 3
+
+
+def rate(operation):
+    """Return the time of a call of operation(i) in seconds."""
+    ops = 0
+    start = time.time()
+    while ops < MIN_OPS or time.time() - start < MIN_TIME:
+        operation(ops)
+        ops += 1
+    return (time.time() - start) / ops
+
+
+def build(tmpdir, size):
+    listfile = os.path.join(tmpdir, 'list-%d' % size)
+    fp = open(listfile, 'w')
+    for i in range(size):
+        fp.write('sender%d@example%d.com\n' % (i, i % 1000))
+    fp.close()
+    start = time.time()
+    Util.build_dbm(listfile)
+    return (listfile + '.dbm', time.time() - start)
+
+
+def bench(tmpdir, size):
+    (dbmfile, build_time) = build(tmpdir, size)
+    filterfile = os.path.join(tmpdir, 'filter-%d' % size)
+    fp = open(filterfile, 'w')
+    fp.write('from-dbm %s hold\nfrom-dbm %s ok\n' % (dbmfile, dbmfile))
+    fp.close()
+    parser = FilterParser.FilterParser()
+    parser.read(filterfile)
+
+    hit = ['sender%d@example%d.com' % (size - 1, (size - 1) % 1000)]
+    miss = ['nobody@nowhere.example']
+
+    per_open = rate(lambda i: dbm.open(dbmfile, 'r').close())
+    per_message = rate(lambda i: parser.firstmatch('recipient@example.com',
+                                                   list(miss)))
+
+    dbm_o = dbm.open(dbmfile, 'r')
+    keys = [ hit[0].encode(), miss[0].encode() ]
+    per_lookup = rate(lambda i: dbm_o.get(keys[i % 2]))
+    dbm_o.close()
+
+    actions = parser.firstmatch('recipient@example.com', list(hit))[0]
+    assert actions == {'incoming': ('hold', None)}, actions
+    print('%9d %10.2fs %14.1fus %14.1fus %14.2fus' % (size, build_time,
+                                                       per_open * 1e6,
+                                                       per_message * 1e6,
+                                                       per_lookup * 1e6))
+
+
+def main():
+    sizes = [ int(arg) for arg in sys.argv[1:] ] or [1000, 10000, 100000]
+    tmpdir = tempfile.mkdtemp(prefix='tmda-bench-dbm.')
+    try:
+        print('DBM module: %s' % dbm.whichdb(build(tmpdir, 1)[0]))
+        print('%9s %11s %16s %16s %16s' % ('entries', 'build', 'open',
+                                           'firstmatch', 'lookup'))
+        for size in sizes:
+            bench(tmpdir, size)
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+if __name__ == '__main__':
+    main()
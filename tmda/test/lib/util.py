@@ -1,6 +1,8 @@
+import atexit
 import os
 import shutil
 import sys
+import tempfile
 
 rootDir = '..'
 userDir = os.path.join('home', 'testuser')
@@ -27,9 +29,18 @@ def fixupPythonPath():
 def fixupHome():
     os.environ['HOME'] = userDir
 
+def fixupCache():
+    '''
+    Keep TMDA's caches out of the source tree.
+    '''
+    cacheDir = tempfile.mkdtemp(prefix='tmda-test-cache.')
+    atexit.register(shutil.rmtree, cacheDir, True)
+    os.environ['TMDA_CACHE_DIR'] = cacheDir
+
 def testPrep():
     fixupFiles()
     fixupHome()
+    fixupCache()
     fixupPythonPath()
 
 # Used to generate "bad" usernames and passwords.
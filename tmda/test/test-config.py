@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import Config
+from TMDA import Cookie
+from TMDA import Errors
+
+
+class Configs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-config.')
+        self.homes = {}
+        for (user, key) in (('alice', '01' * 20), ('bob', '02' * 20)):
+            home = os.path.join(self.tmpdir, user)
+            os.makedirs(os.path.join(home, '.tmda'))
+            self.writeFile(os.path.join(home, '.tmda', 'config'),
+                           'HOSTNAME = "%s.example.com"\n'
+                           'USERNAME = "%s"\n' % (user, user))
+            keyfile = os.path.join(home, '.tmda', 'crypt_key')
+            self.writeFile(keyfile, key + '\n')
+            os.chmod(keyfile, 0o600)
+            self.homes[user] = home
+        Config._configs.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+        Config._configs.clear()
+
+    def writeFile(self, pathname, text):
+        if os.path.exists(pathname):
+            # Make sure the change is seen within the same second.
+            st = os.stat(pathname)
+            os.utime(pathname, (st.st_atime - 10, st.st_mtime - 10))
+        fp = open(pathname, 'w')
+        fp.write(text)
+        fp.close()
+
+    def config(self, user):
+        return Config.get(HOME=self.homes[user], TMDARC='')
+
+    def testSettings(self):
+        hostname = Defaults.HOSTNAME
+        for user in ('alice', 'bob'):
+            with self.config(user).activate():
+                self.assertEqual(Defaults.HOSTNAME, '%s.example.com' % user)
+                self.assertEqual(Defaults.PENDING_DIR,
+                                 os.path.join(self.homes[user], '.tmda',
+                                              'pending'))
+                self.assertEqual(Defaults.__dict__['USERNAME'], user)
+                Defaults.DELIVERY = '_filter_'
+        self.assertEqual(Defaults.HOSTNAME, hostname)
+        self.assertEqual(self.config('alice').DELIVERY, '_filter_')
+
+    def testCookies(self):
+        macs = {}
+        for user in ('alice', 'bob'):
+            with self.config(user).activate():
+                macs[user] = Cookie.make_keyword_mac('test')
+                self.assertTrue(Cookie.verify_keyword_mac(macs[user], 'test'))
+        self.assertNotEqual(macs['alice'], macs['bob'])
+        with self.config('alice').activate():
+            self.assertFalse(Cookie.verify_keyword_mac(macs['bob'], 'test'))
+
+    def testThreads(self):
+        results = {}
+        def run(user):
+            with self.config(user).activate():
+                for i in range(100):
+                    if Defaults.USERNAME != user:
+                        results[user] = 'mixed up'
+                        return
+            results[user] = 'ok'
+        threads = [ threading.Thread(target=run, args=(user,))
+                    for user in ('alice', 'bob') ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {'alice': 'ok', 'bob': 'ok'})
+
+    def testEnvironUntouched(self):
+        # The settings are computed without changing os.environ, which
+        # other threads may be reading meanwhile.
+        environ = dict(os.environ)
+        seen = []
+        stop = threading.Event()
+        def watch():
+            while not stop.is_set():
+                if os.environ.get('HOME') != environ.get('HOME'):
+                    seen.append(os.environ.get('HOME'))
+        thread = threading.Thread(target=watch)
+        thread.start()
+        try:
+            for i in range(5):
+                Config._configs.clear()
+                config = self.config('alice')
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(seen[:1], [])
+        self.assertEqual(dict(os.environ), environ)
+        self.assertEqual(config.HOMEDIR, self.homes['alice'])
+        self.assertEqual(config.CRYPT_KEY_FILE,
+                         os.path.join(self.homes['alice'], '.tmda',
+                                      'crypt_key'))
+
+    def testCacheEnviron(self):
+        # HOSTNAME is computed from the environment.
+        self.writeFile(os.path.join(self.homes['alice'], '.tmda', 'config'),
+                       'USERNAME = "alice"\n')
+        for hostname in ('example.org', 'example.net'):
+            config = Config.get(HOME=self.homes['alice'], TMDARC='',
+                                QMAILHOST=hostname)
+            self.assertEqual(config.HOSTNAME, hostname)
+
+    def testCache(self):
+        config = self.config('alice')
+        self.assertTrue(self.config('alice') is config)
+        self.writeFile(os.path.join(self.homes['alice'], '.tmda', 'config'),
+                       'HOSTNAME = "changed.example.com"\n')
+        self.assertEqual(self.config('alice').HOSTNAME, 'changed.example.com')
+        size = Config.cache_size
+        Config.cache_size = 1
+        try:
+            self.config('bob')
+            self.assertEqual(len(Config._configs), 1)
+        finally:
+            Config.cache_size = size
+
+    def testMissingKey(self):
+        os.unlink(os.path.join(self.homes['bob'], '.tmda', 'crypt_key'))
+        self.assertRaises(Errors.ConfigError, self.config, 'bob')
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
@@ -1,9 +1,18 @@
+import dbm
+import hashlib
+import hmac
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 import sys
 
 import lib.util
 lib.util.testPrep()
 
+from TMDA import Address
+from TMDA import Defaults
 import TMDA.Cookie as Cookie
 
 class Cookies(unittest.TestCase):
@@ -135,6 +144,323 @@ class Cookies(unittest.TestCase):
             expected = 'TestUser-keyword-%s@example.com' % cookie
             self.assertEqual(calculated, expected)
 
+class VerifyCache(unittest.TestCase):
+    sender_address = 'sender@example.org'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-cookie.')
+        Defaults.COOKIE_CACHE = os.path.join(self.tmpdir, 'cookiecache')
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        self.computed = []
+        self.tmda_mac_bytes = Cookie.tmda_mac_bytes
+        def tmda_mac_bytes(*items, rollover=False):
+            self.computed.append((items, rollover))
+            return self.tmda_mac_bytes(*items, rollover=rollover)
+        Cookie.tmda_mac_bytes = tmda_mac_bytes
+
+    def tearDown(self):
+        Cookie.tmda_mac_bytes = self.tmda_mac_bytes
+        Defaults.COOKIE_CACHE = None
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        shutil.rmtree(self.tmpdir, True)
+
+    def testCached(self):
+        self.assertEqual(Cookie.verify_mac('nn0cfv94', self.sender_address),
+                         'current')
+        self.assertEqual(Cookie.verify_mac('c7795c', self.sender_address),
+                         'rollover')
+        self.assertEqual(Cookie.verify_mac('bad0bad0', self.sender_address),
+                         None)
+        self.assertEqual(len(self.computed), 5)
+        del self.computed[:]
+        self.assertTrue(Cookie.verify_sender_mac('NN0CFV94',
+                                                 self.sender_address))
+        self.assertTrue(Cookie.verify_sender_mac('c7795c',
+                                                 self.sender_address))
+        self.assertFalse(Cookie.verify_sender_mac('bad0bad0',
+                                                  self.sender_address))
+        self.assertEqual(self.computed, [])
+
+    def testStore(self):
+        self.assertTrue(Cookie.verify_sender_mac('nn0cfv94',
+                                                 self.sender_address))
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        del self.computed[:]
+        self.assertTrue(Cookie.verify_sender_mac('nn0cfv94',
+                                                 self.sender_address))
+        self.assertEqual(self.computed, [])
+
+    def testKeyChange(self):
+        self.assertTrue(Cookie.verify_sender_mac('nn0cfv94',
+                                                 self.sender_address))
+        crypt_key = Defaults.CRYPT_KEY
+        Defaults.CRYPT_KEY = b'\x01' * 20
+        try:
+            self.assertFalse(Cookie.verify_sender_mac('nn0cfv94',
+                                                      self.sender_address))
+        finally:
+            Defaults.CRYPT_KEY = crypt_key
+        self.assertEqual(len(self.computed), 3)
+
+    def testSize(self):
+        size = Defaults.COOKIE_CACHE_LEN
+        Defaults.COOKIE_CACHE_LEN = 2
+        try:
+            for i in range(4):
+                Cookie.verify_sender_mac('bad0bad0', 'sender%d@example.org' % i)
+            self.assertEqual(len(Cookie._failures), 2)
+        finally:
+            Defaults.COOKIE_CACHE_LEN = size
+
+    def testFailuresApart(self):
+        size = Defaults.COOKIE_CACHE_LEN
+        Defaults.COOKIE_CACHE_LEN = 2
+        try:
+            self.assertTrue(Cookie.verify_sender_mac('nn0cfv94',
+                                                     self.sender_address))
+            for i in range(4):
+                Cookie.verify_sender_mac('bad0bad0', 'sender%d@example.org' % i)
+            self.assertEqual(len(Cookie._cookies), 1)
+            db = dbm.open(Defaults.COOKIE_CACHE, 'r')
+            self.assertEqual(len(db), 1)
+            db.close()
+            del self.computed[:]
+            self.assertTrue(Cookie.verify_sender_mac('nn0cfv94',
+                                                     self.sender_address))
+            self.assertEqual(self.computed, [])
+        finally:
+            Defaults.COOKIE_CACHE_LEN = size
+
+
+class MakeCache(unittest.TestCase):
+    user_address = 'TestUser@example.com'
+
+    def setUp(self):
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        self.computed = []
+        self.tmda_mac_bytes = Cookie.tmda_mac_bytes
+        def tmda_mac_bytes(*items, rollover=False):
+            self.computed.append(items)
+            return self.tmda_mac_bytes(*items, rollover=rollover)
+        Cookie.tmda_mac_bytes = tmda_mac_bytes
+
+    def tearDown(self):
+        Cookie.tmda_mac_bytes = self.tmda_mac_bytes
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+
+    def testCached(self):
+        self.assertEqual(Cookie.make_sender_cookie('Sender@EXAMPLE.org'),
+                         'nn0cfv94')
+        self.assertEqual(Cookie.make_sender_cookie('sender@example.org'),
+                         'nn0cfv94')
+        self.assertTrue(Cookie.verify_sender_mac('nn0cfv94',
+                                                 'sender@example.org'))
+        self.assertEqual(self.computed, [('sender@example.org',)])
+
+    def testBatch(self):
+        senders = [ 'sender%d@example.org' % i for i in range(8) ]
+        addresses = Cookie.make_sender_addresses(self.user_address, senders,
+                                                 threads=4)
+        self.assertEqual(len(self.computed), len(senders))
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        self.assertEqual(addresses,
+                         [ Cookie.make_sender_address(self.user_address,
+                                                      sender)
+                           for sender in senders ])
+
+
+class KeySwitch(unittest.TestCase):
+    time = 1262937386
+    pid = 12345
+    sender_address = 'sender@example.org'
+    settings = ('CRYPT_KEY_SWITCH_TIME', 'HMAC_ALGO_ROLLOVER',
+                'HMAC_ROUNDS_ROLLOVER')
+
+    def setUp(self):
+        self.saved = dict([ (name, getattr(Defaults, name))
+                            for name in self.settings ])
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        self.computed = []
+        self.tmda_mac_bytes = Cookie.tmda_mac_bytes
+        def tmda_mac_bytes(*items, rollover=False):
+            self.computed.append(rollover)
+            return self.tmda_mac_bytes(*items, rollover=rollover)
+        Cookie.tmda_mac_bytes = tmda_mac_bytes
+
+    def tearDown(self):
+        Cookie.tmda_mac_bytes = self.tmda_mac_bytes
+        for (name, value) in self.saved.items():
+            setattr(Defaults, name, value)
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+
+    def testBeforeSwitch(self):
+        Defaults.CRYPT_KEY_SWITCH_TIME = self.time + 432001
+        self.assertTrue(Cookie.verify_confirm_mac('a45167', self.time,
+                                                  self.pid))
+        self.assertEqual(self.computed, [True])
+        del self.computed[:]
+        self.assertTrue(Cookie.verify_dated_mac('df2137', self.time+432000))
+        self.assertEqual(self.computed, [True])
+
+    def testAfterSwitch(self):
+        Defaults.CRYPT_KEY_SWITCH_TIME = self.time - 1
+        self.assertTrue(Cookie.verify_confirm_mac('05rib1ru', self.time,
+                                                  self.pid))
+        self.assertEqual(self.computed, [False])
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        del self.computed[:]
+        self.assertTrue(Cookie.verify_confirm_mac('a45167', self.time,
+                                                  self.pid))
+        self.assertEqual(self.computed, [False, True])
+
+    def testConcurrent(self):
+        Defaults.HMAC_ALGO_ROLLOVER = 'p2sha256'
+        Defaults.HMAC_ROUNDS_ROLLOVER = 3
+        mac = Cookie.tmda_mac_encode(
+            self.tmda_mac_bytes(self.sender_address, rollover=True),
+            rollover=True)
+        self.assertEqual(Cookie.verify_mac(mac, self.sender_address),
+                         'rollover')
+        self.assertEqual(sorted(self.computed), [False, True])
+        self.assertEqual(Cookie.verify_mac('nn0cfv94', self.sender_address),
+                         'current')
+
+
+class DerivedKey(unittest.TestCase):
+    sender_address = 'sender@example.org'
+    settings = ('HMAC_ALGO', 'HMAC_ROUNDS', 'CRYPT_KEY', 'CRYPT_KEY_FILE',
+                'HMAC_ALGO_ROLLOVER', 'HMAC_ROUNDS_ROLLOVER',
+                'HMAC_BYTES_ROLLOVER', 'CRYPT_KEY_ROLLOVER', 'CACHE_DIR')
+
+    def setUp(self):
+        self.saved = dict([ (name, getattr(Defaults, name))
+                            for name in self.settings ])
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-cookie.')
+        Defaults.CACHE_DIR = self.tmpdir
+        Cookie._subkeys.clear()
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+
+    def tearDown(self):
+        for (name, value) in self.saved.items():
+            setattr(Defaults, name, value)
+        Cookie._subkeys.clear()
+        Cookie._cookies.clear()
+        Cookie._failures.clear()
+        shutil.rmtree(self.tmpdir, True)
+
+    def testSubkey(self):
+        Defaults.HMAC_ALGO = 'k2sha256'
+        Defaults.HMAC_ROUNDS = 3
+        subkey = hashlib.pbkdf2_hmac('sha256', Defaults.CRYPT_KEY, b'TMDA',
+                                     1000)
+        expected = hmac.new(subkey, self.sender_address.encode(),
+                            'sha256').digest()
+        self.assertEqual(Cookie.tmda_mac_bytes(self.sender_address), expected)
+        mac = Cookie.make_sender_mac(self.sender_address)
+        self.assertTrue(Cookie.verify_sender_mac(mac, self.sender_address))
+        # The subkey is read back from CACHE_DIR, unless made from another key.
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir, 'keys'))), 1)
+        Cookie._subkeys.clear()
+        self.assertEqual(Cookie.tmda_subkey(Defaults.CRYPT_KEY, 'sha256', 3,
+                                            Defaults.CRYPT_KEY_FILE), subkey)
+        Cookie._subkeys.clear()
+        self.assertNotEqual(Cookie.tmda_subkey(b'\x01' * 20, 'sha256', 3,
+                                               Defaults.CRYPT_KEY_FILE),
+                            subkey)
+
+    def testSubkeyFileMode(self):
+        subkey = Cookie.tmda_subkey(Defaults.CRYPT_KEY, 'sha256', 3,
+                                    Defaults.CRYPT_KEY_FILE)
+        keysdir = os.path.join(self.tmpdir, 'keys')
+        cachefile = os.path.join(keysdir, os.listdir(keysdir)[0])
+        self.assertEqual(os.stat(cachefile).st_mode & 0o777, 0o600)
+        # A subkey file others can read isn't used, but replaced.
+        os.chmod(cachefile, 0o644)
+        Cookie._subkeys.clear()
+        pbkdf2_hmac = hashlib.pbkdf2_hmac
+        derived = []
+        def count(*args):
+            derived.append(args)
+            return pbkdf2_hmac(*args)
+        hashlib.pbkdf2_hmac = count
+        try:
+            self.assertEqual(Cookie.tmda_subkey(Defaults.CRYPT_KEY, 'sha256',
+                                                3, Defaults.CRYPT_KEY_FILE),
+                             subkey)
+        finally:
+            hashlib.pbkdf2_hmac = pbkdf2_hmac
+        self.assertEqual(len(derived), 1)
+        self.assertEqual(os.stat(cachefile).st_mode & 0o777, 0o600)
+
+    def testRollover(self):
+        # Switch to k2sha256 along a new key, the old key and p2sha256
+        # becoming the rollover ones.
+        Defaults.CRYPT_KEY_ROLLOVER = Defaults.CRYPT_KEY
+        Defaults.HMAC_ALGO_ROLLOVER = Defaults.HMAC_ALGO
+        Defaults.HMAC_ROUNDS_ROLLOVER = Defaults.HMAC_ROUNDS
+        Defaults.HMAC_BYTES_ROLLOVER = Defaults.HMAC_BYTES
+        Defaults.CRYPT_KEY = b'\x01' * 20
+        Defaults.CRYPT_KEY_FILE = None
+        Defaults.HMAC_ALGO = 'k2sha256'
+        self.assertEqual(Cookie.verify_mac('nn0cfv94', self.sender_address),
+                         'rollover')
+        mac = Cookie.make_sender_mac(self.sender_address)
+        self.assertNotEqual(mac, 'nn0cfv94')
+        self.assertEqual(Cookie.verify_mac(mac, self.sender_address),
+                         'current')
+
+
+class Addresses(unittest.TestCase):
+    user_address = 'testuser@example.com'
+
+    def testDated(self):
+        addr = Address.DatedAddress().create(self.user_address, '1d')
+        addr = Address.Factory(str(addr))
+        self.assertEqual(addr.verify(), 'current')
+        addr = Address.Factory(str(addr).replace(addr.hmac(), 'bad0bad0'))
+        self.assertRaises(Address.BadCryptoError, addr.verify)
+        addr = Address.Factory('testuser-dated-1263369386.st6b94yp@example.com')
+        self.assertRaises(Address.ExpiredAddressError, addr.verify)
+
+    def testKey(self):
+        addr = Address.Factory('testuser-keyword-keywordtest.243548@example.com')
+        self.assertEqual(addr.verify(), 'rollover')
+        addr = Address.Factory('testuser-sender-nn0cfv94@example.com')
+        self.assertRaises(Address.BadCryptoError, addr.verify,
+                          'x@example.org')
+        self.assertEqual(addr.verify('Sender@example.org'), 'current')
+
+    def testBatch(self):
+        program = os.path.join(lib.util.rootDir, 'bin', 'tmda-check-address')
+        dated = Address.DatedAddress().create(self.user_address, '1d')
+        lines = [str(dated),
+                 'testuser-keyword-keywordtest.243548@example.com',
+                 'testuser-sender-nn0cfv94@example.com\tx@example.org',
+                 'testuser@example.com']
+        environ = dict(os.environ)
+        environ['PYTHONPATH'] = os.path.abspath(lib.util.rootDir)
+        out = subprocess.check_output([sys.executable, program, '-b',
+                                       '-j', '2'], env=environ,
+                                      input='\n'.join(lines).encode())
+        results = [ line.split('\t') for line in out.decode().splitlines() ]
+        self.assertEqual(results[0], [str(dated), 'dated', 'valid',
+                                      dated.timestamp(), 'current', ''])
+        self.assertEqual(results[1][1:5], ['keyword', 'valid', '',
+                                           'rollover'])
+        self.assertEqual(results[2][1:3], ['sender', 'invalid'])
+        self.assertEqual(results[3][1:3], ['', 'invalid'])
+
+
 class Fingerprints(unittest.TestCase):
     def testFingerprint(self):
         headers = ['foo', 'bar', 'baz', '012456789', ' ' * 40]
@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+
+
+class ConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-defaults.')
+        self.home = os.path.join(self.tmpdir, 'home')
+        userdir = os.path.join(lib.util.userDir, '.tmda')
+        os.makedirs(os.path.join(self.home, '.tmda'))
+        for name in ('crypt_key', 'crypt_key.rollover'):
+            shutil.copy(os.path.join(userdir, name),
+                        os.path.join(self.home, '.tmda'))
+        self.config = os.path.join(self.home, '.tmda', 'config')
+        self.writeConfig('CONFIG_CACHE_SNAPSHOT = True\n'
+                         'HOSTNAME = "example.com"\n')
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def writeConfig(self, text):
+        if os.path.exists(self.config):
+            # Make sure the change is seen within the same second.
+            st = os.stat(self.config)
+            os.utime(self.config, (st.st_atime - 10, st.st_mtime - 10))
+        fp = open(self.config, 'w')
+        fp.write(text)
+        fp.close()
+
+    def load(self, *names, **variables):
+        environ = dict(os.environ, **variables)
+        environ.update({'HOME': self.home,
+                        'TMDA_CACHE_DIR': self.cachedir,
+                        'PYTHONPATH': os.path.abspath(lib.util.rootDir)})
+        environ.pop('TMDARC', None)
+        names = ('_snapshot_loaded',) + names
+        program = ('from TMDA import Defaults\n'
+                   'for name in %r:\n'
+                   '    print(repr(getattr(Defaults, name)))\n' % (names,))
+        out = subprocess.check_output([sys.executable, '-c', program],
+                                      env=environ)
+        return [ eval(line) for line in out.decode().splitlines() ]
+
+    def testCodeCache(self):
+        code = Defaults._config_code(self.config)
+        cachefile = Defaults._config_cachefile(self.config, '.code')
+        self.assertTrue(os.path.exists(cachefile))
+        self.assertEqual(Defaults._config_code(self.config), code)
+        self.writeConfig('HOSTNAME = "example.net"\n')
+        namespace = {}
+        exec(Defaults._config_code(self.config), namespace)
+        self.assertEqual(namespace['HOSTNAME'], 'example.net')
+
+    def testSnapshot(self):
+        first = self.load('HOSTNAME', 'PENDING_DIR', 'CRYPT_KEY')
+        self.assertEqual(first[0], False)
+        self.assertEqual(first[1], 'example.com')
+        second = self.load('HOSTNAME', 'PENDING_DIR', 'CRYPT_KEY')
+        self.assertEqual(second, [True] + first[1:])
+        self.writeConfig('CONFIG_CACHE_SNAPSHOT = True\n'
+                         'HOSTNAME = "example.net"\n'
+                         'DATADIR = "~/tmda"\n'
+                         'CRYPT_KEY_FILE = "~/.tmda/crypt_key"\n')
+        third = self.load('HOSTNAME', 'PENDING_DIR')
+        self.assertEqual(third, [False, 'example.net',
+                                 os.path.join(self.home, 'tmda', 'pending')])
+
+    def testSnapshotEnviron(self):
+        # HOSTNAME is computed from the environment.
+        self.writeConfig('CONFIG_CACHE_SNAPSHOT = True\n')
+        self.assertEqual(self.load('HOSTNAME', QMAILHOST='example.org'),
+                         [False, 'example.org'])
+        self.assertEqual(self.load('HOSTNAME', QMAILHOST='example.org'),
+                         [True, 'example.org'])
+        self.assertEqual(self.load('HOSTNAME', QMAILHOST='example.net'),
+                         [False, 'example.net'])
+
+    def testNoSnapshot(self):
+        self.writeConfig('HOSTNAME = "example.com"\n')
+        for i in range(2):
+            self.assertEqual(self.load('HOSTNAME'), [False, 'example.com'])
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
@@ -0,0 +1,109 @@
+import mailbox
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import lib.util
+lib.util.testPrep()
+
+
+messages = [
+    b'Return-Path: <friend@example.org>\nDelivered-To: testuser@example.com\n'
+    b'From: friend@example.org\nSubject: one\n\nHello\n',
+    b'Return-Path: <x@spam.example>\nDelivered-To: testuser@example.com\n'
+    b'From: x@spam.example\nSubject: two\n\nBuy now\n',
+    b'Return-Path: <stranger@example.net>\n'
+    b'Delivered-To: testuser@example.com\n'
+    b'From: stranger@example.net\nSubject: three\n\nThe secret word\n',
+    ]
+
+
+class FilterBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-filter-batch.')
+        self.home = os.path.join(self.tmpdir, 'home')
+        userdir = os.path.join(lib.util.userDir, '.tmda')
+        os.makedirs(os.path.join(self.home, '.tmda', 'filters'))
+        for name in ('config', 'crypt_key', 'crypt_key.rollover'):
+            shutil.copy(os.path.join(userdir, name),
+                        os.path.join(self.home, '.tmda'))
+        fp = open(os.path.join(self.home, '.tmda', 'filters', 'incoming'), 'w')
+        fp.write('from *@spam.example drop\n'
+                 'body "secret" hold\n'
+                 'from friend@example.org ok\n')
+        fp.close()
+        self.environ = dict(os.environ)
+        self.environ.update({'HOME': self.home,
+                             'PYTHONPATH': os.path.abspath(lib.util.rootDir)})
+        self.maildir = mailbox.Maildir(os.path.join(self.tmpdir, 'Maildir'))
+        self.mbox = mailbox.mbox(os.path.join(self.tmpdir, 'mbox'))
+        self.keys = [ self.maildir.add(message) for message in messages ]
+        for message in messages:
+            self.mbox.add(message)
+        self.mbox.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def run_batch(self, *args):
+        program = os.path.join(lib.util.rootDir, 'bin', 'tmda-filter-batch')
+        process = subprocess.Popen([sys.executable, program] + list(args),
+                                   env=self.environ,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        (out, err) = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        self.assertTrue(err.decode().startswith('%d messages in '
+                                                % len(messages)))
+        return [ line.split('\t') for line in out.decode().splitlines() ]
+
+    def pending(self):
+        pending_dir = os.path.join(self.home, '.tmda', 'pending')
+        if not os.path.isdir(pending_dir):
+            return []
+        return [ name for name in os.listdir(pending_dir)
+                 if name.endswith('.msg') ]
+
+    def testMaildir(self):
+        results = self.run_batch('-n', '-j', '2',
+                                 os.path.join(self.tmpdir, 'Maildir'))
+        results = dict([ (result[0], result[1:]) for result in results ])
+        self.assertEqual(sorted(results), sorted(self.keys))
+        self.assertEqual(results[self.keys[0]],
+                         ['friend@example.org', 'testuser@example.com', '0',
+                          'OK (from friend@example.org ok)'])
+        self.assertEqual(results[self.keys[1]][2:],
+                         ['99', 'DROP (from *@spam.example drop)'])
+        self.assertEqual(results[self.keys[2]][2], '99')
+        self.assertTrue(results[self.keys[2]][3].startswith(
+            'HOLD (body "secret" hold); HOLD pending '))
+        self.assertEqual(self.pending(), [])
+
+    def testMbox(self):
+        envelope = os.path.join(self.tmpdir, 'envelope')
+        fp = open(envelope, 'w')
+        fp.write('0\tx@spam.example\ttestuser@example.com\n')
+        fp.close()
+        results = self.run_batch('-n', '-j', '1', '-E', envelope,
+                                 '-s', 'someone@example.net',
+                                 os.path.join(self.tmpdir, 'mbox'))
+        self.assertEqual([ result[0] for result in results ], ['0', '1', '2'])
+        self.assertEqual(results[0][4], 'DROP (from *@spam.example drop)')
+        self.assertEqual(results[0][1], 'x@spam.example')
+        self.assertEqual(results[1][1:3], ['someone@example.net',
+                                           'testuser@example.com'])
+        self.assertEqual(results[1][4], 'DROP (from *@spam.example drop)')
+        self.assertTrue(results[2][4].startswith(
+            'HOLD (body "secret" hold); HOLD pending '))
+
+    def testHold(self):
+        self.run_batch('-j', '2', os.path.join(self.tmpdir, 'Maildir'))
+        self.assertEqual(len(self.pending()), 1)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
@@ -0,0 +1,417 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import FilterParser
+from TMDA import Util
+
+
+class FilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-filter.')
+        self.cachedir = Defaults.CACHE_DIR
+        Defaults.CACHE_DIR = os.path.join(self.tmpdir, 'cache')
+        FilterParser._parsed.clear()
+
+    def tearDown(self):
+        Defaults.CACHE_DIR = self.cachedir
+        shutil.rmtree(self.tmpdir, True)
+        FilterParser._parsed.clear()
+
+    def writeFile(self, name, text):
+        pathname = os.path.join(self.tmpdir, name)
+        fp = open(pathname, 'w')
+        fp.write(text)
+        fp.close()
+        return pathname
+
+    def parse(self, filename):
+        parser = FilterParser.FilterParser()
+        parser.read(filename)
+        return parser
+
+    def rules(self, filename):
+        return [ rule[:3] for rule in self.parse(filename).filterlist ]
+
+    def match(self, filename, sender):
+        return self.parse(filename).firstmatch('testuser@example.com',
+                                               [sender])[0]
+
+
+class FilterCache(FilterTestCase):
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.included = self.writeFile('included',
+                                       'from *@include.example ok\n')
+        self.filter = self.writeFile('incoming',
+            'macro FRIENDS(a) from a ok\n'
+            'FRIENDS(*@example.org)\n'
+            'to ${TMDA_TEST_FILTER_VAR}@example.com hold\n'
+            'include %s\n'
+            'include -optional %s\n'
+            % (self.included, os.path.join(self.tmpdir, 'missing')))
+        os.environ['TMDA_TEST_FILTER_VAR'] = 'hold'
+
+    def tearDown(self):
+        del os.environ['TMDA_TEST_FILTER_VAR']
+        FilterTestCase.tearDown(self)
+
+    def rewriteSameStamp(self, pathname, text):
+        # Change the contents without changing inode, size or mtime.
+        st = os.stat(pathname)
+        fp = open(pathname, 'r+')
+        fp.write(text)
+        fp.close()
+        os.utime(pathname, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def touch(self, pathname):
+        st = os.stat(pathname)
+        os.utime(pathname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def testCacheMatchesParse(self):
+        expected = [('from', {}, '*@example.org'),
+                    ('to', {}, 'hold@example.com'),
+                    ('from', {}, '*@include.example')]
+        self.assertEqual(self.rules(self.filter), expected)
+        cachedir = os.path.join(Defaults.CACHE_DIR, 'filters')
+        self.assertEqual(len(os.listdir(cachedir)), 1)
+        # From the process cache, then from the disk cache.
+        self.assertEqual(self.rules(self.filter), expected)
+        FilterParser._parsed.clear()
+        self.assertEqual(self.rules(self.filter), expected)
+        self.assertEqual(self.match(self.filter, 'x@include.example'),
+                         {'incoming': ('ok', None)})
+
+    def testCacheIsUsed(self):
+        self.rules(self.filter)
+        self.rewriteSameStamp(self.included, 'from *@include.elpmaxe ok\n')
+        FilterParser._parsed.clear()
+        self.assertEqual(self.rules(self.filter)[2][2], '*@include.example')
+
+    def testIncludeChanged(self):
+        self.rules(self.filter)
+        self.rewriteSameStamp(self.included, 'from *@include.elpmaxe ok\n')
+        self.touch(self.included)
+        self.assertEqual(self.rules(self.filter)[2][2], '*@include.elpmaxe')
+
+    def testOptionalIncludeAppears(self):
+        self.assertEqual(len(self.rules(self.filter)), 3)
+        self.writeFile('missing', 'from *@late.example drop\n')
+        self.assertEqual(len(self.rules(self.filter)), 4)
+
+    def testVariableChanged(self):
+        self.rules(self.filter)
+        os.environ['TMDA_TEST_FILTER_VAR'] = 'other'
+        self.assertEqual(self.rules(self.filter)[1][2], 'other@example.com')
+
+    def testActionsNotShared(self):
+        listfile = self.writeFile('list', 'friend@example.net drop\n')
+        filter = self.writeFile('actions', 'from-file %s ok\n' % listfile)
+        self.assertEqual(self.match(filter, 'friend@example.net'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.match(filter, 'other@example.net'), {})
+        self.assertEqual(self.parse(filter).filterlist[0][3],
+                         {'incoming': ('ok', None)})
+
+    def testNoCache(self):
+        cachedir = Defaults.CACHE_DIR
+        Defaults.CACHE_DIR = None
+        self.assertEqual(len(self.rules(self.filter)), 3)
+        FilterParser._parsed.clear()
+        self.assertEqual(len(self.rules(self.filter)), 3)
+        self.assertFalse(os.path.exists(cachedir))
+
+    def testRelativeFilename(self):
+        cwd = os.getcwd()
+        try:
+            for name in ('a', 'b'):
+                os.mkdir(os.path.join(self.tmpdir, name))
+                self.writeFile(os.path.join(name, 'relative'),
+                               'from *@%s.example ok\n' % name)
+            for name in ('a', 'b'):
+                os.chdir(os.path.join(self.tmpdir, name))
+                FilterParser._parsed.clear()
+                self.assertEqual(self.rules('relative')[0][2],
+                                 '*@%s.example' % name)
+        finally:
+            os.chdir(cwd)
+
+    def testSaveFailed(self):
+        rename = os.rename
+        def fail(src, dst):
+            raise OSError('no space left')
+        os.rename = fail
+        try:
+            self.rules(self.filter)
+        finally:
+            os.rename = rename
+        cachedir = os.path.join(Defaults.CACHE_DIR, 'filters')
+        self.assertEqual(os.listdir(cachedir), [])
+
+    def testParsingErrorNotCached(self):
+        filter = self.writeFile('broken', 'frm *@example.org ok\n')
+        for i in range(2):
+            self.assertRaises(FilterParser.ParsingError, self.parse, filter)
+
+
+class Wildcards(unittest.TestCase):
+    patterns = [
+        'jdoe@example.com exact',
+        '*@example.org domain',
+        '*@=example.net subdomains',
+        'list-*@lists.example.com local',
+        '*@*.example.*',
+        'jdoe@example.org shadowed',
+        '*jdoe*',
+    ]
+
+    def findmatch(self, *addrs):
+        return Util.findmatch(self.patterns, addrs)
+
+    def testShapes(self):
+        self.assertEqual(self.findmatch('JDoe@Example.COM'), 'exact')
+        self.assertEqual(self.findmatch('x@example.org'), 'domain')
+        self.assertEqual(self.findmatch('x@sub.example.org'), 1)
+        self.assertEqual(self.findmatch('x@example.net'), 'subdomains')
+        self.assertEqual(self.findmatch('x@a.b.example.net'), 'subdomains')
+        self.assertEqual(self.findmatch('x@badexample.net'), None)
+        self.assertEqual(self.findmatch('list-foo@lists.example.com'), 'local')
+        self.assertEqual(self.findmatch('list-foo@example.com'), None)
+        self.assertEqual(self.findmatch('x@www.example.de'), 1)
+        self.assertEqual(self.findmatch('example.org'), None)
+
+    def testFirstMatchWins(self):
+        # An earlier pattern of another shape takes precedence.
+        self.assertEqual(self.findmatch('jdoe@example.org'), 'domain')
+        self.assertEqual(self.findmatch('jdoe@example.de'), 1)
+        self.assertEqual(self.findmatch(None, 'jdoe@x.com',
+                                        'x@example.org'), 1)
+        self.assertEqual(Util.findmatch(['*@*.example.com a',
+                                         'x@y.example.com b'],
+                                        ['x@y.example.com']), 'a')
+
+    def testSeveralWildcards(self):
+        patterns = ['*jdoe* a', '*@*.example.* b', 'a*b*c@* c']
+        self.assertEqual(Util.findmatch(patterns, ['xjdoey@z.com']), 'a')
+        self.assertEqual(Util.findmatch(patterns, ['x@y.example.de']), 'b')
+        self.assertEqual(Util.findmatch(patterns, ['axbyc@z.com']), 'c')
+        # Python 3.9 and 3.10 translate several '*' into groups.
+        translate = Util.fnmatch.translate
+        try:
+            Util.fnmatch.translate = lambda p: '(?:(%s))' % translate(p)
+            self.assertEqual(Util.findmatch(patterns, ['xjdoey@z.com']), 'a')
+            self.assertEqual(Util.findmatch(patterns, ['axbyc@z.com']), 'c')
+        finally:
+            Util.fnmatch.translate = translate
+
+    def testMatcherReuse(self):
+        matcher = Util.WildcardMatcher(self.patterns)
+        for i in range(2):
+            self.assertEqual(matcher.findmatch(['x@example.net']),
+                             'subdomains')
+
+
+class AutoIndex(FilterTestCase):
+    lines = Wildcards.patterns + ['JSmith@Example.COM deliver=~/Mail/JSmith']
+
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.list = self.writeFile('list', '\n'.join(self.lines) + '\n')
+        self.filter = self.writeFile('incoming',
+                                     'from-file -autoindex %s ok\n' % self.list)
+
+    def testIndexMatchesList(self):
+        self.assertTrue(Util.build_index(self.list))
+        index = Util.ListIndex(self.list + '.idx')
+        lines = [ FilterParser._lowerfirst(line) for line in self.lines ]
+        for address in ('jdoe@example.com', 'x@example.org', 'x@example.net',
+                        'x@a.b.example.net', 'x@badexample.net',
+                        'list-foo@lists.example.com', 'jdoe@example.org',
+                        'x@www.example.de', 'nobody@nowhere.com',
+                        'jsmith@example.com'):
+            self.assertEqual(index.findmatch([address]),
+                             Util.findmatch(lines, [address]))
+
+    def testAutoIndex(self):
+        self.writeFile('list', '*@=example.net\n' + self.lines[-1] + '\n')
+        self.assertEqual(self.match(self.filter, 'JSmith@example.com'),
+                         {'incoming': ('deliver', '~/Mail/JSmith')})
+        self.assertTrue(os.path.exists(self.list + '.idx'))
+        self.assertEqual(self.match(self.filter, 'x@sub.example.net'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.match(self.filter, 'x@example.com'), {})
+
+    def testRebuild(self):
+        self.match(self.filter, 'x@example.com')
+        st = os.stat(self.list)
+        self.writeFile('list', 'x@example.com\n')
+        os.utime(self.list, (st.st_atime + 10, st.st_mtime + 10))
+        self.assertEqual(self.match(self.filter, 'x@example.com'),
+                         {'incoming': ('ok', None)})
+
+
+class Dbm(FilterTestCase):
+    def testDbmLookups(self):
+        listfile = self.writeFile('list', 'a@example.com\n'
+                                          '*@example.org\n'
+                                          'example.net drop\n')
+        self.assertTrue(Util.build_dbm(listfile))
+        filter = self.writeFile('incoming',
+                                'from-dbm %s.dbm hold\n'
+                                'from-file -autodbm %s ok\n'
+                                % (listfile, listfile))
+        parser = self.parse(filter)
+        for (sender, actions) in (('A@example.com', ('hold', None)),
+                                  ('x@example.net', ('drop', None)),
+                                  ('x@example.org', None)):
+            found = parser.firstmatch('testuser@example.com', [sender])[0]
+            self.assertEqual(found.get('incoming'), actions)
+            self.assertEqual(parser.dbm_handles, {})
+
+
+class Content(FilterTestCase):
+    body = b'Hello,\nBuy cheap VIAGRA now!\nRegards\n'
+    headers = b'Subject: offer\nX-Spam-Flag: YES\n'
+
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.phrases = self.writeFile('phrases', 'lottery\n"cheap viagra"\n')
+
+    def matchContent(self, rules):
+        filter = self.writeFile('incoming', rules)
+        parser = self.parse(filter)
+        return parser.firstmatch('testuser@example.com', ['x@example.com'],
+                                 self.body, self.headers, len(self.body))
+
+    def testFirstRuleWins(self):
+        (actions, line) = self.matchContent(
+            'body "nothing here" drop\n'
+            'headers "^X-Spam-Flag: YES" hold\n'
+            'body-file %s bounce\n'
+            'body "buy" ok\n' % self.phrases)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        (actions, line) = self.matchContent(
+            'body "regards$" ok\n'
+            'body-file %s bounce\n' % self.phrases)
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+        self.assertEqual(line, 'body "regards$" ok')
+
+    def testCase(self):
+        (actions, line) = self.matchContent(
+            'body -case "cheap viagra" drop\n'
+            'body-file -case %s hold\n'
+            'body "Cheap Viagra" ok\n' % self.phrases)
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+
+    def testBackreference(self):
+        (actions, line) = self.matchContent(
+            'body "(l)\\1" drop\n'
+            'body "zzz|(?P<x>o)" ok\n')
+        self.assertEqual(actions, {'incoming': ('drop', None)})
+
+    def testGlobalFlag(self):
+        # (?s) must not apply to the expressions of the other rules.
+        self.body = b'foo\nbar\n'
+        (actions, line) = self.matchContent(
+            'body "foo.bar" drop\n'
+            'body "(?s)zzz" ok\n')
+        self.assertEqual(actions, {})
+        scanner = FilterParser._ContentScanner([(0, False, 'foo.bar'),
+                                                (1, False, '(?s)zzz')])
+        self.assertEqual([ ruleno for (ruleno, regex) in scanner.singles ],
+                         [1])
+
+    def testScannersBounded(self):
+        for i in range(FilterParser._scanners_len + 5):
+            self.matchContent('body "rule%d" ok\n' % i)
+        self.assertEqual(len(FilterParser._scanners),
+                         FilterParser._scanners_len)
+
+    def testMissingFile(self):
+        missing = os.path.join(self.tmpdir, 'missing')
+        (actions, line) = self.matchContent(
+            'body-file -optional %s drop\n'
+            'body "buy" ok\n'
+            'body-file %s hold\n' % (missing, missing))
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+        self.assertRaises(IOError, self.matchContent,
+                          'body-file %s hold\n'
+                          'body "buy" ok\n' % missing)
+
+    def testBadExpression(self):
+        bad = self.writeFile('bad', 'hello\nbad(\n')
+        (actions, line) = self.matchContent('body-file %s hold\n' % bad)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        self.assertRaises(re.error, self.matchContent,
+                          'body "nothing" ok\n'
+                          'headers-file %s hold\n' % bad)
+
+
+class RawMessage(unittest.TestCase):
+    raw = (b'From jdoe@example.com Mon Jan  1 00:00:00 2001\n'
+           b'From: jdoe@example.com\n'
+           b'Subject: hello\n'
+           b'\n'
+           b'Body\n\nmore\n')
+
+    def testSplit(self):
+        rawin = Util.RawMessage(self.raw)
+        self.assertEqual(bytes(rawin.headers),
+                         b'From: jdoe@example.com\nSubject: hello\n')
+        self.assertEqual(bytes(rawin.body), b'Body\n\nmore\n')
+        self.assertEqual(rawin.size, len(self.raw))
+        rawin = Util.RawMessage(b'Subject: no body\n')
+        self.assertEqual(bytes(rawin.headers), b'Subject: no body\n')
+        self.assertEqual(bytes(rawin.body), b'')
+
+    def testNoSeparator(self):
+        # As with the email parser, the first line which isn't a header
+        # starts the body.
+        raw = (b'From: jdoe@example.com\n'
+               b'Subject: hello\n'
+               b' world\n'
+               b'Body without a separator\n'
+               b'X-Not-A-Header: body\n')
+        rawin = Util.RawMessage(raw)
+        self.assertEqual(bytes(rawin.headers),
+                         b'From: jdoe@example.com\nSubject: hello\n world\n')
+        self.assertEqual(bytes(rawin.body),
+                         b'Body without a separator\nX-Not-A-Header: body\n')
+        msg = rawin.headers_message()
+        self.assertEqual(msg.keys(), ['From', 'Subject'])
+        self.assertEqual(rawin.message().get_payload(),
+                         bytes(rawin.body).decode())
+        rawin = Util.RawMessage(b'Subject: crlf\r\n\r\nBody\r\n')
+        self.assertEqual(bytes(rawin.headers), b'Subject: crlf\r\n')
+        self.assertEqual(bytes(rawin.body), b'Body\r\n')
+
+    def testMessage(self):
+        rawin = Util.RawMessage(self.raw)
+        msg = rawin.headers_message()
+        self.assertEqual(msg['subject'], 'hello')
+        msg['X-TMDA-Action'] = 'OK'
+        msg = rawin.message(msg)
+        self.assertEqual(msg['X-TMDA-Action'], 'OK')
+        self.assertEqual(msg.get_payload(), 'Body\n\nmore\n')
+        self.assertTrue(rawin.message(msg) is msg)
+
+    def testFilterViews(self):
+        rawin = Util.RawMessage(self.raw)
+        filter = FilterParser.FilterParser()
+        filter.filterlist = [('headers', {}, '^subject: hello$',
+                              {'incoming': ('ok', None)}, 1)]
+        (actions, line) = filter.firstmatch('testuser@example.com', [],
+                                            rawin.body, rawin.headers,
+                                            rawin.size)
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
@@ -0,0 +1,111 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import lib.util
+lib.util.testPrep()
+
+
+message = b'From: sender@example.org\nSubject: hi\n\nThe secret word\n'
+
+
+class FilterServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-filterd.')
+        self.home = os.path.join(self.tmpdir, 'home')
+        userdir = os.path.join(lib.util.userDir, '.tmda')
+        os.makedirs(os.path.join(self.home, '.tmda', 'filters'))
+        for name in ('config', 'crypt_key', 'crypt_key.rollover'):
+            shutil.copy(os.path.join(userdir, name),
+                        os.path.join(self.home, '.tmda'))
+        self.writeFilter('from *@spam.example drop\nbody "secret" ok\n')
+        self.socket = os.path.join(self.tmpdir, 'sock')
+        self.environ = dict(os.environ)
+        self.environ.update({'HOME': self.home,
+                             'PYTHONPATH': os.path.abspath(lib.util.rootDir),
+                             'RECIPIENT': 'testuser@example.com',
+                             'TMDA_FILTERD_SOCKET': self.socket})
+        self.server = subprocess.Popen(
+            [sys.executable, self.program('tmda-filterd'), '-f',
+             '-s', self.socket], env=self.environ)
+        for i in range(50):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.tmpdir, True)
+
+    def program(self, name):
+        return os.path.join(lib.util.rootDir, 'bin', name)
+
+    def writeFilter(self, text):
+        pathname = os.path.join(self.home, '.tmda', 'filters', 'incoming')
+        if os.path.exists(pathname):
+            # Make sure the change is seen within the same second.
+            st = os.stat(pathname)
+            os.utime(pathname, (st.st_atime - 10, st.st_mtime - 10))
+        fp = open(pathname, 'w')
+        fp.write(text)
+        fp.close()
+
+    def run_filter(self, program, sender):
+        environ = dict(self.environ)
+        environ['SENDER'] = sender
+        process = subprocess.Popen([sys.executable, self.program(program),
+                                    '-p'], env=environ,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        (out, err) = process.communicate(message)
+        return (process.returncode, out)
+
+    def testSameAsFilter(self):
+        for sender in ('sender@example.org', 'x@spam.example'):
+            self.assertEqual(self.run_filter('tmda-filter-client', sender),
+                             self.run_filter('tmda-filter', sender))
+        (status, out) = self.run_filter('tmda-filter-client',
+                                        'sender@example.org')
+        self.assertEqual(status, 0)
+        self.assertTrue(out.endswith(b'\n\nThe secret word\n'))
+
+    def testFilterChanged(self):
+        self.assertEqual(self.run_filter('tmda-filter-client',
+                                         'sender@example.org')[0], 0)
+        self.writeFilter('body "secret" drop\n')
+        self.assertEqual(self.run_filter('tmda-filter-client',
+                                         'sender@example.org')[0], 99)
+
+    def testHostnameChanged(self):
+        # HOSTNAME comes from the environment of each delivery.
+        config = os.path.join(self.home, '.tmda', 'config')
+        lines = open(config).readlines()
+        fp = open(config, 'w')
+        fp.writelines([ line for line in lines
+                        if not line.startswith('HOSTNAME') ])
+        fp.close()
+        self.writeFilter('from *@${HOSTNAME} ok\nfrom *@* drop\n')
+        for (hostname, status) in (('example.org', 0),
+                                   ('elsewhere.example', 99),
+                                   ('example.org', 0)):
+            self.environ['QMAILHOST'] = hostname
+            self.assertEqual(self.run_filter('tmda-filter-client',
+                                             'sender@example.org')[0],
+                             status)
+
+    def testNoServer(self):
+        self.server.terminate()
+        self.server.wait()
+        self.assertFalse(os.path.exists(self.socket))
+        self.assertEqual(self.run_filter('tmda-filter-client',
+                                         'x@spam.example')[0], 99)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
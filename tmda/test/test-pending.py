@@ -11,6 +11,7 @@ lib.util.testPrep()
 
 from TMDA import Pending
 from TMDA import Defaults
+from TMDA import SMTP
 from TMDA import Util
 
 verbose = False
@@ -80,6 +81,18 @@ class MockMailQueue(object):
     def fetch_message(self, msgid):
         return self.parser.parsebytes(self._msgs[msgid])
 
+    def fetch_headers(self, msgid):
+        return self.parser.parsebytes(self._msgs[msgid], headersonly=True)
+
+    def message_size(self, msgid):
+        return len(self._msgs[msgid])
+
+    def fetch_metadata(self):
+        from TMDA.Queue.Queue import Queue
+        return [Queue()._make_metadata(self.fetch_headers(msgid), msgid, None,
+                                       self.message_size(msgid))
+                for msgid in self._msgs]
+
     def delete_message(self, msgid):
         self._msgs.pop(msgid, None)
 
@@ -129,6 +142,137 @@ class QueueInitTests(unittest.TestCase):
         self.assertEqual(pending.msgs, ['1243439251.12345', '1303349951.12346',
                                         '1303433207.12347'])
 
+class QueryTests(unittest.TestCase):
+    '''
+    TMDA.Pending.Query selects messages by their metadata.
+    '''
+
+    def setUp(self):
+        Pending.Q = MockMailQueue()
+
+    def select(self, msgs=[], **kwargs):
+        pending = Pending.Queue(list(msgs), query=Pending.Query(**kwargs))
+        pending.initQueue()
+        return pending.msgs
+
+    def testSender(self):
+        self.assertEqual(self.select(sender=r'^return\.path\.[23]@'),
+                         ['1303349951.12346', '1303433207.12347'])
+        self.assertEqual(self.select(sender='RETURN.PATH.1'),
+                         ['1243439251.12345'])
+
+    def testDomain(self):
+        self.assertEqual(self.select(domain='example.com'),
+                         ['1243439251.12345', '1303349951.12346',
+                          '1303433207.12347'])
+        self.assertEqual(self.select(domain='com'),
+                         ['1243439251.12345', '1303349951.12346',
+                          '1303433207.12347'])
+        self.assertEqual(self.select(domain='ample.com'), [])
+
+    def testRecipient(self):
+        self.assertEqual(self.select(recipient='-extension@'),
+                         ['1303433207.12347'])
+
+    def testSubject(self):
+        self.assertEqual(self.select(subject='num\xe9ro'),
+                         ['1303349951.12346', '1303433207.12347'])
+        self.assertEqual(self.select(subject='num\xe9ro', larger=400,
+                                     smaller=480),
+                         ['1303349951.12346'])
+
+    def testAge(self):
+        age = int(time.time()) - 1303400000
+        self.assertEqual(self.select(younger='%ds' % age),
+                         ['1303433207.12347'])
+        self.assertEqual(self.select(younger='%ds' % (age + 100000),
+                                     older='%ds' % age),
+                         ['1303349951.12346'])
+
+    def testMessages(self):
+        self.assertEqual(self.select(['1243439251.12345', '1303433207.12347'],
+                                     sender='example'),
+                         ['1243439251.12345', '1303433207.12347'])
+
+class MessageTests(unittest.TestCase):
+    '''
+    TMDA.Pending.Message only reads the whole message when needed.
+    '''
+
+    def setUp(self):
+        Pending.Q = MockMailQueue()
+        self.fetched = []
+        fetch_message = Pending.Q.fetch_message
+        def record_fetch(msgid):
+            self.fetched.append(msgid)
+            return fetch_message(msgid)
+        Pending.Q.fetch_message = record_fetch
+
+    def testHeaders(self):
+        msg = Pending.Message('1243439251.12345')
+        self.assertEqual(msg.return_path, 'return.path.1@example.com')
+        self.assertEqual(msg.recipient, 'testuser@example.com')
+        summary = msg.summary()
+        self.assertTrue(summary.startswith('1243439251.12345 (%d bytes)'
+                        % len(Pending.Q._msgs['1243439251.12345'])))
+        self.assertTrue('Test message number one!' in summary)
+        self.assertEqual(msg.terse()[0], '1243439251.12345')
+        self.assertEqual(self.fetched, [])
+
+    def testBody(self):
+        msg = Pending.Message('1243439251.12345')
+        self.assertTrue('This is a test message.' in msg.show())
+        self.assertEqual(self.fetched, ['1243439251.12345'])
+        msg.show()
+        self.assertEqual(self.fetched, ['1243439251.12345'])
+
+class MessageCacheTests(unittest.TestCase):
+    '''
+    The PENDING_CACHE journal is appended to, then rewritten when it grows.
+    '''
+
+    def setUp(self):
+        self.filename = Defaults.PENDING_CACHE
+
+    def tearDown(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def lines(self):
+        return open(self.filename).read().splitlines()
+
+    def testJournal(self):
+        cache = Pending.MessageCache(self.filename, 3)
+        cache.add('1.1')
+        cache.add('2.2')
+        cache.save()
+        cache = Pending.MessageCache(self.filename, 3)
+        self.assertTrue('1.1' in cache)
+        cache.remove('1.1')
+        cache.add('3.3')
+        cache.save()
+        self.assertEqual(self.lines(), ['+1.1', '+2.2', '-1.1', '+3.3'])
+        cache = Pending.MessageCache(self.filename, 3)
+        self.assertEqual(list(cache), ['3.3', '2.2'])
+
+    def testCompact(self):
+        cache = Pending.MessageCache(self.filename, 2)
+        for msgid in ['1.1', '2.2', '3.3', '4.4', '5.5']:
+            cache.add(msgid)
+        cache.save()
+        self.assertEqual(self.lines(), ['+4.4', '+5.5'])
+        cache = Pending.MessageCache(self.filename, 2)
+        self.assertEqual(list(cache), ['5.5', '4.4'])
+
+    def testConvert(self):
+        Util.pickleit(['3.3', '2.2', '1.1'], self.filename, 0)
+        cache = Pending.MessageCache(self.filename, 2)
+        self.assertEqual(list(cache), ['3.3', '2.2'])
+        cache.save()
+        self.assertEqual(self.lines(), ['+2.2', '+3.3'])
+
 class QueueLoopTestMixin(object):
     expected_addrs = ['return.path.1@example.com', 'return.path.2@example.com',
                       'return.path.3@example.com']
@@ -282,6 +426,34 @@ class QueueLoopTestAppendingMixin(QueueLoopTestMixin):
         self.assertEqual(len(self.file_appends), 1)
         self.assertEqual(len(self.db_inserts), 1)
 
+    def testTimeRange(self):
+        younger = "%ds" % (time.time() - 1303000000)
+        older = "%ds" % (time.time() - 1303400000)
+
+        # as tmda-pending -Y ... -O ... does
+        queue = Pending.Queue(dispose=self.dispose, verbose=verbose,
+                              younger=younger, older=older,
+                              query=Pending.Query(younger=younger,
+                                                  older=older))
+        queue.initQueue()
+
+        queue.mainLoop()
+        self.assertEqual(len(self.file_appends), 1)
+        self.assertEqual(len(self.db_inserts), 1)
+
+    def testThresholdRange(self):
+        younger = "%ds" % (time.time() - 1303000000)
+        older = "%ds" % (time.time() - 1303400000)
+
+        queue = Pending.Queue(dispose=self.dispose, verbose=verbose,
+                              threshold=younger, younger=younger,
+                              older=older)
+        queue.initQueue()
+
+        queue.mainLoop()
+        self.assertEqual(len(self.file_appends), 1)
+        self.assertEqual(len(self.db_inserts), 1)
+
     def testCached(self):
         # First, cause some IDs to be cached.
         cache_ids = ['1243439251.12345', '1303433207.12347']
@@ -291,7 +463,7 @@ class QueueLoopTestAppendingMixin(QueueLoopTestMixin):
 
         queue.mainLoop()
         # Make sure the cached IDs are as expected.
-        self.assertEqual(queue.msgcache, list(reversed(cache_ids)))
+        self.assertEqual(list(queue.msgcache), list(reversed(cache_ids)))
 
         # Revisit the loop, this time expected only the non-cached IDs to be
         # handled.
@@ -329,6 +501,125 @@ class QueueLoopReleaseTest(QueueLoopTestAppendingMixin, unittest.TestCase):
     def dropDbInsert(self):
         Defaults.DB_PENDING_RELEASE_APPEND = None
 
+class MockConnection(object):
+    '''
+    Records the messages sent over it, and fails for the extension address.
+    '''
+    connections = []
+
+    def __init__(self):
+        self.sent = []
+        self.connections.append(self)
+
+    def sendmail(self, envsender, recips, msg_bytes):
+        if recips == 'testuser-extension@example.com':
+            raise SMTP.smtplib.SMTPRecipientsRefused({recips: (550, 'No')})
+        self.sent.append(recips)
+        return {}
+
+    def quit(self):
+        pass
+
+class QueueReleaseSMTPTest(unittest.TestCase):
+    '''
+    Released messages are sent over reused SMTP connections.
+    '''
+
+    def setUp(self):
+        Pending.Q = MockMailQueue()
+        Defaults.MAIL_TRANSPORT = 'smtp'
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        self.Connection = SMTP.Connection
+        SMTP.Connection = MockConnection
+        MockConnection.connections = []
+
+    def tearDown(self):
+        SMTP.Connection = self.Connection
+        sys.stderr = self.stderr
+        imp.reload(Defaults)
+
+    def release(self, connections):
+        Defaults.PENDING_RELEASE_CONNECTIONS = connections
+        queue = Pending.Queue(dispose='release', verbose=verbose)
+        queue.initQueue()
+        queue.mainLoop()
+        sent = []
+        for conn in MockConnection.connections:
+            sent.extend(conn.sent)
+        self.assertEqual(sent, ['testuser@example.com'] * 2)
+        self.assertEqual(queue.failures, ['1303433207.12347'])
+        self.assertTrue(sys.stderr.getvalue().startswith(
+            'release 1303433207.12347 failed: '))
+
+    def testConnection(self):
+        self.release(1)
+        self.assertEqual(len(MockConnection.connections), 1)
+
+    def testConnectionPool(self):
+        self.release(2)
+        self.assertEqual(len(MockConnection.connections), 2)
+
+class MockSMTP(object):
+    '''
+    An SMTP session the server closes once idle, i.e. after each message.
+    '''
+    sessions = []
+    down = False
+
+    def __init__(self):
+        self.sent = 0
+        self.sessions.append(self)
+
+    def connect(self, host):
+        pass
+
+    def sendmail(self, envsender, recips, msg_bytes):
+        if self.sent or self.down:
+            raise SMTP.smtplib.SMTPServerDisconnected(
+                'Connection unexpectedly closed')
+        self.sent += 1
+        return {}
+
+    def quit(self):
+        pass
+
+class ConnectionTest(unittest.TestCase):
+    '''
+    A connection the server closed while idle is opened again.
+    '''
+
+    def setUp(self):
+        Defaults.SMTPHOST = 'localhost'
+        Defaults.SMTPSSL = None
+        Defaults.SMTPAUTH_USERNAME = Defaults.SMTPAUTH_PASSWORD = None
+        Defaults.SMTP_MAX_SESSIONS_PER_CONNECTION = 0
+        self.SMTP = SMTP.smtplib.SMTP
+        SMTP.smtplib.SMTP = MockSMTP
+        MockSMTP.sessions = []
+        MockSMTP.down = False
+
+    def tearDown(self):
+        SMTP.smtplib.SMTP = self.SMTP
+        imp.reload(Defaults)
+
+    def testReconnect(self):
+        conn = SMTP.Connection()
+        for i in range(3):
+            self.assertEqual(conn.sendmail('a@example.com',
+                                           'b@example.com', b'test'), {})
+        self.assertEqual(len(MockSMTP.sessions), 3)
+
+    def testServerDown(self):
+        conn = SMTP.Connection()
+        conn.sendmail('a@example.com', 'b@example.com', b'test')
+        MockSMTP.down = True
+        self.assertRaises(SMTP.smtplib.SMTPServerDisconnected,
+                          conn.sendmail, 'a@example.com', 'b@example.com',
+                          b'test')
+        # tried once more only
+        self.assertEqual(len(MockSMTP.sessions), 2)
+
 class QueueLoopDeleteTest(QueueLoopTestAppendingMixin, unittest.TestCase):
     dispose = 'delete'
     append_file = 'delete_file'
@@ -0,0 +1,418 @@
+import fcntl
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from email.message import Message
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Cookie
+from TMDA import Defaults
+from TMDA import Util
+from TMDA.Queue.MaildirQueue import MaildirQueue
+from TMDA.Queue.OriginalQueue import OriginalQueue
+from TMDA.Queue.Queue import STORED_FIELDS
+from TMDA.Queue import SQLiteQueue as SQLiteQueueModule
+from TMDA.Queue.SQLiteQueue import SQLiteQueue
+
+
+def make_message(subject):
+    msg = Message()
+    msg['Return-Path'] = '<sender@example.org>'
+    msg['Subject'] = subject
+    msg.set_payload('Hello\n')
+    return msg
+
+
+class QueueTestMixin(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tmda-test-queue.')
+        self.saved = (Defaults.PENDING_DIR, Defaults.PENDING_LIFETIME)
+        Defaults.PENDING_DIR = os.path.join(self.tmpdir, 'pending')
+        self.queue = self.queueClass()
+        self.now = int(time.time())
+        self.mailids = [ '%d.%d' % (self.now - i, 100 + i) for i in range(3) ]
+        for (i, mailid) in enumerate(self.mailids):
+            self.queue.insert_message(make_message('message %d' % i), mailid,
+                                      'testuser@example.com')
+
+    def tearDown(self):
+        (Defaults.PENDING_DIR, Defaults.PENDING_LIFETIME) = self.saved
+        shutil.rmtree(self.tmpdir, True)
+
+    def testFetch(self):
+        self.assertEqual(sorted(self.queue.fetch_ids()), sorted(self.mailids))
+        msg = self.queue.fetch_message(self.mailids[1])
+        self.assertEqual(msg['subject'], 'message 1')
+        self.assertEqual(msg['x-tmda-recipient'], 'testuser@example.com')
+        self.assertTrue(self.queue.find_message(self.mailids[2]))
+
+    def testHeaders(self):
+        msg = self.queue.fetch_headers(self.mailids[1])
+        self.assertEqual(msg['subject'], 'message 1')
+        self.assertEqual(msg['return-path'], '<sender@example.org>')
+        self.assertEqual(msg.get_payload(), '')
+        size = len(Util.msg_as_bytes(self.queue.fetch_message(self.mailids[1])))
+        self.assertEqual(self.queue.message_size(self.mailids[1]), size)
+
+    def testMetadata(self):
+        self.queue.delete_message(self.mailids[0])
+        metadata = dict([ (record['mailid'], record)
+                          for record in self.queue.fetch_metadata() ])
+        self.assertEqual(sorted(metadata), sorted(self.mailids[1:]))
+        record = metadata[self.mailids[1]]
+        self.assertEqual(sorted(record), sorted(STORED_FIELDS))
+        self.assertEqual(record['return_path'], '<sender@example.org>')
+        self.assertEqual(record['recipient'], 'testuser@example.com')
+        self.assertEqual(record['subject'], 'message 1')
+        self.assertEqual(record['from'], None)
+        self.assertEqual(record['size'],
+                         self.queue.message_size(self.mailids[1]))
+        (timestamp, pid) = self.mailids[1].split('.')
+        self.assertEqual(record['confirm_address'],
+                         Cookie.make_confirm_address('testuser@example.com',
+                                                     timestamp, pid, 'accept'))
+
+    def testConfirmAddressLazy(self):
+        # The confirmation addresses are only made when looked up.
+        make_confirm_address = Cookie.make_confirm_address
+        made = []
+        def count(*args):
+            made.append(args)
+            return make_confirm_address(*args)
+        Cookie.make_confirm_address = count
+        try:
+            self.queue.insert_message(make_message('new'),
+                                      '%d.500' % self.now,
+                                      'testuser@example.com')
+            records = self.queue.fetch_metadata()
+            self.assertEqual(made, [])
+            self.assertTrue(records[0].get('confirm_address'))
+            self.assertEqual(len(made), 1)
+        finally:
+            Cookie.make_confirm_address = make_confirm_address
+
+    def testDelete(self):
+        self.queue.delete_message(self.mailids[0])
+        self.assertFalse(self.queue.find_message(self.mailids[0]))
+        self.assertRaises(IOError, self.queue.fetch_message, self.mailids[0])
+        self.assertEqual(sorted(self.queue.fetch_ids()),
+                         sorted(self.mailids[1:]))
+
+    def testCleanup(self):
+        Defaults.PENDING_LIFETIME = '1h'
+        old = '%d.99' % (self.now - 7200)
+        self.queue.insert_message(make_message('old'), old,
+                                  'testuser@example.com')
+        self.queue.cleanup()
+        self.assertFalse(self.queue.find_message(old))
+        self.assertTrue(self.queue.find_message(self.mailids[0]))
+
+    def testCleanupBudget(self):
+        Defaults.PENDING_LIFETIME = '1h'
+        old = [ '%d.%d' % (self.now - 7200 - i, 200 + i) for i in range(5) ]
+        for mailid in old:
+            self.queue.insert_message(make_message('old'), mailid,
+                                      'testuser@example.com')
+        self.assertEqual(self.queue.cleanup(2), 2)
+        # The oldest are deleted first.
+        self.assertEqual(sorted(self.queue.fetch_ids()),
+                         sorted(self.mailids + old[:3]))
+        self.assertEqual(self.queue.cleanup(2), 2)
+        self.assertEqual(self.queue.cleanup(2), 1)
+        self.assertEqual(self.queue.cleanup(2), 0)
+        self.assertEqual(sorted(self.queue.fetch_ids()), sorted(self.mailids))
+        (cursor, oldest, compacted) = open(os.path.join(
+            Defaults.PENDING_DIR, 'tmda-cleanup')).read().split()
+        self.assertTrue(int(cursor) >= self.now - 3600)
+        self.assertEqual(int(oldest), self.now - 2)
+
+    def testCleanupUpToDate(self):
+        # Once clean, the queue isn't gone through until its oldest
+        # message expires.
+        Defaults.PENDING_LIFETIME = '1h'
+        self.assertEqual(self.queue.cleanup(2), 0)
+        def expire(after, until, limit):
+            raise AssertionError('the queue is gone through')
+        self.queue._expire = expire
+        self.assertEqual(self.queue.cleanup(2), 0)
+        Defaults.PENDING_LIFETIME = '1s'
+        self.assertRaises(AssertionError, self.queue.cleanup, 2)
+
+    def testCleanupLease(self):
+        Defaults.PENDING_LIFETIME = '1h'
+        old = '%d.99' % (self.now - 7200)
+        self.queue.insert_message(make_message('old'), old,
+                                  'testuser@example.com')
+        fd = os.open(os.path.join(Defaults.PENDING_DIR, 'tmda-cleanup'),
+                     os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self.assertEqual(self.queue.cleanup(), None)
+        finally:
+            os.close(fd)
+        self.assertEqual(self.queue.cleanup(), 1)
+
+
+class FileQueueTestMixin(QueueTestMixin):
+    def metadataFile(self):
+        return os.path.join(Defaults.PENDING_DIR, 'tmda-metadata')
+
+    def testMetadataRebuilt(self):
+        os.unlink(self.metadataFile())
+        self.assertEqual(sorted([ record['mailid'] for record
+                                  in self.queue.fetch_metadata() ]),
+                         sorted(self.mailids))
+        self.assertEqual(len(open(self.metadataFile()).readlines()), 3)
+
+    def testMetadataCompaction(self):
+        # Only cleanups without a budget compact a small store.
+        Defaults.PENDING_LIFETIME = '1h'
+        for i in range(2):
+            self.queue.insert_message(make_message('old'),
+                                      '%d.%d' % (self.now - 7200, 200 + i),
+                                      'testuser@example.com')
+        self.assertEqual(self.queue.cleanup(1), 1)
+        self.assertEqual(len(open(self.metadataFile()).readlines()), 5)
+        self.assertEqual(self.queue.cleanup(), 1)
+        self.assertEqual(len(open(self.metadataFile()).readlines()), 3)
+
+    def testMetadataReplaced(self):
+        # A record appended while the store is being replaced (as
+        # _compact_metadata() does) goes to the new store.
+        new = '%d.400' % self.now
+        with self.queue._lock_metadata():
+            record = self.queue._make_metadata(make_message('new'), new,
+                                               'testuser@example.com', 6)
+            thread = threading.Thread(target=self.queue._append_metadata,
+                                      args=(record,))
+            thread.start()
+            time.sleep(0.2)
+            tmpname = self.metadataFile() + '.new'
+            shutil.copy(self.metadataFile(), tmpname)
+            os.rename(tmpname, self.metadataFile())
+        thread.join()
+        self.assertTrue(new in self.queue._read_metadata())
+
+    def testMetadataCleanup(self):
+        Defaults.PENDING_LIFETIME = '1h'
+        saved = Defaults.PENDING_DELETE_APPEND
+        Defaults.PENDING_DELETE_APPEND = os.path.join(self.tmpdir, 'deleted')
+        try:
+            old = '%d.99' % (self.now - 7200)
+            msg = make_message('old')
+            msg.replace_header('Return-Path', '<old@example.org>')
+            self.queue.insert_message(msg, old, 'testuser@example.com')
+            self.queue.cleanup()
+        finally:
+            Defaults.PENDING_DELETE_APPEND = saved
+        self.assertEqual(open(os.path.join(self.tmpdir, 'deleted')).read(),
+                         'old@example.org\n')
+        self.assertEqual(len(open(self.metadataFile()).readlines()), 3)
+
+
+class OriginalQueueTest(FileQueueTestMixin, unittest.TestCase):
+    queueClass = OriginalQueue
+
+
+class BucketQueueTest(FileQueueTestMixin, unittest.TestCase):
+    queueClass = OriginalQueue
+
+    def setUp(self):
+        self.bucket_size = Defaults.PENDING_BUCKET_SIZE
+        Defaults.PENDING_BUCKET_SIZE = '1h'
+        FileQueueTestMixin.setUp(self)
+
+    def tearDown(self):
+        Defaults.PENDING_BUCKET_SIZE = self.bucket_size
+        FileQueueTestMixin.tearDown(self)
+
+    def bucket(self, msg_time):
+        start = msg_time // 3600 * 3600
+        return os.path.join(Defaults.PENDING_DIR,
+                            '%d-%d' % (start, start + 3600))
+
+    def testLayout(self):
+        for mailid in self.mailids:
+            self.assertTrue(os.path.exists(os.path.join(
+                self.bucket(int(mailid.split('.')[0])), mailid + '.msg')))
+
+    def testExpiredBucket(self):
+        Defaults.PENDING_LIFETIME = '1h'
+        old = [ '%d.%d' % (self.now - 7200 - i, 200 + i) for i in range(3) ]
+        for mailid in old:
+            self.queue.insert_message(make_message('old'), mailid,
+                                      'testuser@example.com')
+        buckets = set([ self.bucket(int(mailid.split('.')[0]))
+                        for mailid in old ])
+        self.queue.cleanup()
+        self.assertEqual(sorted(self.queue.fetch_ids()), sorted(self.mailids))
+        for bucket in buckets:
+            self.assertFalse(os.path.exists(bucket))
+
+    def testMigrate(self):
+        flat = '%d.300' % self.now
+        Defaults.PENDING_BUCKET_SIZE = None
+        self.queue.insert_message(make_message('flat'), flat,
+                                  'testuser@example.com')
+        Defaults.PENDING_BUCKET_SIZE = '1h'
+        self.assertEqual(self.queue.fetch_message(flat)['subject'], 'flat')
+        self.assertTrue(os.path.exists(os.path.join(self.bucket(self.now),
+                                                    flat + '.msg')))
+        # Messages queued with another bucket size are still found.
+        Defaults.PENDING_BUCKET_SIZE = '1d'
+        self.assertTrue(self.queue.find_message(flat))
+        self.queue.delete_message(flat)
+        self.assertFalse(self.queue.find_message(flat))
+
+
+class MaildirQueueTest(FileQueueTestMixin, unittest.TestCase):
+    queueClass = MaildirQueue
+
+    def indexDir(self):
+        return os.path.join(Defaults.PENDING_DIR, 'tmda-index')
+
+    def testIndexed(self):
+        self.assertEqual(sorted(os.listdir(self.indexDir())),
+                         sorted(self.mailids))
+        # A mailid is not found by substring.
+        self.assertFalse(self.queue.find_message(self.mailids[0][1:]))
+
+    def testRenamed(self):
+        # A MUA moves messages to cur/, maybe with flags.
+        for (mailid, info) in ((self.mailids[0], ':2,'),
+                               (self.mailids[1], ':2,S')):
+            link = os.path.join(self.indexDir(), mailid)
+            filename = os.path.basename(os.readlink(link))
+            os.rename(os.path.join(Defaults.PENDING_DIR, 'new', filename),
+                      os.path.join(Defaults.PENDING_DIR, 'cur',
+                                   filename + info))
+            msg = self.queue.fetch_message(mailid)
+            self.assertEqual(msg['subject'],
+                             'message %d' % self.mailids.index(mailid))
+            self.assertEqual(os.readlink(link),
+                             os.path.join('..', 'cur', filename + info))
+
+    def testUnindexed(self):
+        # Messages queued before the index existed are found and indexed.
+        shutil.rmtree(self.indexDir())
+        self.assertTrue(self.queue.find_message(self.mailids[2]))
+        self.assertEqual(os.listdir(self.indexDir()), [self.mailids[2]])
+        self.queue.delete_message(self.mailids[1])
+        self.assertEqual(sorted(self.queue.fetch_ids()),
+                         sorted([self.mailids[0], self.mailids[2]]))
+
+    def testStale(self):
+        link = os.path.join(self.indexDir(), self.mailids[0])
+        target = os.path.join(Defaults.PENDING_DIR,
+                              os.path.relpath(os.readlink(link), '..'))
+        os.unlink(target)
+        self.assertFalse(self.queue.find_message(self.mailids[0]))
+        self.assertFalse(os.path.lexists(link))
+
+
+class SQLiteQueueTest(QueueTestMixin, unittest.TestCase):
+    queueClass = SQLiteQueue
+
+    def testColumns(self):
+        db = sqlite3.connect(os.path.join(Defaults.PENDING_DIR,
+                                          'pending.sqlite'))
+        row = db.execute('SELECT timestamp, return_path, recipient, subject,'
+                         ' size FROM messages WHERE mailid = ?',
+                         (self.mailids[2],)).fetchone()
+        db.close()
+        self.assertEqual(row[:4], (self.now - 2, '<sender@example.org>',
+                                   'testuser@example.com', 'message 2'))
+        self.assertTrue(row[4] > 0)
+
+    def testUpgrade(self):
+        # A database created before the date and confirm_address columns.
+        Defaults.PENDING_DIR = os.path.join(self.tmpdir, 'old')
+        os.makedirs(Defaults.PENDING_DIR)
+        db = sqlite3.connect(os.path.join(Defaults.PENDING_DIR,
+                                          'pending.sqlite'))
+        db.executescript("""
+CREATE TABLE messages (
+    mailid TEXT PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    return_path TEXT,
+    recipient TEXT,
+    from_header TEXT,
+    subject TEXT,
+    size INTEGER NOT NULL,
+    message BLOB NOT NULL
+);
+""")
+        db.execute("INSERT INTO messages VALUES (?, ?, '<old@example.org>',"
+                   " 'testuser@example.com', NULL, 'old', 6, ?)",
+                   (self.mailids[0], self.now, b'\nHello'))
+        db.commit()
+        db.close()
+        queue = SQLiteQueue()
+        queue.insert_message(make_message('new'), self.mailids[1],
+                             'testuser@example.com')
+        metadata = dict([ (record['mailid'], record)
+                          for record in queue.fetch_metadata() ])
+        self.assertEqual(metadata[self.mailids[0]]['subject'], 'old')
+        self.assertEqual(metadata[self.mailids[1]]['subject'], 'new')
+        self.assertTrue(metadata[self.mailids[1]]['confirm_address'])
+
+    def testConvert(self):
+        for queueClass in (OriginalQueue, MaildirQueue):
+            Defaults.PENDING_DIR = os.path.join(self.tmpdir,
+                                                queueClass.__name__)
+            queue = queueClass()
+            for mailid in self.mailids:
+                queue.insert_message(make_message(mailid), mailid,
+                                     'testuser@example.com')
+            queue = SQLiteQueue()
+            self.assertEqual(sorted(queue.fetch_ids()), sorted(self.mailids))
+            self.assertEqual(queueClass().fetch_ids(), [])
+            msg = queue.fetch_message(self.mailids[0])
+            self.assertEqual(msg['subject'], self.mailids[0])
+            self.assertEqual(msg['x-tmda-recipient'], 'testuser@example.com')
+
+    def testConvertResumed(self):
+        # A few messages are moved each time the database is opened,
+        # those left by an interrupted conversion included, and the
+        # rest by a cleanup.
+        Defaults.PENDING_DIR = os.path.join(self.tmpdir, 'old')
+        SQLiteQueue().fetch_ids()
+        db = sqlite3.connect(os.path.join(Defaults.PENDING_DIR,
+                                          'pending.sqlite'))
+        db.execute('DELETE FROM state')
+        db.commit()
+        db.close()
+        queue = OriginalQueue()
+        old = [ '%d.%d' % (self.now - i, 300 + i) for i in range(5) ]
+        for mailid in old:
+            queue.insert_message(make_message(mailid), mailid,
+                                 'testuser@example.com')
+        batch = SQLiteQueueModule.CONVERT_BATCH
+        SQLiteQueueModule.CONVERT_BATCH = 2
+        try:
+            for left in (3, 1):
+                SQLiteQueueModule._connections.clear()
+                SQLiteQueue().fetch_ids()
+                self.assertEqual(len(queue.fetch_ids()), left)
+            self.assertEqual(SQLiteQueue().cleanup(), 0)
+            self.assertEqual(queue.fetch_ids(), [])
+            self.assertEqual(sorted(SQLiteQueue().fetch_ids()), sorted(old))
+            # Once done, PENDING_DIR is no longer looked at.
+            queue.insert_message(make_message('late'), self.mailids[0],
+                                 'testuser@example.com')
+            SQLiteQueueModule._connections.clear()
+            SQLiteQueue().cleanup()
+            self.assertEqual(queue.fetch_ids(), [self.mailids[0]])
+        finally:
+            SQLiteQueueModule.CONVERT_BATCH = batch
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)